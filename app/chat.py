@@ -0,0 +1,329 @@
+# app/chat.py
+
+import json
+import time
+import asyncio
+import logging
+
+from starlette.websockets import WebSocketDisconnect
+
+from app.config import CHAT_FLUSH_BATCH, CHAT_FLUSH_INTERVAL_S, CHAT_MAX_TEXT, CHAT_PENDING_MAX, CHAT_SEND_QUEUE
+from app.db import get_pool
+
+# Чат между "сматченными" пользователями (accepted-инвайт в любую сторону).
+# /ws/chat - одно соединение на вкладку; сообщение сразу раздаётся соединениям
+# обоих участников, а в messages пишется пачками (одна транзакция на пачку).
+# id выдаёт хаб (MAX(id) при старте + счётчик), поэтому клиент получает id
+# сразу, а история листается keyset-ом по (user_lo, user_hi, id).
+# Очередь отправки соединения ограничена CHAT_SEND_QUEUE: медленный клиент
+# отключается (1013), переподключается и дочитывает историю.
+# Хаб живёт в процессе - как notification_hub, рассчитан на один воркер.
+
+MATCHED_PEER_SQL = """
+    SELECT u.id FROM users u
+    WHERE u.tg_id = ? AND u.id != ? AND EXISTS (
+        SELECT 1 FROM invites i
+        WHERE (i.from_user_id = ? AND i.to_user_id = u.id AND i.status = 'accepted')
+           OR (i.from_user_id = u.id AND i.to_user_id = ? AND i.status = 'accepted')
+    )
+"""
+
+# tg_id -> users.id всех собеседников, грузится один раз при подключении
+PEERS_SQL = """
+    SELECT u.tg_id, u.id FROM users u
+    WHERE u.id IN (
+        SELECT to_user_id FROM invites WHERE from_user_id = ? AND status = 'accepted'
+        UNION
+        SELECT from_user_id FROM invites WHERE to_user_id = ? AND status = 'accepted'
+    )
+"""
+
+# собеседники: все accepted-инвайты пользователя + последнее сообщение в паре
+CONTACTS_SQL = """
+    WITH peers AS (
+        SELECT to_user_id AS peer_id FROM invites WHERE from_user_id = ? AND status = 'accepted'
+        UNION
+        SELECT from_user_id FROM invites WHERE to_user_id = ? AND status = 'accepted'
+    )
+    SELECT u.id, u.tg_id, u.name, u.username, u.avatar,
+           m.id AS last_id, m.sender_id AS last_sender_id, m.body AS last_text, m.created_at AS last_at
+    FROM peers p
+    JOIN users u ON u.id = p.peer_id
+    LEFT JOIN messages m ON m.id = (
+        SELECT MAX(id) FROM messages WHERE user_lo = MIN(p.peer_id, ?) AND user_hi = MAX(p.peer_id, ?)
+    )
+    ORDER BY m.id IS NULL, m.id DESC
+    LIMIT ?
+"""
+
+HISTORY_SQL = """
+    SELECT id, sender_id, body, created_at FROM messages
+    WHERE user_lo = ? AND user_hi = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+
+async def create_messages_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,        -- выдаёт chat_hub
+            user_lo INTEGER NOT NULL,      -- пара собеседников: min/max users.id
+            user_hi INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_pair
+            ON messages(user_lo, user_hi, id);
+    """)
+
+
+def pair(a: int, b: int):
+    return (a, b) if a < b else (b, a)
+
+
+async def load_peers(db, user_id: int) -> dict:
+    cur = await db.execute(PEERS_SQL, (user_id, user_id))
+    return {r[0]: r[1] for r in await cur.fetchall()}
+
+
+async def matched_peer(db, user_id: int, peer_tg: int):
+    """users.id собеседника, если между ними есть accepted-инвайт, иначе None."""
+    cur = await db.execute(MATCHED_PEER_SQL, (peer_tg, user_id, user_id, user_id))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+class _Conn:
+    __slots__ = ("user_id", "tg_id", "ws", "queue", "writer", "peers", "closed")
+
+    def __init__(self, ws, user_id: int, tg_id: int, peers: dict):
+        self.ws = ws
+        self.user_id = user_id
+        self.tg_id = tg_id
+        self.queue = asyncio.Queue(maxsize=CHAT_SEND_QUEUE)
+        self.writer = None
+        self.peers = peers    # tg_id -> users.id, проверенные собеседники
+        self.closed = False
+
+
+class ChatHub:
+
+    def __init__(self):
+        self._conns = {}      # user_id -> set(_Conn)
+        self._pending = []    # (id, user_lo, user_hi, sender_id, body, created_at) ещё не в messages
+        self._next_id = 0
+        self._wake = None
+        self._lock = None
+        self._flusher = None
+        self._stopping = False
+        self.connections = 0
+        self.messages = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.flush_batches = 0
+        self.flush_errors = 0
+        self.flush_max_batch = 0
+
+    async def start(self):
+        async with get_pool().reader() as db:
+            cur = await db.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            self._next_id = (await cur.fetchone())[0]
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Закрыть соединения (1001) и дописать незаписанные сообщения."""
+        self._stopping = True
+        for conns in list(self._conns.values()):
+            for c in list(conns):
+                self._disconnect(c, 1001)
+        if self._flusher is not None:
+            self._wake.set()
+            try:
+                await self._flusher
+            except Exception:
+                logging.exception("chat: flusher failed")
+            self._flusher = None
+        if self._pending and not await self.flush():
+            logging.error("chat: %d messages lost on shutdown", len(self._pending))
+
+    async def serve(self, ws, user_id: int, tg_id: int, peers: dict):
+        """Цикл чтения одного WebSocket; отправка - в отдельной задаче через ограниченную очередь.
+
+        ws уже принят (accept) и аутентифицирован вызывающим.
+        peers - load_peers() на момент подключения; сматченные позже проверяются при первом сообщении.
+        """
+        conn = _Conn(ws, user_id, tg_id, peers)
+        conn.writer = asyncio.create_task(self._writer(conn))
+        self._conns.setdefault(user_id, set()).add(conn)
+        self.connections += 1
+        try:
+            while not conn.closed:
+                raw = await ws.receive_text()
+                try:
+                    msg = json.loads(raw)
+                except ValueError:
+                    msg = None
+                if not isinstance(msg, dict):
+                    self._push(conn, _error(None, "bad json"))
+                elif msg.get("type") == "send":
+                    await self._send(conn, msg)
+                elif msg.get("type") == "ping":
+                    self._push(conn, '{"type": "pong"}')
+                else:
+                    self._push(conn, _error(msg.get("client_id"), "unknown type"))
+        except (WebSocketDisconnect, RuntimeError):
+            # клиент ушёл или соединение уже закрыто нами (_disconnect)
+            pass
+        finally:
+            conns = self._conns.get(user_id)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del self._conns[user_id]
+            self.connections -= 1
+            conn.closed = True
+            conn.writer.cancel()
+            await asyncio.gather(conn.writer, return_exceptions=True)
+
+    async def _send(self, conn: _Conn, msg: dict):
+        client_id = msg.get("client_id")
+        client_id = str(client_id)[:64] if client_id is not None else None
+        text = msg.get("text")
+        text = text.strip() if isinstance(text, str) else ""
+        try:
+            to_tg = int(msg.get("to"))
+        except (TypeError, ValueError):
+            to_tg = None
+        if not text or len(text) > CHAT_MAX_TEXT or to_tg is None:
+            self._push(conn, _error(client_id, "to and text (1..%d chars) required" % CHAT_MAX_TEXT))
+            return
+        if len(self._pending) >= CHAT_PENDING_MAX:
+            # БД не успевает (или недоступна) - не копим в памяти бесконечно
+            self.rejected += 1
+            self._push(conn, _error(client_id, "busy, retry later"))
+            return
+        peer_id = conn.peers.get(to_tg)
+        if peer_id is None:
+            async with get_pool().reader() as db:
+                peer_id = await matched_peer(db, conn.user_id, to_tg)
+            if peer_id is None:
+                self._push(conn, _error(client_id, "not matched"))
+                return
+            conn.peers[to_tg] = peer_id
+
+        self._next_id += 1
+        mid = self._next_id
+        created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._pending.append((mid, *pair(conn.user_id, peer_id), conn.user_id, text, created_at))
+        self._wake.set()
+        self.messages += 1
+
+        event = json.dumps({"type": "message", "id": mid, "from_tg": conn.tg_id, "to_tg": to_tg, "text": text,
+                            "created_at": created_at, "client_id": client_id}, ensure_ascii=False)
+        targets = list(self._conns.get(conn.user_id, ()))
+        if peer_id != conn.user_id:
+            targets += self._conns.get(peer_id, ())
+        for c in targets:
+            self._push(c, event)
+
+    def _push(self, conn: _Conn, event: str):
+        if conn.closed:
+            return
+        try:
+            conn.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # медленный потребитель: рвём соединение, историю он дочитает после переподключения
+            self.dropped += 1
+            self._disconnect(conn, 1013)
+
+    def _disconnect(self, conn: _Conn, code: int):
+        if conn.closed:
+            return
+        conn.closed = True
+        conn.writer.cancel()
+        asyncio.create_task(self._close(conn, code))
+
+    @staticmethod
+    async def _close(conn: _Conn, code: int):
+        try:
+            await conn.ws.close(code)
+        except Exception:
+            pass
+
+    async def _writer(self, conn: _Conn):
+        try:
+            while True:
+                event = await conn.queue.get()
+                await conn.ws.send_text(event)
+                self.delivered += 1
+        except Exception:
+            # сокет закрыт - цикл чтения в serve() тоже завершится
+            conn.closed = True
+
+    async def _flush_loop(self):
+        while True:
+            await self._wake.wait()
+            if len(self._pending) < CHAT_FLUSH_BATCH and not self._stopping:
+                await asyncio.sleep(CHAT_FLUSH_INTERVAL_S)  # копим пачку
+            self._wake.clear()
+            ok = await self.flush()
+            if self._stopping:
+                return
+            if not ok:
+                await asyncio.sleep(1.0)
+                self._wake.set()
+
+    async def flush(self) -> bool:
+        """Записать накопленные сообщения пачками по CHAT_FLUSH_BATCH. -> False, если запись не удалась."""
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:CHAT_FLUSH_BATCH]
+                del self._pending[:len(batch)]
+
+                async def _op(db):
+                    await db.executemany(
+                        "INSERT OR IGNORE INTO messages (id, user_lo, user_hi, sender_id, body, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", batch)
+                try:
+                    await get_pool().write(_op)
+                except Exception:
+                    logging.exception("chat: flush of %d messages failed", len(batch))
+                    self._pending[:0] = batch
+                    self.flush_errors += 1
+                    return False
+                self.flushed += len(batch)
+                self.flush_batches += 1
+                self.flush_max_batch = max(self.flush_max_batch, len(batch))
+        return True
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "users": len(self._conns),
+            "messages": self.messages,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "pending": len(self._pending),
+            "flushed": self.flushed,
+            "flush_batches": self.flush_batches,
+            "avg_batch": round(self.flushed / self.flush_batches, 1) if self.flush_batches else 0.0,
+            "max_batch": self.flush_max_batch,
+            "flush_errors": self.flush_errors,
+        }
+
+
+def _error(client_id, error: str) -> str:
+    return json.dumps({"type": "error", "client_id": client_id, "error": error}, ensure_ascii=False)
+
+
+chat_hub = ChatHub()
@@ -3,6 +3,105 @@
 import os
 
 DB_PATH = os.getenv("DB_PATH", "db.sqlite3")
-# BOT_TOKEN = os.getenv("BOT_TOKEN", "8430676291:AAFr9yilHXr2Fel35y297btCjln6N6cR7l8")
-BOT_TOKEN='8430676291:AAFr9yilHXr2Fel35y297btCjln6N6cR7l8'
+BOT_TOKEN = os.getenv("BOT_TOKEN", "8430676291:AAFr9yilHXr2Fel35y297btCjln6N6cR7l8")
 SERVER_BASE_URL = os.getenv("SERVER_BASE_URL", "")
+
+# пул соединений SQLite (app/db.py)
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# очередь записи с group commit (app/db.py)
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+DB_WRITE_MAX_DELAY_MS = float(os.getenv("DB_WRITE_MAX_DELAY_MS", "2"))
+DB_WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "2000"))
+
+# in-memory сетка живых сессий для /nearby (app/geo.py)
+GEO_GRID_ENABLED = os.getenv("GEO_GRID_ENABLED", "1") == "1"
+GEO_GRID_PRECISION = int(os.getenv("GEO_GRID_PRECISION", "5"))
+# больше ячеек в прямоугольнике поиска (большой радиус, высокие широты) - запрос идёт в R*Tree
+GEO_GRID_MAX_CELLS = int(os.getenv("GEO_GRID_MAX_CELLS", "2048"))
+
+# in-memory инвертированный индекс тегов для /api/users/similar (app/tag_index.py)
+TAG_INDEX_ENABLED = os.getenv("TAG_INDEX_ENABLED", "1") == "1"
+
+# /nearby?k=... - поиск k ближайших с расширением радиуса
+NEARBY_KNN_MAX_K = int(os.getenv("NEARBY_KNN_MAX_K", "100"))
+NEARBY_KNN_START_KM = float(os.getenv("NEARBY_KNN_START_KM", "1"))
+NEARBY_KNN_MAX_KM = float(os.getenv("NEARBY_KNN_MAX_KM", "50"))
+NEARBY_KNN_MAX_RINGS = int(os.getenv("NEARBY_KNN_MAX_RINGS", "8"))
+NEARBY_KNN_MAX_CANDIDATES = int(os.getenv("NEARBY_KNN_MAX_CANDIDATES", "5000"))
+
+# POST /heartbeat: сдвиг меньше порога - только продление expires_at,
+# а если продлевали недавно (slack) - вообще без записи
+HEARTBEAT_MIN_MOVE_M = float(os.getenv("HEARTBEAT_MIN_MOVE_M", "25"))
+HEARTBEAT_EXTEND_SLACK_S = int(os.getenv("HEARTBEAT_EXTEND_SLACK_S", "120"))
+
+# ретеншн eat_sessions (app/retention.py)
+SESSION_RETENTION_HOURS = float(os.getenv("SESSION_RETENTION_HOURS", str(24 * 7)))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_INTERVAL_S = float(os.getenv("RETENTION_INTERVAL_S", "300"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+# прочитанные уведомления старше N дней удаляются тем же проходом ретеншна (0 - не удалять)
+NOTIF_RETENTION_DAYS = float(os.getenv("NOTIF_RETENTION_DAYS", "30"))
+
+# страховочный sweep истёкших сессий (основное гашение - по куче дедлайнов)
+SESSION_SWEEP_INTERVAL_S = float(os.getenv("SESSION_SWEEP_INTERVAL_S", "600"))
+
+# планировщик scheduled_jobs (app/jobs.py)
+JOBS_BATCH = int(os.getenv("JOBS_BATCH", "50"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "5"))
+JOBS_RETRY_BASE_S = float(os.getenv("JOBS_RETRY_BASE_S", "30"))
+JOBS_MAX_SLEEP_S = float(os.getenv("JOBS_MAX_SLEEP_S", "300"))
+# опрос "сходили ли вы" через столько секунд после accept; pending-инвайт протухает через N часов
+INVITE_SURVEY_DELAY_S = int(os.getenv("INVITE_SURVEY_DELAY_S", "3600"))
+INVITE_PENDING_TTL_HOURS = float(os.getenv("INVITE_PENDING_TTL_HOURS", "24"))
+# /api/invites/wait: максимальное время удержания long-poll запроса
+INVITE_WAIT_MAX_S = float(os.getenv("INVITE_WAIT_MAX_S", "30"))
+
+# outbox исходящих сообщений Telegram (app/outbox.py); лимиты Bot API: ~30 msg/s на бота, ~1 msg/s в чат
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "100"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_PER_CHAT_INTERVAL_S = float(os.getenv("OUTBOX_PER_CHAT_INTERVAL_S", "1.0"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_RETRY_BASE_S = float(os.getenv("OUTBOX_RETRY_BASE_S", "5"))
+OUTBOX_SEND_TIMEOUT_S = float(os.getenv("OUTBOX_SEND_TIMEOUT_S", "15"))
+OUTBOX_MAX_SLEEP_S = float(os.getenv("OUTBOX_MAX_SLEEP_S", "60"))
+OUTBOX_DRAIN_TIMEOUT_S = float(os.getenv("OUTBOX_DRAIN_TIMEOUT_S", "10"))
+
+# HTTP-клиент Bot API (app/telegram_utils.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+# офлайн-бенчмарки: весь Bot API на bench/fake_telegram.py и фиктивный токен,
+# чтобы настоящий никогда не уходил на стенд: TELEGRAM_FAKE_API=http://127.0.0.1:8081
+TELEGRAM_FAKE_API = os.getenv("TELEGRAM_FAKE_API", "")
+if TELEGRAM_FAKE_API:
+    TELEGRAM_API_BASE = TELEGRAM_FAKE_API
+    BOT_TOKEN = os.getenv("FAKE_BOT_TOKEN", "100000:fake-token")
+TELEGRAM_POOL_LIMIT = int(os.getenv("TELEGRAM_POOL_LIMIT", "50"))
+TELEGRAM_DNS_TTL_S = int(os.getenv("TELEGRAM_DNS_TTL_S", "300"))
+TELEGRAM_TIMEOUT_S = float(os.getenv("TELEGRAM_TIMEOUT_S", "15"))
+TELEGRAM_BREAKER_FAILURES = int(os.getenv("TELEGRAM_BREAKER_FAILURES", "5"))
+TELEGRAM_BREAKER_COOLDOWN_S = float(os.getenv("TELEGRAM_BREAKER_COOLDOWN_S", "30"))
+
+# обработка /telegram/webhook (app/webhook.py)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "500"))
+WEBHOOK_RESCAN_S = float(os.getenv("WEBHOOK_RESCAN_S", "30"))
+WEBHOOK_STOP_TIMEOUT_S = float(os.getenv("WEBHOOK_STOP_TIMEOUT_S", "10"))
+WEBHOOK_KEEP_HOURS = float(os.getenv("WEBHOOK_KEEP_HOURS", "48"))  # дедупликация повторных доставок
+
+# /api/notifications/stream (SSE, app/notifications.py)
+NOTIF_SSE_HEARTBEAT_S = float(os.getenv("NOTIF_SSE_HEARTBEAT_S", "15"))
+NOTIF_SSE_BUFFER = int(os.getenv("NOTIF_SSE_BUFFER", "100"))      # live-событий в очереди соединения
+NOTIF_SSE_BACKLOG = int(os.getenv("NOTIF_SSE_BACKLOG", "100"))    # сколько дочитывать из БД при подключении
+NOTIF_SSE_RETRY_MS = int(os.getenv("NOTIF_SSE_RETRY_MS", "3000"))
+
+# чат /ws/chat (app/chat.py)
+CHAT_SEND_QUEUE = int(os.getenv("CHAT_SEND_QUEUE", "256"))           # исходящих событий на соединение, дальше - разрыв
+CHAT_FLUSH_INTERVAL_S = float(os.getenv("CHAT_FLUSH_INTERVAL_S", "0.05"))  # сколько копить пачку для messages
+CHAT_FLUSH_BATCH = int(os.getenv("CHAT_FLUSH_BATCH", "500"))
+CHAT_PENDING_MAX = int(os.getenv("CHAT_PENDING_MAX", "10000"))       # незаписанных сообщений, дальше send отклоняется
+CHAT_MAX_TEXT = int(os.getenv("CHAT_MAX_TEXT", "2000"))
+CHAT_AUTH_TIMEOUT_S = float(os.getenv("CHAT_AUTH_TIMEOUT_S", "10"))  # сколько ждать первое сообщение {"type": "auth"}
@@ -0,0 +1,342 @@
+# app/db.py
+
+import time
+import asyncio
+import logging
+import aiosqlite
+from contextlib import asynccontextmanager
+
+from app.config import (DB_PATH, DB_POOL_READERS, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE,
+                        DB_WRITE_BATCH, DB_WRITE_MAX_DELAY_MS, DB_WRITE_QUEUE_SIZE)
+
+
+# PRAGMA применяются один раз при открытии соединения, а не на каждый запрос
+def _connection_pragmas(read_only: bool):
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)};",
+        "PRAGMA synchronous = NORMAL;",
+        "PRAGMA temp_store = MEMORY;",
+        f"PRAGMA cache_size = -{int(DB_CACHE_SIZE_KB)};",  # отрицательное значение - в KiB
+        f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)};",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = 1;")
+    return pragmas
+
+
+class _PoolStats:
+    """Счётчики ожидания для одной группы соединений (readers / writer)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.saturated = 0      # сколько раз свободных соединений не было и пришлось ждать
+        self.wait_total = 0.0   # секунды
+        self.wait_max = 0.0
+
+    def as_dict(self):
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "saturated": self.saturated,
+            "wait_total_ms": round(self.wait_total * 1000, 3),
+            "wait_avg_ms": round(self.wait_total * 1000 / self.acquired, 3) if self.acquired else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+
+class _WriteStats:
+    """Счётчики очереди записи и group commit."""
+
+    def __init__(self):
+        self.submitted = 0
+        self.saturated = 0      # сколько раз запись встала в очередь за другими
+        self.ops = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_max = 0
+        self.commit_total = 0.0  # секунды
+        self.latency_total = 0.0  # от постановки в очередь до результата
+        self.latency_max = 0.0
+
+    def as_dict(self, queue_depth: int, queue_size: int):
+        return {
+            "queue_depth": queue_depth,
+            "queue_size": queue_size,
+            "submitted": self.submitted,
+            "saturated": self.saturated,
+            "ops": self.ops,
+            "errors": self.errors,
+            "batches": self.batches,
+            "batch_avg": round(self.ops / self.batches, 2) if self.batches else 0.0,
+            "batch_max": self.batch_max,
+            "commit_avg_ms": round(self.commit_total * 1000 / self.batches, 3) if self.batches else 0.0,
+            "latency_avg_ms": round(self.latency_total * 1000 / self.ops, 3) if self.ops else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 3),
+        }
+
+
+class DBPool:
+    """Пул aiosqlite-соединений: N соединений только на чтение и одно на запись.
+
+    SQLite в WAL допускает параллельное чтение, но только одного писателя,
+    поэтому writer-соединением владеет отдельный таск: записи приходят через
+    очередь (pool.write(op)) и коммитятся пачками - один fsync на пачку.
+    """
+
+    def __init__(self, path: str = DB_PATH, readers: int = DB_POOL_READERS,
+                 write_batch: int = DB_WRITE_BATCH, write_max_delay_ms: float = DB_WRITE_MAX_DELAY_MS,
+                 write_queue_size: int = DB_WRITE_QUEUE_SIZE):
+        self.path = path
+        self.readers_count = max(1, int(readers))
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all_readers = []
+        self._writer = None
+        self._write_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, int(write_queue_size)))
+        self._writer_task = None
+        self._carry = None  # exclusive-op, прервавшая сбор пачки
+        self._write_batch = max(1, int(write_batch))
+        self._write_max_delay = max(0.0, float(write_max_delay_ms)) / 1000.0
+        self.read_stats = _PoolStats(self.readers_count)
+        self.write_stats = _WriteStats()
+
+    async def _connect(self, read_only: bool):
+        db = await aiosqlite.connect(self.path)
+        db.row_factory = aiosqlite.Row
+        for p in _connection_pragmas(read_only):
+            await db.execute(p)
+        return db
+
+    async def open(self):
+        self._writer = await self._connect(read_only=False)
+        await self._writer.execute("PRAGMA journal_mode=WAL;")
+        for _ in range(self.readers_count):
+            db = await self._connect(read_only=True)
+            self._all_readers.append(db)
+            self._readers.put_nowait(db)
+        self._writer_task = asyncio.create_task(self._writer_loop(), name="db-writer")
+
+    async def close(self):
+        # сначала дописываем всё, что уже стоит в очереди, затем останавливаем writer
+        if self._writer_task is not None:
+            await self._write_queue.put(None)
+            try:
+                await self._writer_task
+            except Exception:
+                logging.exception("DBPool: writer task failed")
+            self._writer_task = None
+        for db in self._all_readers:
+            try:
+                await db.close()
+            except Exception:
+                logging.exception("DBPool: failed to close reader")
+        self._all_readers = []
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            try:
+                await self._writer.close()
+            except Exception:
+                logging.exception("DBPool: failed to close writer")
+            self._writer = None
+
+    @staticmethod
+    async def _reset(db):
+        # соединение возвращается в пул без незавершённой транзакции
+        if db.in_transaction:
+            try:
+                await db.rollback()
+            except Exception:
+                logging.exception("DBPool: rollback on release failed")
+
+    @asynccontextmanager
+    async def reader(self):
+        st = self.read_stats
+        if self._readers.empty():
+            st.saturated += 1
+        st.waiting += 1
+        t0 = time.perf_counter()
+        try:
+            db = await self._readers.get()
+        finally:
+            st.waiting -= 1
+        wait = time.perf_counter() - t0
+        st.acquired += 1
+        st.wait_total += wait
+        st.wait_max = max(st.wait_max, wait)
+        st.in_use += 1
+        try:
+            yield db
+        finally:
+            st.in_use -= 1
+            await self._reset(db)
+            self._readers.put_nowait(db)
+
+    async def write(self, op, exclusive: bool = False):
+        """Выполнить op(db) на writer-соединении и вернуть её результат.
+
+        op - корутинная функция, которая НЕ вызывает commit/rollback: каждая op
+        выполняется в своём SAVEPOINT, исключение откатывает только её и
+        пробрасывается вызывающему. Результат приходит после коммита пачки.
+
+        exclusive=True - op выполняется одна, вне транзакции (для VACUUM,
+        executescript и т.п.); если она что-то открыла - коммитим после неё.
+        """
+        if self._writer_task is None:
+            raise RuntimeError("DB writer is not running")
+        st = self.write_stats
+        st.submitted += 1
+        if not self._write_queue.empty():
+            st.saturated += 1
+        fut = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((op, fut, time.perf_counter(), exclusive))
+        return await fut
+
+    async def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self._write_max_delay
+        while len(batch) < self._write_batch:
+            try:
+                item = self._write_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                # одиночную запись не задерживаем: ждём "соседей" только если
+                # параллельные записи уже идут (как commit_siblings в Postgres)
+                timeout = deadline - time.perf_counter()
+                if len(batch) < 2 or timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is not None and item[3]:
+                # exclusive op не смешиваем с пачкой - выполнится следующей
+                self._carry = item
+                break
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    async def _run_batch(self, batch):
+        db = self._writer
+        st = self.write_stats
+        results = []
+        await db.execute("BEGIN")
+        for op, fut, _, _ in batch:
+            if fut.cancelled():
+                results.append(None)
+                continue
+            await db.execute("SAVEPOINT write_op")
+            try:
+                res = await op(db)
+            except Exception as e:
+                await db.execute("ROLLBACK TO SAVEPOINT write_op")
+                await db.execute("RELEASE SAVEPOINT write_op")
+                results.append((False, e))
+            else:
+                await db.execute("RELEASE SAVEPOINT write_op")
+                results.append((True, res))
+        t0 = time.perf_counter()
+        await db.commit()
+        st.commit_total += time.perf_counter() - t0
+        return results
+
+    async def _run_exclusive(self, item):
+        op, fut, _, _ = item
+        if fut.cancelled():
+            return None
+        db = self._writer
+        try:
+            res = await op(db)
+            if db.in_transaction:
+                await db.commit()
+        except Exception as e:
+            await self._reset(db)
+            return (False, e)
+        return (True, res)
+
+    async def _writer_loop(self):
+        stopping = False
+        while not stopping:
+            if self._carry is not None:
+                first, self._carry = self._carry, None
+            else:
+                first = await self._write_queue.get()
+            if first is None:
+                break
+            if first[3]:
+                self._finish([first], [await self._run_exclusive(first)])
+                continue
+            batch = await self._collect_batch(first)
+            if batch[-1] is None:
+                batch.pop()
+                stopping = True
+            try:
+                results = await self._run_batch(batch)
+            except Exception as e:
+                logging.exception("DBPool: write batch of %d failed", len(batch))
+                await self._reset(self._writer)
+                results = [(False, e)] * len(batch)
+            self._finish(batch, results)
+
+    def _finish(self, batch, results):
+        st = self.write_stats
+        now = time.perf_counter()
+        st.batches += 1
+        st.batch_max = max(st.batch_max, len(batch))
+        for (_, fut, t_enq, _), res in zip(batch, results):
+            st.ops += 1
+            lat = now - t_enq
+            st.latency_total += lat
+            st.latency_max = max(st.latency_max, lat)
+            if res is None or fut.done():
+                continue
+            ok, value = res
+            if ok:
+                fut.set_result(value)
+            else:
+                st.errors += 1
+                fut.set_exception(value)
+
+    def stats(self):
+        return {
+            "read": self.read_stats.as_dict(),
+            "write": self.write_stats.as_dict(self._write_queue.qsize(), self._write_queue.maxsize),
+        }
+
+
+_pool: DBPool = None
+
+
+async def init_pool(path: str = DB_PATH, readers: int = DB_POOL_READERS) -> DBPool:
+    global _pool
+    pool = DBPool(path, readers)
+    await pool.open()
+    _pool = pool
+    return pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> DBPool:
+    if _pool is None:
+        raise RuntimeError("DB pool is not initialized (lifespan not started)")
+    return _pool
+
+
+# FastAPI dependencies
+def db_pool() -> DBPool:
+    return get_pool()
+
+
+async def read_db():
+    async with get_pool().reader() as db:
+        yield db
@@ -0,0 +1,420 @@
+# app/geo.py
+
+import sys
+import json
+import math
+import heapq
+import base64
+import logging
+
+from app.config import GEO_GRID_PRECISION
+from utils import haversine_many
+
+# In-memory сетка живых сессий для /nearby.
+# Ключ ячейки - geohash заданной точности; при precision=5 ячейка ~4.9 x 4.9 км,
+# так что радиус 3 км покрывают 4-9 ячеек. SQLite остаётся источником правды:
+# сетка прогревается из БД при старте и обновляется после коммита /start, /stop и истечения.
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lon: float, precision: int = 5) -> str:
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    out = []
+    bit = 0
+    ch = 0
+    even = True  # первый бит - долгота
+    while len(out) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid:
+                ch = (ch << 1) | 1
+                lon_lo = mid
+            else:
+                ch <<= 1
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch = (ch << 1) | 1
+                lat_lo = mid
+            else:
+                ch <<= 1
+                lat_hi = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            out.append(_BASE32[ch])
+            bit = 0
+            ch = 0
+    return "".join(out)
+
+
+def geohash_cell_size(precision: int):
+    """(высота, ширина) ячейки в градусах."""
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def _clamp_lat(lat: float) -> float:
+    return min(90.0, max(-90.0, lat))
+
+
+def _wrap_lon(lon: float) -> float:
+    return ((lon + 180.0) % 360.0) - 180.0
+
+
+def _clamp_box(min_lat: float, max_lat: float, min_lon: float, max_lon: float):
+    # у полюса bbox по долготе может быть шире земного шара - хватает одного оборота
+    if max_lon - min_lon >= 360.0:
+        min_lon, max_lon = -180.0, 180.0
+    return _clamp_lat(min_lat), _clamp_lat(max_lat), min_lon, max_lon
+
+
+def covering_cells_count(min_lat: float, max_lat: float, min_lon: float, max_lon: float, precision: int = 5) -> int:
+    """Сколько ячеек вернёт covering_cells (оценка без перебора)."""
+    dlat, dlon = geohash_cell_size(precision)
+    min_lat, max_lat, min_lon, max_lon = _clamp_box(min_lat, max_lat, min_lon, max_lon)
+    top = round(180.0 / dlat) - 1   # lat = 90 попадает в последний ряд
+    rows = min(math.floor((max_lat + 90.0) / dlat), top) - min(math.floor((min_lat + 90.0) / dlat), top) + 1
+    cols = math.floor((max_lon + 180.0) / dlon) - math.floor((min_lon + 180.0) / dlon) + 1
+    return rows * min(cols, round(360.0 / dlon))
+
+
+def _cover_points(min_lat: float, max_lat: float, min_lon: float, max_lon: float, dlat: float, dlon: float):
+    """По точке в каждой ячейке прямоугольника (долгота не нормализована)."""
+    lat = min_lat
+    while True:
+        lon = min_lon
+        while True:
+            yield lat, lon
+            if lon >= max_lon:
+                break
+            lon = min(lon + dlon, max_lon)
+        if lat >= max_lat:
+            break
+        lat = min(lat + dlat, max_lat)
+
+
+def covering_cells(min_lat: float, max_lat: float, min_lon: float, max_lon: float, precision: int = 5):
+    """Множество geohash-ячеек, которые пересекают прямоугольник."""
+    dlat, dlon = geohash_cell_size(precision)
+    min_lat, max_lat, min_lon, max_lon = _clamp_box(min_lat, max_lat, min_lon, max_lon)
+    return {geohash_encode(la, _wrap_lon(lo), precision)
+            for la, lo in _cover_points(min_lat, max_lat, min_lon, max_lon, dlat, dlon)}
+
+
+def covering_cells_nearest(lat: float, lon: float, min_lat: float, max_lat: float, min_lon: float, max_lon: float,
+                           precision: int = 5, max_km: float = None):
+    """[(km, cell)] ячеек прямоугольника, ближайшие к точке первыми; ячейки дальше max_km не нужны.
+
+    km - нижняя оценка расстояния от точки до ячейки: всё внутри ячейки не ближе km.
+    """
+    dlat, dlon = geohash_cell_size(precision)
+    min_lat, max_lat, min_lon, max_lon = _clamp_box(min_lat, max_lat, min_lon, max_lon)
+    top = round(180.0 / dlat) - 1
+    best = {}
+    for la, lo in _cover_points(min_lat, max_lat, min_lon, max_lon, dlat, dlon):
+        lat_lo = min(math.floor((la + 90.0) / dlat), top) * dlat - 90.0
+        lon_lo = math.floor((lo + 180.0) / dlon) * dlon - 180.0
+        dy = max(0.0, lat_lo - lat, lat - (lat_lo + dlat))
+        dx = max(0.0, lon_lo - lon, lon - (lon_lo + dlon))
+        # градус долготы короче всего на ближнем к полюсу краю - берём его, чтобы оценка была снизу;
+        # 111.0 км на градус чуть меньше, чем у haversine (R = 6371)
+        k = min(math.cos(math.radians(lat)), math.cos(math.radians(max(abs(lat_lo), abs(lat_lo + dlat)))))
+        km = 111.0 * math.hypot(dy, dx * k)
+        if max_km is not None and km > max_km:
+            continue
+        cell = geohash_encode(la, _wrap_lon(lo), precision)
+        if km < best.get(cell, math.inf):
+            best[cell] = km
+    return sorted((km, cell) for cell, km in best.items())
+
+
+class LiveSession:
+    """Активная сессия + поля пользователя, нужные ответу /nearby."""
+
+    __slots__ = ("sid", "user_id", "tg_id", "lat", "lon", "started_at", "expires_at",
+                 "name", "username", "avatar", "age", "cell")
+
+    def __init__(self, sid, user_id, tg_id, lat, lon, started_at, expires_at,
+                 name=None, username=None, avatar=None, age=None):
+        self.sid = sid
+        self.user_id = user_id
+        self.tg_id = tg_id
+        self.lat = lat
+        self.lon = lon
+        self.started_at = started_at
+        self.expires_at = expires_at
+        self.name = name
+        self.username = username
+        self.avatar = avatar
+        self.age = age
+        self.cell = None
+
+    @classmethod
+    def from_row(cls, r):
+        return cls(r["sid"], r["user_id"], r["tg_id"], r["lat"], r["lon"], r["started_at"], r["expires_at"],
+                   r["name"], r["username"], r["avatar"], r["age"])
+
+    def key(self):
+        return (self.sid, self.user_id, self.tg_id, self.lat, self.lon, self.expires_at)
+
+    def nbytes(self):
+        n = sys.getsizeof(self)
+        for f in ("started_at", "expires_at", "name", "username", "avatar"):
+            v = getattr(self, f)
+            if v is not None:
+                n += sys.getsizeof(v)
+        return n
+
+
+class SessionGrid:
+    """Сетка geohash-ячеек -> {sid: LiveSession}; у пользователя не больше одной сессии.
+
+    Все методы синхронные и вызываются из event loop, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, precision: int = 5):
+        self.precision = precision
+        self.ready = False
+        self._cells = {}      # cell -> {sid: LiveSession}
+        self._by_sid = {}     # sid -> LiveSession
+        self._by_user = {}    # user_id -> sid
+        self._by_tg = {}      # tg_id -> user_id
+        self.queries = 0
+        self.cells_probed = 0
+        self.candidates = 0
+        self.truncated = 0    # запросы, упёршиеся в max_candidates
+
+    def __len__(self):
+        return len(self._by_sid)
+
+    def clear(self):
+        self._cells.clear()
+        self._by_sid.clear()
+        self._by_user.clear()
+        self._by_tg.clear()
+
+    def load(self, sessions):
+        self.clear()
+        for s in sessions:
+            self.put(s)
+        self.ready = True
+
+    def put(self, s: LiveSession):
+        """Добавить/заменить сессию пользователя. Более старая сессия (меньший sid)
+        не вытесняет более новую - на случай переупорядочивания после коммита."""
+        old_sid = self._by_user.get(s.user_id)
+        if old_sid is not None:
+            if old_sid > s.sid:
+                return
+            self._drop(old_sid)
+        s.cell = geohash_encode(s.lat, s.lon, self.precision)
+        self._cells.setdefault(s.cell, {})[s.sid] = s
+        self._by_sid[s.sid] = s
+        self._by_user[s.user_id] = s.sid
+        self._by_tg[s.tg_id] = s.user_id
+
+    def _drop(self, sid: int):
+        s = self._by_sid.pop(sid, None)
+        if s is None:
+            return
+        cell = self._cells.get(s.cell)
+        if cell is not None:
+            cell.pop(sid, None)
+            if not cell:
+                del self._cells[s.cell]
+        if self._by_user.get(s.user_id) == sid:
+            del self._by_user[s.user_id]
+            self._by_tg.pop(s.tg_id, None)
+
+    def remove_sids(self, sids):
+        for sid in sids:
+            self._drop(sid)
+
+    def get_by_tg(self, tg_id: int):
+        user_id = self._by_tg.get(tg_id)
+        sid = self._by_user.get(user_id) if user_id is not None else None
+        return self._by_sid.get(sid) if sid is not None else None
+
+    def update_user(self, tg_id: int, name=None, username=None, avatar=None, age=None):
+        """Обновить закэшированный профиль, если у пользователя есть живая сессия."""
+        s = self.get_by_tg(tg_id)
+        if s is None:
+            return
+        s.name, s.username, s.avatar, s.age = name, username, avatar, age
+
+    def query(self, lat: float, lon: float, radius_km: float, min_lat: float, max_lat: float,
+              min_lon: float, max_lon: float, now_s: str, exclude_tg: int = None, limit: int = None,
+              max_candidates: int = None):
+        """-> ([(distance_km, LiveSession)] в радиусе, не больше limit ближайших, по (distance, sid); truncated).
+        Истёкшие, но ещё не выметенные сессии отбрасываются по expires_at.
+
+        Ячейки смотрятся от ближней к дальней: как только limit ближайших найдены ближе следующей
+        ячейки, перебор останавливается. max_candidates ограничивает число просмотренных сессий;
+        упёрлись - truncated=True, и ответ обрезан по ближайшей непросмотренной ячейке (внутри точный).
+        """
+        self.queries += 1
+        if limit is not None and limit <= 0:
+            return [], False
+        cand = []
+        top = []   # max-heap (-distance) limit ближайших из найденных
+        scanned = 0
+        max_km = radius_km
+        truncated = False
+        cells = covering_cells_nearest(lat, lon, min_lat, max_lat, min_lon, max_lon, self.precision, radius_km)
+        for bound, c in cells:
+            if limit is not None and len(top) >= limit and -top[0] < bound:
+                break
+            if max_candidates is not None and scanned >= max_candidates:
+                max_km, truncated = bound, True
+                break
+            self.cells_probed += 1
+            bucket = self._cells.get(c)
+            if not bucket:
+                continue
+            scanned += len(bucket)
+            live = [s for s in bucket.values() if s.tg_id != exclude_tg and s.expires_at > now_s]
+            if not live:
+                continue
+            for s, d in zip(live, haversine_many(lat, lon, [s.lat for s in live], [s.lon for s in live])):
+                d = float(d)
+                if d > radius_km:
+                    continue
+                cand.append((d, s.sid, s))
+                if limit is not None:
+                    if len(top) < limit:
+                        heapq.heappush(top, -d)
+                    elif d < -top[0]:
+                        heapq.heapreplace(top, -d)
+        self.candidates += scanned
+        if truncated:
+            self.truncated += 1
+        # детерминированный порядок при равных расстояниях
+        cand.sort(key=lambda x: (x[0], x[1]))
+        ranked = [(d, s) for d, _, s in cand if d <= max_km]
+        return (ranked[:limit] if limit is not None else ranked), truncated
+
+    def snapshot(self):
+        return {sid: s.key() for sid, s in self._by_sid.items()}
+
+    def stats(self, top: int = 10):
+        sizes = []
+        for cell, bucket in self._cells.items():
+            nbytes = sys.getsizeof(bucket) + sum(s.nbytes() for s in bucket.values())
+            sizes.append((cell, len(bucket), nbytes))
+        counts = [n for _, n, _ in sizes]
+        total_bytes = sum(b for _, _, b in sizes) + sum(
+            sys.getsizeof(d) for d in (self._cells, self._by_sid, self._by_user, self._by_tg))
+        sizes.sort(key=lambda x: x[1], reverse=True)
+        cell_h, cell_w = geohash_cell_size(self.precision)
+        return {
+            "ready": self.ready,
+            "precision": self.precision,
+            "cell_deg": [round(cell_h, 5), round(cell_w, 5)],
+            "sessions": len(self._by_sid),
+            "cells": len(self._cells),
+            "per_cell_avg": round(sum(counts) / len(counts), 2) if counts else 0.0,
+            "per_cell_max": max(counts) if counts else 0,
+            "bytes_total": total_bytes,
+            "bytes_per_session": round(total_bytes / len(self._by_sid), 1) if self._by_sid else 0.0,
+            "queries": self.queries,
+            "cells_per_query": round(self.cells_probed / self.queries, 2) if self.queries else 0.0,
+            "candidates_per_query": round(self.candidates / self.queries, 2) if self.queries else 0.0,
+            "truncated_queries": self.truncated,
+            "top_cells": [{"cell": c, "sessions": n, "bytes": b} for c, n, b in sizes[:top]],
+        }
+
+
+def diff_with_db(grid: SessionGrid, db_rows, now_s: str, sample: int = 20):
+    """Сравнивает сетку с активными сессиями из БД.
+
+    Записи, идущие параллельно с проверкой, могут дать кратковременное расхождение,
+    поэтому истёкшие к now_s сессии не считаются ни с одной стороны.
+    """
+    db_map = {r["sid"]: LiveSession.from_row(r).key() for r in db_rows if r["expires_at"] > now_s}
+    mem_map = {sid: k for sid, k in grid.snapshot().items() if k[5] > now_s}
+    missing = sorted(set(db_map) - set(mem_map))
+    stale = sorted(set(mem_map) - set(db_map))
+    mismatched = sorted(sid for sid in set(db_map) & set(mem_map)
+                        if not _same(db_map[sid], mem_map[sid]))
+    ok = not (missing or stale or mismatched)
+    if not ok:
+        logging.warning("session grid drift: missing=%d stale=%d mismatched=%d",
+                        len(missing), len(stale), len(mismatched))
+    return {
+        "ok": ok,
+        "db": len(db_map),
+        "memory": len(mem_map),
+        "missing": missing[:sample],
+        "stale": stale[:sample],
+        "mismatched": mismatched[:sample],
+    }
+
+
+def _same(a, b):
+    # координаты сравниваем с допуском: в БД REAL, в памяти float из запроса
+    return (a[:3] == b[:3] and a[5] == b[5]
+            and math.isclose(a[3], b[3], abs_tol=1e-9) and math.isclose(a[4], b[4], abs_tol=1e-9))
+
+
+# ----------------------
+# k ближайших с расширением радиуса
+# ----------------------
+
+_CURSOR_SID_MAX = sys.maxsize
+
+
+def encode_cursor(lat: float, lon: float, dist_km: float, sid: int) -> str:
+    """Курсор следующей страницы: точка отсчёта + ключ (distance, sid) последнего отданного."""
+    raw = json.dumps({"o": [lat, lon], "d": dist_km, "s": sid}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """-> (lat, lon, dist_km, sid); ValueError на мусоре."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c = json.loads(raw)
+        return float(c["o"][0]), float(c["o"][1]), float(c["d"]), int(c["s"])
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+async def knn_search(fetch, k: int, after=None, start_km: float = 1.0, max_km: float = 50.0,
+                     max_rings: int = 8):
+    """k ближайших после ключа after=(distance, sid), расширяя радиус вдвое за кольцо.
+
+    fetch(radius_km) -> ([(distance_km, LiveSession)] в радиусе, по (distance, sid); truncated).
+    Всё, что внутри радиуса r, ближе всего, что за ним, поэтому как только внутри r
+    набралось k - это точные k ближайших. Работа ограничена max_km и max_rings, а
+    truncated (fetch упёрся в лимит кандидатов) останавливает расширение: как и LIMIT
+    в R*Tree, поиск видит только столько ближайших сессий.
+
+    Возвращает (items, radius_km, rings, next_after, truncated): next_after=None - дальше искать нечего.
+    """
+    r = min(max(start_km, after[0] if after else 0.0), max_km)
+    rings = 0
+    while True:
+        rings += 1
+        found, truncated = await fetch(r)
+        picked = [(d, s) for d, s in found if after is None or (d, s.sid) > after]
+        if len(picked) >= k or r >= max_km or rings >= max_rings or truncated:
+            break
+        r = min(r * 2, max_km)
+    picked = picked[:k]
+    if len(picked) >= k:
+        next_after = (picked[-1][0], picked[-1][1].sid)
+    elif r < max_km and not truncated:
+        # упёрлись в max_rings: всё внутри r уже отдано, продолжаем за его границей
+        next_after = (r, _CURSOR_SID_MAX)
+    else:
+        next_after = None
+    return picked, r, rings, next_after, truncated
+
+
+session_grid = SessionGrid(GEO_GRID_PRECISION)
@@ -1,19 +1,201 @@
 # app/invites.py
 
-import json
+import asyncio
 import logging
-import aiosqlite
 from zoneinfo import ZoneInfo
 from datetime import datetime, timezone
 
-from routes import DB_PATH
-from app.telegram_utils import send_telegram_message
+from app.config import INVITE_PENDING_TTL_HOURS, INVITE_SURVEY_DELAY_S
+from app.db import get_pool
+from app.jobs import cancel_job, due_in, job_handler, job_scheduler, schedule_job
+from app.notifications import insert_notification, notification_hub
+from app.outbox import enqueue_message, outbox
+
+# pending-инвайты получателя, новые первыми (индекс idx_invites_to_status)
+PENDING_INVITES_SQL = """
+    SELECT i.id, fu.tg_id AS from_tg, fu.name AS from_name, i.time_iso, i.meal_type, i.message, i.status,
+           i.place_id, i.place_name, i.created_at
+    FROM invites i
+    JOIN users fu ON fu.id = i.from_user_id
+    WHERE i.to_user_id = ? AND i.status = 'pending' AND i.id > ?
+    ORDER BY i.created_at DESC
+"""
+
+
+def invite_item(r) -> dict:
+    return {
+        "id": r["id"],
+        "from_tg": r["from_tg"],
+        "from_name": r["from_name"],
+        "time_iso": r["time_iso"],
+        "meal_type": r["meal_type"],
+        "message": r["message"],
+        "status": r["status"],
+        "place_id": r["place_id"],
+        "place_name": r["place_name"],
+        "created_at": r["created_at"]
+    }
+
+
+class InviteWaiters:
+    """Long-poll /api/invites/wait: запросы получателя ждут на общем Event, api_invite будит его после коммита.
+
+    Как и notification_hub, живёт в процессе - рассчитан на один воркер.
+    """
+
+    def __init__(self):
+        self._waiters = {}    # user_id -> [Event, число ожидающих]
+        self._closed = False
+        self.waiting = 0
+        self.wakeups = 0
+        self.timeouts = 0
+
+    def start(self):
+        self._closed = False
+
+    def close(self):
+        """Shutdown: отпустить все висящие запросы."""
+        self._closed = True
+        for ev, _ in self._waiters.values():
+            ev.set()
+
+    def subscribe(self, user_id: int) -> asyncio.Event:
+        """Встать в ожидание до чтения БД, чтобы не пропустить wake между SELECT и wait."""
+        entry = self._waiters.get(user_id)
+        if entry is None:
+            entry = self._waiters[user_id] = [asyncio.Event(), 0]
+        if self._closed:
+            entry[0].set()
+        entry[1] += 1
+        self.waiting += 1
+        return entry[0]
+
+    def unsubscribe(self, user_id: int, ev: asyncio.Event):
+        self.waiting -= 1
+        entry = self._waiters.get(user_id)
+        if entry is not None and entry[0] is ev:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._waiters[user_id]
+
+    async def wait(self, ev: asyncio.Event, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(ev.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+
+    def wake(self, user_id: int):
+        """Новый инвайт для user_id закоммичен."""
+        entry = self._waiters.pop(user_id, None)
+        if entry is not None:
+            entry[0].set()
+            self.wakeups += 1
+
+    def stats(self):
+        return {"waiting": self.waiting, "users": len(self._waiters), "wakeups": self.wakeups, "timeouts": self.timeouts}
+
+
+invite_waiters = InviteWaiters()
+
+
+async def backfill_invite_jobs(db):
+    """Задачи для инвайтов, созданных до scheduled_jobs (или потерянных): опрос и протухание."""
+    await db.execute("""
+        INSERT OR IGNORE INTO scheduled_jobs (kind, ref_id, due_at)
+        SELECT 'invite_survey', id,
+               datetime(replace(replace(responded_at,'T',' '),'Z',''), ?)
+        FROM invites
+        WHERE status = 'accepted' AND IFNULL(survey_sent,0) = 0 AND responded_at IS NOT NULL
+    """, (f"+{int(INVITE_SURVEY_DELAY_S)} seconds",))
+    await db.execute("""
+        INSERT OR IGNORE INTO scheduled_jobs (kind, ref_id, due_at)
+        SELECT 'invite_expire', id, datetime(created_at, ?)
+        FROM invites
+        WHERE status = 'pending' AND created_at IS NOT NULL
+    """, (f"+{int(INVITE_PENDING_TTL_HOURS * 3600)} seconds",))
+
+
+@job_handler("invite_expire")
+async def expire_pending_invite(invite_id: int, payload: dict = None):
+    """Задача scheduled_jobs: pending-инвайт без ответа INVITE_PENDING_TTL_HOURS -> expired."""
+    async def _expire(db):
+        await db.execute(
+            "UPDATE invites SET status = 'expired', updated_at = datetime('now') WHERE id = ? AND status = 'pending'",
+            (invite_id,))
+    await get_pool().write(_expire)
+
+
+@job_handler("invite_survey")
+async def send_invite_survey(invite_id: int, payload: dict = None):
+    """Задача scheduled_jobs через INVITE_SURVEY_DELAY_S после accept: создает notifications и ставит telegram в outbox."""
+    async with get_pool().reader() as db:
+        cur = await db.execute("""
+            SELECT i.id, i.from_user_id, i.to_user_id, i.place_name, i.responded_at, i.meal_type,
+                fu.tg_id AS from_tg, tu.tg_id AS to_tg, fu.name AS from_name, tu.name AS to_name
+            FROM invites i
+            JOIN users fu ON fu.id = i.from_user_id
+            JOIN users tu ON tu.id = i.to_user_id
+            WHERE i.id = ? AND i.status = 'accepted' AND IFNULL(i.survey_sent,0) = 0
+        """, (invite_id,))
+        row = await cur.fetchone()
+    if not row:
+        return
+    r = dict(row)  # безопасный словарь
+
+    # payload для уведомления в мини-аппе
+    payload_from = {
+        "invite_id": invite_id,
+        "place_name": r.get("place_name"),
+        "partner_name": r.get("to_name"),
+        "partner_tg": r.get("to_tg"),
+        "role": "initiator"
+    }
+    payload_to = {
+        "invite_id": invite_id,
+        "place_name": r.get("place_name"),
+        "partner_name": r.get("from_name"),
+        "partner_tg": r.get("from_tg"),
+        "role": "responder"
+    }
+
+    # формируем дружелюбные тексты с запасными значениями
+    place = r.get("place_name") or ""
+    place_text = f' в "{place}"' if place else ""
+    meal_type = (r.get("meal_type") or "встречу").strip()
+    from_display = r.get("from_name") or (("@%s" % r.get("from_tg")) if r.get("from_tg") else "пользователь")
+    to_display = r.get("to_name") or (("@%s" % r.get("to_tg")) if r.get("to_tg") else "пользователь")
+
+    text_for_from = f'Сходили ли вы с "{to_display}" на {meal_type}{place_text}?Зайдите в мини-апп и ответься пожалуйста))'
+    text_for_to   = f'Сходили ли вы с "{from_display}" на {meal_type}{place_text}?\nЗайдите в мини-апп и ответься пожалуйста))'
+
+    # пометка survey_sent (race-safe), notifications и outbox - одной транзакцией:
+    # при ошибке задача уйдёт на повтор целиком
+    async def _mark_and_notify(db):
+        cur_mark = await db.execute("UPDATE invites SET survey_sent = 1 WHERE id = ? AND IFNULL(survey_sent,0) = 0", (invite_id,))
+        if cur_mark.rowcount == 0:
+            return False
+        items = [
+            await insert_notification(db, r.get("from_user_id"), "survey", payload_from),
+            await insert_notification(db, r.get("to_user_id"), "survey", payload_to),
+        ]
+        # telegram - через outbox, в той же транзакции
+        if r.get("from_tg"):
+            await enqueue_message(db, r.get("from_tg"), text_for_from)
+        if r.get("to_tg"):
+            await enqueue_message(db, r.get("to_tg"), text_for_to)
+        return items
+    items = await get_pool().write(_mark_and_notify)
+    if items:
+        outbox.wake()
+        notification_hub.publish(items)
+
 
 async def handle_invite_response(invite_id: int, responder_tg: int, action: str):
     if action not in ("accept", "decline"):
         raise ValueError("invalid action")
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async def _respond(db):
         cur = await db.execute(
             "SELECT i.id, i.status, i.from_user_id, i.to_user_id, i.place_name, i.time_iso, i.meal_type, fu.tg_id AS from_tg, tu.tg_id AS to_tg, fu.name AS from_name "
             "FROM invites i JOIN users fu ON fu.id = i.from_user_id JOIN users tu ON tu.id = i.to_user_id WHERE i.id = ?",
@@ -54,87 +236,102 @@ async def handle_invite_response(invite_id: int, responder_tg: int, action: str)
         await db.execute(
             "UPDATE invites SET status = ?, responder_user_id = ?, responded_at = datetime('now'), updated_at = datetime('now') WHERE id = ?",
             (new_status, responder_user_id, invite_id))
-        await db.commit()
+        # ответ получен - протухание не нужно; на accept ставим опрос через INVITE_SURVEY_DELAY_S
+        await cancel_job(db, "invite_expire", invite_id)
+        survey_due = None
+        if new_status == "accepted":
+            survey_due = await schedule_job(db, "invite_survey", invite_id, due_in(INVITE_SURVEY_DELAY_S))
+        return {"ok": True, "survey_due": survey_due, "inv": dict(inv), "new_status": new_status,
+                "responder_name": responder_name, "responder_username": responder_username}
+
+    res = await get_pool().write(_respond)
+    if not res.get("ok"):
+        return res
+    if res["survey_due"]:
+        job_scheduler.wake(res["survey_due"])
+    inv = res["inv"]
+    new_status = res["new_status"]
+    responder_name = res["responder_name"]
+    responder_username = res["responder_username"]
 
-        # --- подготовка читаемого времени (Asia/Almaty) ---
-        time_readable = ""
-        raw_time = inv["time_iso"]
-        if raw_time:
+    # --- подготовка читаемого времени (Asia/Almaty) ---
+    time_readable = ""
+    raw_time = inv["time_iso"]
+    if raw_time:
+        try:
+            t = raw_time
+            if t.endswith("Z"):
+                t = t[:-1]
             try:
-                t = raw_time
-                if t.endswith("Z"):
-                    t = t[:-1]
-                try:
-                    dt = datetime.fromisoformat(t)
-                except Exception:
-                    dt = datetime.strptime(raw_time, "%Y-%m-%dT%H:%M:%S.%fZ")
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=timezone.utc)
-                try:
-                    almaty = ZoneInfo("Asia/Almaty")
-                    dt_local = dt.astimezone(almaty)
-                except Exception:
-                    dt_local = dt.astimezone(timezone.utc)
-                ru_months = ["января","февраля","марта","апреля","мая","июня","июля","августа","сентября","октября","ноября","декабря"]
-                hhmm = dt_local.strftime("%H:%M")
-                day = dt_local.day
-                month = ru_months[dt_local.month - 1]
-                time_readable = f"{hhmm} {day} {month}"
+                dt = datetime.fromisoformat(t)
             except Exception:
-                logging.exception("time parse failed")
+                dt = datetime.strptime(raw_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            try:
+                almaty = ZoneInfo("Asia/Almaty")
+                dt_local = dt.astimezone(almaty)
+            except Exception:
+                dt_local = dt.astimezone(timezone.utc)
+            ru_months = ["января","февраля","марта","апреля","мая","июня","июля","августа","сентября","октября","ноября","декабря"]
+            hhmm = dt_local.strftime("%H:%M")
+            day = dt_local.day
+            month = ru_months[dt_local.month - 1]
+            time_readable = f"{hhmm} {day} {month}"
+        except Exception:
+            logging.exception("time parse failed")
 
-        # --- Формирование текста уведомления для инициатора ---
-        place_text = f' в "{inv["place_name"]}"' if inv["place_name"] else ""
-        meal_type = inv["meal_type"] or "встречу"
+    # --- Формирование текста уведомления для инициатора ---
+    place_text = f' в "{inv["place_name"]}"' if inv["place_name"] else ""
+    meal_type = inv["meal_type"] or "встречу"
 
-        status_text = "принято" if new_status == "accepted" else "отказано"
-        emojis = "🥳🥳🥳" if new_status == "accepted" else "😭😭😭"
+    status_text = "принято" if new_status == "accepted" else "отказано"
+    emojis = "🥳🥳🥳" if new_status == "accepted" else "😭😭😭"
 
-        # responder_display = responder_name or ("@" + str(responder_tg)) if responder_tg else "пользователь"
-        if responder_name:
-            responder_display = responder_name
-        elif responder_username:
-            responder_display = "@" + str(responder_username)
-        elif responder_tg:
-            responder_display = "@" + str(responder_tg)
-        else:
-            responder_display = "пользователь"
+    # responder_display = responder_name or ("@" + str(responder_tg)) if responder_tg else "пользователь"
+    if responder_name:
+        responder_display = responder_name
+    elif responder_username:
+        responder_display = "@" + str(responder_username)
+    elif responder_tg:
+        responder_display = "@" + str(responder_tg)
+    else:
+        responder_display = "пользователь"
 
-        when_part = f"в {time_readable}" if time_readable else (f"в {inv['time_iso']}" if inv["time_iso"] else "")
+    when_part = f"в {time_readable}" if time_readable else (f"в {inv['time_iso']}" if inv["time_iso"] else "")
 
-        # При принятии добавляем отдельную строку с username (если есть) - как просил
-        contact_line = ""
-        if new_status == "accepted":
-            if responder_username:
-                contact_line = f"\n\nСвяжись с @{responder_username}"
-            elif responder_tg:
-                contact_line = f"\n\nСвяжись с @{responder_tg}"
+    # При принятии добавляем отдельную строку с username (если есть) - как просил
+    contact_line = ""
+    if new_status == "accepted":
+        if responder_username:
+            contact_line = f"\n\nСвяжись с @{responder_username}"
+        elif responder_tg:
+            contact_line = f"\n\nСвяжись с @{responder_tg}"
 
-        telegram_text = f'Ваше приглашение{place_text} с {responder_display} на {meal_type} {when_part} было {status_text} {emojis}{contact_line}'
+    telegram_text = f'Ваше приглашение{place_text} с {responder_display} на {meal_type} {when_part} было {status_text} {emojis}{contact_line}'
 
-        # Отправим Telegram (best-effort)
-        try:
-            await send_telegram_message(inv["from_tg"], telegram_text)
-        except Exception:
-            logging.exception("failed to send telegram notify to initiator")
-
-        # --- Создадим запись в notifications для мини-аппа инициатора ---
-        notif_payload = {
-            "invite_id": invite_id,
-            "place_name": inv["place_name"],
-            "meal_type": meal_type,
-            "time_readable": time_readable,
-            "responder_name": responder_display,
-            "status": new_status
-        }
-        try:
-            await db.execute(
-                "INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                (inv["from_user_id"], "invite_response", json.dumps(notif_payload, ensure_ascii=False))
-            )
-            await db.commit()
-        except Exception:
-            logging.exception("failed to insert notification")
+    # --- Создадим запись в notifications для мини-аппа инициатора ---
+    notif_payload = {
+        "invite_id": invite_id,
+        "place_name": inv["place_name"],
+        "meal_type": meal_type,
+        "time_readable": time_readable,
+        "responder_name": responder_display,
+        "status": new_status
+    }
+    async def _notify(db):
+        item = await insert_notification(db, inv["from_user_id"], "invite_response", notif_payload)
+        # Telegram инициатору - через outbox
+        if inv["from_tg"]:
+            await enqueue_message(db, inv["from_tg"], telegram_text)
+        return item
+
+    try:
+        item = await get_pool().write(_notify)
+        outbox.wake()
+        notification_hub.publish([item])
+    except Exception:
+        logging.exception("failed to insert notification")
 
-        return {"ok": True, "invite_id": invite_id, "status": new_status}
+    return {"ok": True, "invite_id": invite_id, "status": new_status}
 
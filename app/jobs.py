@@ -0,0 +1,233 @@
+# app/jobs.py
+
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from app.config import JOBS_BATCH, JOBS_MAX_ATTEMPTS, JOBS_RETRY_BASE_S, JOBS_MAX_SLEEP_S
+from app.db import get_pool
+
+# Персистентный планировщик: задача - строка scheduled_jobs с due_at.
+# Воркер спит до ближайшего due_at (или пока не разбудит новая более ранняя задача),
+# атомарно забирает пачку созревших (UPDATE ... RETURNING на единственном writer)
+# и выполняет обработчики. Выполнение at-least-once: обработчики идемпотентны.
+
+_TS = '%Y-%m-%d %H:%M:%S'
+
+JOB_HANDLERS = {}
+
+
+def job_handler(kind: str):
+    """Регистрирует async-обработчик задач вида kind: handler(ref_id, payload)."""
+    def deco(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return deco
+
+
+async def create_jobs_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            ref_id INTEGER NOT NULL,           -- например invite_id
+            payload TEXT,
+            due_at TEXT NOT NULL,              -- UTC 'YYYY-MM-DD HH:MM:SS'
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            claimed_at TEXT,
+            created_at TEXT DEFAULT (datetime('now')),
+            UNIQUE(kind, ref_id)
+        );
+    """)
+    # воркер читает только созревшие pending - частичный индекс по due_at
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due
+            ON scheduled_jobs(due_at) WHERE status = 'pending';
+    """)
+    # задачи, взятые в работу до рестарта, снова в очередь (at-least-once)
+    await db.execute("UPDATE scheduled_jobs SET status = 'pending' WHERE status = 'running'")
+
+
+async def schedule_job(db, kind: str, ref_id: int, due_s: str, payload: dict = None):
+    """Ставит (или переносит) задачу внутри текущей write-op. После коммита - job_scheduler.wake(due_s)."""
+    await db.execute("""
+        INSERT INTO scheduled_jobs (kind, ref_id, payload, due_at, status, attempts)
+        VALUES (?, ?, ?, ?, 'pending', 0)
+        ON CONFLICT(kind, ref_id) DO UPDATE SET
+            payload = excluded.payload, due_at = excluded.due_at,
+            status = 'pending', attempts = 0, last_error = NULL
+    """, (kind, ref_id, json.dumps(payload, ensure_ascii=False) if payload is not None else None, due_s))
+    return due_s
+
+
+async def cancel_job(db, kind: str, ref_id: int):
+    await db.execute("DELETE FROM scheduled_jobs WHERE kind = ? AND ref_id = ? AND status = 'pending'", (kind, ref_id))
+
+
+def due_in(seconds: float, now: datetime = None) -> str:
+    return ((now or datetime.now(timezone.utc)) + timedelta(seconds=seconds)).strftime(_TS)
+
+
+class JobScheduler:
+
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._next_due = None
+        self.claimed = 0
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+        self.batches = 0
+        self.lag_total = 0.0     # секунды от due_at до взятия в работу
+        self.lag_max = 0.0
+        self.run_total = 0.0
+        self.last_run_at = None
+
+    def reset(self):
+        self._wakeup = asyncio.Event()  # привязывается к loop текущего lifespan
+        self._next_due = None
+
+    def wake(self, due_s: str = None):
+        """Разбудить воркер, если новая задача созреет раньше, чем он собирался проснуться."""
+        if due_s is None or self._next_due is None or due_s < self._next_due:
+            self._wakeup.set()
+
+    async def _claim(self, now_s: str):
+        async def _op(db):
+            cur = await db.execute("""
+                UPDATE scheduled_jobs
+                SET status = 'running', attempts = attempts + 1, claimed_at = ?
+                WHERE id IN (
+                    SELECT id FROM scheduled_jobs
+                    WHERE status = 'pending' AND due_at <= ?
+                    ORDER BY due_at
+                    LIMIT ?
+                )
+                RETURNING id, kind, ref_id, payload, due_at, attempts
+            """, (now_s, now_s, JOBS_BATCH))
+            return [dict(r) for r in await cur.fetchall()]
+        return await get_pool().write(_op)
+
+    async def _run_one(self, job):
+        handler = JOB_HANDLERS.get(job["kind"])
+        if handler is None:
+            return job, RuntimeError(f"no handler for {job['kind']}")
+        try:
+            payload = json.loads(job["payload"]) if job["payload"] else None
+            await handler(job["ref_id"], payload)
+            return job, None
+        except Exception as e:
+            logging.exception("job %s:%s failed (attempt %s)", job["kind"], job["ref_id"], job["attempts"])
+            return job, e
+
+    async def _finish(self, results, now: datetime):
+        done_ids, retry, failed = [], [], []
+        for job, err in results:
+            if err is None:
+                done_ids.append((job["id"],))
+            elif job["attempts"] >= JOBS_MAX_ATTEMPTS:
+                failed.append((repr(err)[:500], job["id"]))
+            else:
+                delay = JOBS_RETRY_BASE_S * (2 ** (job["attempts"] - 1))
+                retry.append((due_in(delay, now), repr(err)[:500], job["id"]))
+
+        async def _op(db):
+            # выполненные удаляем: идемпотентность держится на данных (survey_sent, status)
+            if done_ids:
+                await db.executemany("DELETE FROM scheduled_jobs WHERE id = ?", done_ids)
+            if retry:
+                await db.executemany(
+                    "UPDATE scheduled_jobs SET status = 'pending', due_at = ?, last_error = ? WHERE id = ?", retry)
+            if failed:
+                await db.executemany(
+                    "UPDATE scheduled_jobs SET status = 'failed', last_error = ? WHERE id = ?", failed)
+        await get_pool().write(_op)
+        self.done += len(done_ids)
+        self.retried += len(retry)
+        self.failed += len(failed)
+
+    async def run_due(self):
+        """Забрать и выполнить все созревшие задачи (пачками). -> сколько выполнено."""
+        total = 0
+        while True:
+            now = datetime.now(timezone.utc)
+            jobs = await self._claim(now.strftime(_TS))
+            if not jobs:
+                return total
+            self.batches += 1
+            self.claimed += len(jobs)
+            for j in jobs:
+                lag = max(0.0, (now - datetime.strptime(j["due_at"], _TS).replace(tzinfo=timezone.utc)).total_seconds())
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+            t0 = time.perf_counter()
+            results = await asyncio.gather(*(self._run_one(j) for j in jobs))
+            self.run_total += time.perf_counter() - t0
+            await self._finish(results, now)
+            self.last_run_at = now.strftime(_TS)
+            total += len(jobs)
+            if len(jobs) < JOBS_BATCH:
+                return total
+
+    async def _load_next_due(self):
+        async with get_pool().reader() as db:
+            cur = await db.execute("SELECT MIN(due_at) FROM scheduled_jobs WHERE status = 'pending'")
+            row = await cur.fetchone()
+        next_due = row[0] if row else None
+        if not self._wakeup.is_set():
+            self._next_due = next_due
+        return next_due
+
+    async def run_forever(self):
+        while True:
+            # пока идёт проход, любой wake() будит следующий (MIN(due_at) мог не увидеть новую задачу)
+            self._wakeup.clear()
+            self._next_due = None
+            try:
+                await self.run_due()
+                next_due = await self._load_next_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("job scheduler pass failed")
+                next_due = due_in(5)
+            timeout = JOBS_MAX_SLEEP_S
+            if next_due is not None:
+                wait = (datetime.strptime(next_due, _TS).replace(tzinfo=timezone.utc)
+                        - datetime.now(timezone.utc)).total_seconds()
+                timeout = min(timeout, max(0.0, wait))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            "handlers": sorted(JOB_HANDLERS),
+            "next_due": self._next_due,
+            "claimed": self.claimed,
+            "done": self.done,
+            "retried": self.retried,
+            "failed": self.failed,
+            "batches": self.batches,
+            "lag_avg_ms": round(self.lag_total * 1000 / self.claimed, 1) if self.claimed else 0.0,
+            "lag_max_ms": round(self.lag_max * 1000, 1),
+            "run_avg_ms": round(self.run_total * 1000 / self.batches, 1) if self.batches else 0.0,
+            "last_run_at": self.last_run_at,
+        }
+
+
+job_scheduler = JobScheduler()
+
+
+async def job_worker_loop():
+    job_scheduler.reset()
+    try:
+        await job_scheduler.run_forever()
+    except asyncio.CancelledError:
+        logging.info("job_worker_loop cancelled")
+        raise
@@ -0,0 +1,117 @@
+# app/maintenance.py
+#
+# Сверка и пересчёт денормализованных счётчиков с исходными таблицами.
+#
+#   python -m app.maintenance verify                 # все счётчики, код выхода 1 при расхождении
+#   python -m app.maintenance verify review_counts
+#   python -m app.maintenance rebuild review_counts  # пересчитать с нуля в одной транзакции
+#
+# Работает по DB_PATH (или --db) и безопасна на живой базе: пересчёт идёт под
+# BEGIN IMMEDIATE, так что конкурирующие записи просто подождут busy_timeout.
+
+import sys
+import asyncio
+import logging
+import argparse
+import aiosqlite
+
+from app.config import DB_PATH
+from app import notifications, reviews, tags
+
+# имя -> (текущие значения, эталон из исходной таблицы, SQL пересчёта)
+COUNTERS = {
+    "review_counts": (
+        "SELECT target_user_id, reaction, cnt FROM review_counts",
+        "SELECT target_user_id, reaction, COUNT(*) FROM reviews GROUP BY target_user_id, reaction",
+        reviews.REBUILD_SQL,
+    ),
+    "tag_counts": (
+        "SELECT tag, cnt FROM tag_counts",
+        "SELECT tag, COUNT(*) FROM user_tags GROUP BY tag",
+        tags.REBUILD_SQL,
+    ),
+    "notification_unread": (
+        "SELECT user_id, cnt FROM notification_unread",
+        "SELECT user_id, COUNT(*) FROM notifications WHERE read = 0 GROUP BY user_id",
+        notifications.REBUILD_UNREAD_SQL,
+    ),
+}
+
+
+async def verify_counter(db, name: str, sample: int = 20) -> dict:
+    current_sql, expected_sql, _ = COUNTERS[name]
+    # оба чтения в одной транзакции - один снимок, параллельные записи не дают ложного дрейфа
+    await db.execute("BEGIN")
+    try:
+        cur = await db.execute(current_sql)
+        current = {tuple(r[:-1]): r[-1] for r in await cur.fetchall()}
+        cur = await db.execute(expected_sql)
+        expected = {tuple(r[:-1]): r[-1] for r in await cur.fetchall()}
+    finally:
+        await db.rollback()
+    missing = sorted(k for k in expected.keys() - current.keys())
+    stale = sorted(k for k in current.keys() - expected.keys())
+    wrong = sorted(k for k in expected.keys() & current.keys() if expected[k] != current[k])
+    ok = not (missing or stale or wrong)
+    if not ok:
+        logging.warning("%s drift: missing=%d stale=%d wrong=%d", name, len(missing), len(stale), len(wrong))
+    return {
+        "ok": ok,
+        "rows": len(current),
+        "expected_rows": len(expected),
+        "missing": [list(k) for k in missing[:sample]],
+        "stale": [list(k) for k in stale[:sample]],
+        "wrong": [{"key": list(k), "cnt": current[k], "expected": expected[k]} for k in wrong[:sample]],
+    }
+
+
+async def rebuild_counter(db, name: str) -> int:
+    """Пересчитать таблицу счётчиков с нуля. -> сколько строк получилось."""
+    _, _, rebuild_sql = COUNTERS[name]
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        await db.execute(f"DELETE FROM {name}")
+        await db.execute(rebuild_sql)
+        cur = await db.execute(f"SELECT COUNT(*) FROM {name}")
+        n = (await cur.fetchone())[0]
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    return n
+
+
+async def _run(command: str, names, path: str) -> bool:
+    ok = True
+    async with aiosqlite.connect(path, isolation_level=None) as db:
+        await db.execute("PRAGMA busy_timeout = 5000;")
+        for name in names:
+            if command == "rebuild":
+                n = await rebuild_counter(db, name)
+                print(f"{name}: rebuilt, {n} rows")
+            res = await verify_counter(db, name)
+            ok = ok and res["ok"]
+            status = "ok" if res["ok"] else "DRIFT"
+            print(f"{name}: {status} ({res['rows']} rows, expected {res['expected_rows']})")
+            for k in ("missing", "stale", "wrong"):
+                if res[k]:
+                    print(f"  {k}: {res[k]}")
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser(description="verify/rebuild denormalized counters")
+    ap.add_argument("command", choices=("verify", "rebuild"))
+    ap.add_argument("counters", nargs="*", help=f"{', '.join(COUNTERS)}; по умолчанию - все")
+    ap.add_argument("--db", default=DB_PATH)
+    args = ap.parse_args()
+    unknown = [n for n in args.counters if n not in COUNTERS]
+    if unknown:
+        ap.error(f"unknown counters: {', '.join(unknown)}")
+    names = args.counters or list(COUNTERS)
+    ok = asyncio.run(_run(args.command, names, args.db))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
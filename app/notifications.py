@@ -0,0 +1,281 @@
+# app/notifications.py
+
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+from app.config import NOTIF_SSE_BACKLOG, NOTIF_SSE_BUFFER, NOTIF_SSE_HEARTBEAT_S, NOTIF_SSE_RETRY_MS
+from app.db import get_pool
+
+# Уведомления мини-аппа. Строка в notifications пишется через insert_notification
+# внутри транзакции; после коммита вызывающий публикует её в notification_hub,
+# и открытые /api/notifications/stream (SSE) получают её без опроса.
+# id события = notifications.id: переподключение с Last-Event-ID дочитывает
+# пропущенное из БД, поэтому потеря live-события (переполнение буфера) не страшна.
+# Хаб живёт в процессе - как и сетка сессий, рассчитан на один воркер.
+# Число непрочитанных ведётся в notification_unread в тех же транзакциях, что
+# insert_notification / mark_read, поэтому бейдж - одно чтение по ключу.
+# Сверка/пересчёт: python -m app.maintenance verify notification_unread.
+
+REBUILD_UNREAD_SQL = """
+    INSERT INTO notification_unread (user_id, cnt)
+    SELECT user_id, COUNT(*) FROM notifications WHERE read = 0 GROUP BY user_id
+"""
+
+UNREAD_COUNT_SQL = """
+    SELECT u.id, COALESCE((SELECT cnt FROM notification_unread WHERE user_id = u.id), 0) AS unread
+    FROM users u WHERE u.tg_id = ?
+"""
+
+# сколько id можно передать в один mark_read
+MARK_READ_MAX_IDS = 500
+
+
+async def create_notification_unread_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS notification_unread (
+            user_id INTEGER PRIMARY KEY,
+            cnt INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """)
+    # миграция: пустая таблица при непрочитанных уведомлениях - досчитываем один раз
+    cur = await db.execute(
+        "SELECT EXISTS(SELECT 1 FROM notification_unread), EXISTS(SELECT 1 FROM notifications WHERE read = 0)")
+    has_counts, has_unread = await cur.fetchone()
+    if has_unread and not has_counts:
+        await db.execute(REBUILD_UNREAD_SQL)
+        logging.info("init_db: notification_unread backfilled from notifications")
+
+
+async def insert_notification(db, user_id: int, type_: str, payload: dict) -> dict:
+    """INSERT в notifications (внутри op пула). -> элемент для notification_hub.publish после коммита."""
+    cur = await db.execute(
+        "INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now')) "
+        "RETURNING id, created_at",
+        (user_id, type_, json.dumps(payload, ensure_ascii=False))
+    )
+    row = await cur.fetchone()
+    await db.execute(
+        "INSERT INTO notification_unread (user_id, cnt) VALUES (?, 1) "
+        "ON CONFLICT(user_id) DO UPDATE SET cnt = cnt + 1",
+        (user_id,)
+    )
+    return {"user_id": user_id, "id": row[0], "type": type_, "payload": payload, "read": False, "created_at": row[1]}
+
+
+async def mark_read(db, user_id: int, ids=None, up_to_id: int = None) -> int:
+    """Пометить прочитанными ids и/или все с id <= up_to_id одним UPDATE (внутри op пула). -> сколько помечено."""
+    conds = []
+    params = [user_id]
+    if ids:
+        conds.append(f"id IN ({','.join('?' for _ in ids)})")
+        params += list(ids)
+    if up_to_id is not None:
+        conds.append("id <= ?")
+        params.append(up_to_id)
+    if not conds:
+        return 0
+    cur = await db.execute(
+        f"UPDATE notifications SET read = 1 WHERE user_id = ? AND read = 0 AND ({' OR '.join(conds)})", params)
+    n = cur.rowcount
+    if n:
+        await _sub_unread(db, user_id, n)
+    return n
+
+
+async def _sub_unread(db, user_id: int, n: int):
+    await db.execute("UPDATE notification_unread SET cnt = cnt - ? WHERE user_id = ?", (n, user_id))
+    await db.execute("DELETE FROM notification_unread WHERE user_id = ? AND cnt <= 0", (user_id,))
+
+
+# опрос по инвайту и ответы на него: по (user_id, invite_id) нужен только последний
+SURVEY_TYPES = ("survey", "survey_followup", "survey_negative")
+_SURVEY_IN = "(" + ",".join(f"'{t}'" for t in SURVEY_TYPES) + ")"
+
+
+async def purge_read_batch(db, after_id: int, below_id: int, cutoff_s: str, limit: int):
+    """Удаляет до limit прочитанных уведомлений старше cutoff_s с after_id < id < below_id. -> (удалено, id последней)."""
+    cur = await db.execute(
+        "SELECT id FROM notifications WHERE id > ? AND id < ? AND read = 1 AND created_at < ? ORDER BY id LIMIT ?",
+        (after_id, below_id, cutoff_s, limit)
+    )
+    ids = [r[0] for r in await cur.fetchall()]
+    if not ids:
+        return 0, None
+    # прочитанные - счётчик непрочитанных не меняется
+    cur = await db.execute(
+        "DELETE FROM notifications WHERE id > ? AND id <= ? AND read = 1 AND created_at < ?",
+        (after_id, ids[-1], cutoff_s)
+    )
+    return cur.rowcount, ids[-1]
+
+
+async def collapse_superseded_batch(db, after_id: int, limit: int):
+    """Для следующих limit опросных уведомлений с id > after_id удаляет более ранние опросные
+    уведомления того же пользователя по тому же инвайту. -> (удалено, id последней просмотренной)."""
+    cur = await db.execute(
+        f"SELECT id FROM notifications WHERE id > ? AND type IN {_SURVEY_IN} ORDER BY id LIMIT ?",
+        (after_id, limit)
+    )
+    ids = [r[0] for r in await cur.fetchall()]
+    if not ids:
+        return 0, None
+    hi = ids[-1]
+    cur = await db.execute(f"""
+        DELETE FROM notifications WHERE id IN (
+            SELECT o.id FROM notifications f
+            JOIN notifications o ON o.user_id = f.user_id AND o.id < f.id
+            WHERE f.id > ? AND f.id <= ? AND f.type IN {_SURVEY_IN} AND o.type IN {_SURVEY_IN}
+              AND json_extract(o.payload, '$.invite_id') = json_extract(f.payload, '$.invite_id')
+        )
+        RETURNING user_id, read
+    """, (after_id, hi))
+    rows = await cur.fetchall()
+    unread = {}
+    for user_id, read in rows:
+        if not read:
+            unread[user_id] = unread.get(user_id, 0) + 1
+    for user_id, n in unread.items():
+        await _sub_unread(db, user_id, n)
+    return len(rows), hi
+
+
+def notification_item(r) -> dict:
+    """Строка notifications -> тот же вид, что отдаёт /api/notifications."""
+    try:
+        pl = json.loads(r["payload"]) if r["payload"] else {}
+    except Exception:
+        pl = {}
+    return {
+        "id": r["id"],
+        "type": r["type"],
+        "payload": pl,
+        "read": bool(r["read"]),
+        "created_at": r["created_at"]
+    }
+
+
+class _Subscriber:
+    __slots__ = ("user_id", "buf", "wake", "overflow")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.buf = deque()
+        self.wake = asyncio.Event()
+        self.overflow = False
+
+
+class NotificationHub:
+
+    def __init__(self):
+        self._subs = {}       # user_id -> set(_Subscriber)
+        self._closed = False
+        self.connections = 0
+        self.published = 0
+        self.delivered = 0
+        self.overflows = 0
+        self.replayed = 0
+
+    def start(self):
+        self._closed = False
+
+    def close(self):
+        """Shutdown: все открытые стримы завершаются (клиент переподключится к новому процессу)."""
+        self._closed = True
+        for subs in self._subs.values():
+            for s in subs:
+                s.wake.set()
+
+    def publish(self, items):
+        """Раздать уведомления подписчикам (вызывать после коммита)."""
+        for it in items:
+            if not it:
+                continue
+            self.published += 1
+            for s in self._subs.get(it["user_id"], ()):
+                if s.overflow:
+                    continue
+                if len(s.buf) >= NOTIF_SSE_BUFFER:
+                    # медленный клиент: закрываем стрим, остальное он дочитает из БД по Last-Event-ID
+                    s.overflow = True
+                    s.buf.clear()
+                    self.overflows += 1
+                else:
+                    s.buf.append(it)
+                s.wake.set()
+
+    def _subscribe(self, user_id: int) -> _Subscriber:
+        s = _Subscriber(user_id)
+        self._subs.setdefault(user_id, set()).add(s)
+        self.connections += 1
+        return s
+
+    def _unsubscribe(self, s: _Subscriber):
+        subs = self._subs.get(s.user_id)
+        if subs is not None:
+            subs.discard(s)
+            if not subs:
+                del self._subs[s.user_id]
+        self.connections -= 1
+
+    async def _backlog(self, user_id: int, after_id: int):
+        async with get_pool().reader() as db:
+            cur = await db.execute(
+                "SELECT id, type, payload, read, created_at FROM notifications "
+                "WHERE user_id = ? AND read = 0 AND id > ? ORDER BY id LIMIT ?",
+                (user_id, after_id, NOTIF_SSE_BACKLOG)
+            )
+            return [notification_item(r) for r in await cur.fetchall()]
+
+    async def stream(self, user_id: int, last_id: int = 0):
+        """SSE-поток: непрочитанные после last_id из БД, затем live-события и пинги."""
+        s = self._subscribe(user_id)
+        try:
+            yield f"retry: {NOTIF_SSE_RETRY_MS}\n\n"
+            # подписка до чтения БД: что придёт во время SELECT, не потеряется (дубли отсекает last_id)
+            backlog = await self._backlog(user_id, last_id)
+            self.replayed += len(backlog)
+            for it in backlog:
+                last_id = it["id"]
+                yield _event(it)
+            if len(backlog) >= NOTIF_SSE_BACKLOG:
+                # хвост заберём на переподключении
+                return
+            next_ping = time.monotonic() + NOTIF_SSE_HEARTBEAT_S
+            while not self._closed:
+                while s.buf:
+                    it = s.buf.popleft()
+                    if it["id"] > last_id:
+                        last_id = it["id"]
+                        self.delivered += 1
+                        yield _event(it)
+                if s.overflow:
+                    return
+                s.wake.clear()
+                try:
+                    await asyncio.wait_for(s.wake.wait(), max(0.0, next_ping - time.monotonic()))
+                except asyncio.TimeoutError:
+                    next_ping = time.monotonic() + NOTIF_SSE_HEARTBEAT_S
+                    yield ": ping\n\n"
+        finally:
+            self._unsubscribe(s)
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "users": len(self._subs),
+            "published": self.published,
+            "delivered": self.delivered,
+            "replayed": self.replayed,
+            "overflows": self.overflows,
+        }
+
+
+def _event(it: dict) -> str:
+    data = {k: v for k, v in it.items() if k != "user_id"}
+    return f"id: {it['id']}\nevent: notification\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+notification_hub = NotificationHub()
@@ -0,0 +1,385 @@
+# app/outbox.py
+
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from datetime import datetime, timedelta, timezone
+
+from app.config import (OUTBOX_BATCH, OUTBOX_DRAIN_TIMEOUT_S, OUTBOX_GLOBAL_RATE, OUTBOX_MAX_ATTEMPTS,
+                        OUTBOX_MAX_SLEEP_S, OUTBOX_PER_CHAT_INTERVAL_S, OUTBOX_RETRY_BASE_S,
+                        OUTBOX_SEND_TIMEOUT_S, OUTBOX_WORKERS)
+from app.db import get_pool
+from app.telegram_utils import CircuitOpenError, message_payload, telegram
+
+# Исходящие сообщения Telegram: хендлеры только кладут строку в outbox (в своей же
+# транзакции), отправляет пул воркеров с лимитами Bot API - не больше
+# OUTBOX_GLOBAL_RATE сообщений/с на бота и одного сообщения в OUTBOX_PER_CHAT_INTERVAL_S
+# на чат. 429 -> пауза чата на retry_after, сеть/5xx -> повтор с backoff,
+# прочие 4xx (бот заблокирован, чат не найден) -> failed сразу.
+# В чат сообщения идут строго по id: забирается только самое раннее неотправленное
+# сообщение чата, так что в полёте по чату не больше одного. Если чат ещё на паузе,
+# сообщение возвращается в pending с next_at на конец паузы - воркер не спит на чужом чате.
+# Доставка at-least-once: 'sending', прерванные рестартом, уходят повторно.
+
+_TS = '%Y-%m-%d %H:%M:%S'
+
+
+# головы очередей чатов - самое раннее неотправленное сообщение каждого чата
+# (один проход по покрывающему idx_outbox_chat); если голова в 'sending', чат занят
+_HEADS_CTE = """
+    WITH heads AS (
+        SELECT MIN(id) AS id FROM outbox WHERE status IN ('pending', 'sending') GROUP BY chat_id
+    )
+"""
+
+
+def _at(seconds: float = 0.0) -> str:
+    t = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    if seconds > 0 and t.microsecond:
+        # округляем вверх: next_at с секундной точностью не должен наступить раньше срока
+        t += timedelta(microseconds=1_000_000 - t.microsecond)
+    return t.strftime(_TS)
+
+
+async def create_outbox_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            method TEXT NOT NULL DEFAULT 'sendMessage',
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,             -- json-параметры метода Bot API
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_at TEXT NOT NULL DEFAULT (datetime('now')),
+            last_error TEXT,
+            created_at TEXT DEFAULT (datetime('now'))
+        );
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+            ON outbox(next_at) WHERE status = 'pending';
+    """)
+    # головы очередей чатов (см. _HEADS_CTE)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_chat
+            ON outbox(chat_id, status, id);
+    """)
+    # отправка прервана рестартом - снова в очередь
+    await db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+
+
+async def enqueue_message(db, chat_id: int, text: str, reply_markup: dict = None) -> int:
+    """Кладёт sendMessage в outbox внутри текущей write-op. После коммита - outbox.wake()."""
+    cur = await db.execute(
+        "INSERT INTO outbox (method, chat_id, payload) VALUES ('sendMessage', ?, ?)",
+        (chat_id, json.dumps(message_payload(chat_id, text, reply_markup), ensure_ascii=False))
+    )
+    return cur.lastrowid
+
+
+async def queue_telegram_message(chat_id: int, text: str, reply_markup: dict = None) -> int:
+    """Отдельная запись в outbox (когда своей транзакции нет)."""
+    async def _op(db):
+        return await enqueue_message(db, chat_id, text, reply_markup)
+    msg_id = await get_pool().write(_op)
+    outbox.wake()
+    return msg_id
+
+
+class RateLimiter:
+    """Слоты отправки: глобально rate в секунду (резервируются заранее), в чат - раз в per_chat_s
+    (занимается в момент отправки, чтобы ожидание глобального слота не сокращало интервал)."""
+
+    def __init__(self, rate: float, per_chat_s: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.per_chat_s = per_chat_s
+        self._next_global = 0.0
+        self._next_chat = {}     # chat_id -> monotonic, раньше которого в чат не пишем
+
+    def chat_wait(self, chat_id: int, now: float) -> float:
+        return max(0.0, self._next_chat.get(chat_id, 0.0) - now)
+
+    def take_chat(self, chat_id: int, now: float):
+        self._next_chat[chat_id] = now + self.per_chat_s
+
+    def global_delay(self, now: float) -> float:
+        t = max(now, self._next_global)
+        self._next_global = t + self.interval
+        return t - now
+
+    def pause_chat(self, chat_id: int, seconds: float, now: float):
+        self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0.0), now + seconds)
+
+    def prune(self, now: float):
+        for chat_id in [c for c, t in self._next_chat.items() if t <= now]:
+            del self._next_chat[chat_id]
+
+    def __len__(self):
+        return len(self._next_chat)
+
+
+class TelegramOutbox:
+
+    def __init__(self):
+        self.limiter = RateLimiter(OUTBOX_GLOBAL_RATE, OUTBOX_PER_CHAT_INTERVAL_S)
+        self._queue = None
+        self._wakeup = None
+        self._stopping = False
+        self._tasks = []
+        self.in_flight = 0
+        self.claimed = 0
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.breaker_deferred = 0
+        self.chat_deferred = 0   # чат ещё на паузе - сообщение отложено, а не ждёт в воркере
+        self.failed = 0
+        self.send_total = 0.0
+        self.send_max = 0.0
+        self.lag_total = 0.0     # секунды от next_at до фактической отправки
+        self.lag_max = 0.0
+        self.pending_hint = None
+
+    def start(self, workers: int = OUTBOX_WORKERS):
+        # Queue/Event привязываются к loop текущего lifespan; HTTP - общий клиент telegram
+        self._queue = asyncio.Queue(maxsize=workers * 4)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._dispatch_loop())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self, timeout: float = OUTBOX_DRAIN_TIMEOUT_S):
+        """Досылает созревшие сообщения (не дольше timeout), остальное остаётся в outbox."""
+        if not self._tasks:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._tasks), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("outbox: drain timed out after %.1fs, %d in flight", timeout, self.in_flight)
+            for t in self._tasks:
+                t.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+            async def _requeue(db):
+                await db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+            try:
+                await get_pool().write(_requeue)
+            except Exception:
+                logging.exception("outbox: requeue after drain failed")
+        self._tasks = []
+
+    async def _claim(self, limit: int):
+        now_s = _at()
+
+        async def _op(db):
+            cur = await db.execute(f"""
+                {_HEADS_CTE}
+                UPDATE outbox SET status = 'sending', attempts = attempts + 1
+                WHERE id IN (
+                    SELECT o.id FROM heads h JOIN outbox o ON o.id = h.id
+                    WHERE o.status = 'pending' AND o.next_at <= ?
+                    ORDER BY o.id
+                    LIMIT ?
+                )
+                RETURNING id, method, chat_id, payload, attempts, next_at
+            """, (now_s, limit))
+            return [dict(r) for r in await cur.fetchall()]
+        jobs = await get_pool().write(_op)
+        jobs.sort(key=lambda j: j["id"])  # RETURNING порядок не гарантирует
+        return jobs
+
+    async def _next_due(self):
+        async with get_pool().reader() as db:
+            # только головы очередей чатов: остальные заберутся после них, а их next_at уже в прошлом
+            cur = await db.execute(
+                f"{_HEADS_CTE} SELECT MIN(o.next_at) FROM heads h JOIN outbox o ON o.id = h.id WHERE o.status = 'pending'")
+            next_at = (await cur.fetchone())[0]
+            cur = await db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+            row = (next_at, (await cur.fetchone())[0])
+        self.pending_hint = row[1]
+        return row[0]
+
+    async def _dispatch_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            self._wakeup.clear()
+            free = self._queue.maxsize - self._queue.qsize()
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = await self._claim(min(free, OUTBOX_BATCH))
+                except Exception:
+                    logging.exception("outbox: claim failed")
+                    if self._stopping:
+                        break
+                    await asyncio.sleep(1.0)
+                    continue
+                self.claimed += len(jobs)
+                for job in jobs:
+                    self._queue.put_nowait(job)
+
+            if time.monotonic() - last_prune > 60:
+                last_prune = time.monotonic()
+                self.limiter.prune(last_prune)
+
+            if free == 0 or len(jobs) == free:
+                # очередь воркеров полна, а в outbox может быть ещё - ждём, пока освободится место
+                await self._wait(OUTBOX_MAX_SLEEP_S)
+                continue
+            if self._stopping:
+                break
+            if jobs:
+                continue
+
+            timeout = OUTBOX_MAX_SLEEP_S
+            try:
+                next_due = await self._next_due()
+            except Exception:
+                logging.exception("outbox: next_due failed")
+                next_due = None
+            if next_due is not None:
+                wait = (datetime.strptime(next_due, _TS).replace(tzinfo=timezone.utc)
+                        - datetime.now(timezone.utc)).total_seconds()
+                timeout = min(timeout, max(0.0, wait))
+            await self._wait(timeout)
+
+        # drain: воркеры доберут очередь и завершатся
+        for _ in range(len(self._tasks) - 1):
+            await self._queue.put(None)
+
+    async def _wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job is None:
+                return
+            self.in_flight += 1
+            try:
+                await self._deliver(job)
+            except Exception:
+                logging.exception("outbox: deliver %s failed", job["id"])
+            finally:
+                self.in_flight -= 1
+                self.wake()  # освободилось место в очереди
+
+    async def _deliver(self, job):
+        chat_id = job["chat_id"]
+        now = time.monotonic()
+        wait = self.limiter.chat_wait(chat_id, now)
+        if wait > 0:
+            # чат на паузе (интервал или 429): следующее по чату всё равно ждёт это сообщение
+            self.chat_deferred += 1
+            await self._defer(job, wait)
+            return
+        # слот чата - на момент отправки, чтобы ожидание глобального слота не сокращало интервал
+        delay = self.limiter.global_delay(now)
+        self.limiter.take_chat(chat_id, now + delay)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        lag = (datetime.now(timezone.utc)
+               - datetime.strptime(job["next_at"], _TS).replace(tzinfo=timezone.utc)).total_seconds()
+        self.lag_total += max(0.0, lag)
+        self.lag_max = max(self.lag_max, lag)
+
+        t0 = time.perf_counter()
+        try:
+            resp = await telegram.call(job["method"], json.loads(job["payload"]), timeout=OUTBOX_SEND_TIMEOUT_S)
+        except CircuitOpenError as e:
+            # Telegram лежит - не жжём попытки, ждём конца cooldown
+            self.breaker_deferred += 1
+            await self._reschedule(job, e.retry_in, str(e), count_attempt=False)
+            return
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            resp = {"ok": False, "error_code": None, "description": repr(e)}
+        dt = time.perf_counter() - t0
+        self.send_total += dt
+        self.send_max = max(self.send_max, dt)
+
+        if resp.get("ok"):
+            await self._done(job)
+            return
+        code = resp.get("error_code")
+        err = str(resp.get("description") or resp)[:500]
+        if code == 429:
+            retry_after = float((resp.get("parameters") or {}).get("retry_after") or 1)
+            self.rate_limited += 1
+            self.limiter.pause_chat(job["chat_id"], retry_after, time.monotonic())
+            # флуд-лимит - не ошибка сообщения, попытку не засчитываем
+            await self._reschedule(job, retry_after + 1, err, count_attempt=False)
+        elif code is not None and 400 <= code < 500:
+            logging.warning("outbox: message %s to %s rejected: %s", job["id"], job["chat_id"], err)
+            await self._fail(job, err)
+        elif job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            logging.warning("outbox: message %s to %s gave up after %d attempts: %s",
+                            job["id"], job["chat_id"], job["attempts"], err)
+            await self._fail(job, err)
+        else:
+            await self._reschedule(job, OUTBOX_RETRY_BASE_S * (2 ** (job["attempts"] - 1)), err)
+
+    async def _done(self, job):
+        async def _op(db):
+            await db.execute("DELETE FROM outbox WHERE id = ?", (job["id"],))
+        await get_pool().write(_op)
+        self.sent += 1
+
+    async def _reschedule(self, job, delay_s: float, err: str, count_attempt: bool = True):
+        async def _op(db):
+            await db.execute(
+                "UPDATE outbox SET status = 'pending', next_at = ?, last_error = ?, attempts = attempts - ? WHERE id = ?",
+                (_at(delay_s), err, 0 if count_attempt else 1, job["id"])
+            )
+        await get_pool().write(_op)
+        self.retried += 1
+
+    async def _defer(self, job, delay_s: float):
+        """Назад в pending без траты попытки."""
+        async def _op(db):
+            await db.execute(
+                "UPDATE outbox SET status = 'pending', next_at = ?, attempts = attempts - 1 WHERE id = ?",
+                (_at(delay_s), job["id"])
+            )
+        await get_pool().write(_op)
+
+    async def _fail(self, job, err: str):
+        async def _op(db):
+            await db.execute("UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", (err, job["id"]))
+        await get_pool().write(_op)
+        self.failed += 1
+
+    def stats(self):
+        done = self.sent + self.retried + self.failed
+        return {
+            "workers": max(0, len(self._tasks) - 1),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": self.in_flight,
+            "pending": self.pending_hint,
+            "claimed": self.claimed,
+            "sent": self.sent,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "breaker_deferred": self.breaker_deferred,
+            "chat_deferred": self.chat_deferred,
+            "failed": self.failed,
+            "send_avg_ms": round(self.send_total * 1000 / done, 1) if done else 0.0,
+            "send_max_ms": round(self.send_max * 1000, 1),
+            "lag_avg_s": round(self.lag_total / done, 2) if done else 0.0,
+            "lag_max_s": round(self.lag_max, 2),
+            "chats_limited": len(self.limiter),
+        }
+
+
+outbox = TelegramOutbox()
@@ -0,0 +1,279 @@
+# app/retention.py
+
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from app.config import (NOTIF_RETENTION_DAYS, SESSION_RETENTION_HOURS, RETENTION_BATCH, RETENTION_INTERVAL_S,
+                        RETENTION_VACUUM_PAGES)
+from app.db import get_pool
+from app.notifications import collapse_superseded_batch, purge_read_batch
+
+# Ретеншн eat_sessions: погасшие сессии старше SESSION_RETENTION_HOURS пачками
+# переезжают в компактный eat_sessions_archive, по пользователю копится сводка
+# в user_activity (сколько сессий, первая/последняя), освободившиеся страницы
+# возвращаются через PRAGMA incremental_vacuum.
+# Тем же проходом чистятся notifications: прочитанные старше NOTIF_RETENTION_DAYS
+# удаляются пачками, устаревшие опросы по инвайту схлопываются до последнего.
+
+
+async def create_retention_tables(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS eat_sessions_archive (
+            id INTEGER PRIMARY KEY,         -- тот же id, что был в eat_sessions
+            user_id INTEGER NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            started_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        );
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_eat_sessions_archive_user
+            ON eat_sessions_archive(user_id, started_at);
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            sessions INTEGER NOT NULL DEFAULT 0,  -- сколько сессий ушло в архив
+            first_seen TEXT,
+            last_seen TEXT
+        );
+    """)
+    # курсоры проходов ретеншна, переживают рестарт
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS retention_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """)
+
+
+async def get_state(db, name: str, default: int = 0) -> int:
+    cur = await db.execute("SELECT value FROM retention_state WHERE name = ?", (name,))
+    row = await cur.fetchone()
+    return row[0] if row else default
+
+
+async def set_state(db, name: str, value: int):
+    await db.execute(
+        "INSERT INTO retention_state (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (name, value)
+    )
+
+
+# строки одной пачки: погасшие и истёкшие до cutoff, с id не больше верхней границы пачки
+_BATCH_WHERE = "id <= ? AND active = 0 AND expires_at < ?"
+
+
+async def archive_batch(db, cutoff_s: str, limit: int):
+    """Переносит до limit старых сессий в архив. -> (перенесено, id последней)."""
+    # eat_sessions растёт по id примерно в хронологическом порядке, так что старые
+    # строки в начале таблицы и скан по rowid останавливается после limit совпадений
+    cur = await db.execute(
+        "SELECT id FROM eat_sessions WHERE active = 0 AND expires_at < ? ORDER BY id LIMIT ?",
+        (cutoff_s, limit)
+    )
+    ids = [r[0] for r in await cur.fetchall()]
+    if not ids:
+        return 0, None
+    hi = ids[-1]
+    params = (hi, cutoff_s)
+    await db.execute(f"""
+        INSERT OR REPLACE INTO eat_sessions_archive (id, user_id, lat, lon, started_at, expires_at)
+        SELECT id, user_id, lat, lon, started_at, expires_at FROM eat_sessions WHERE {_BATCH_WHERE}
+    """, params)
+    await db.execute(f"""
+        INSERT INTO user_activity (user_id, sessions, first_seen, last_seen)
+        SELECT user_id, COUNT(*), MIN(started_at), MAX(started_at) FROM eat_sessions
+        WHERE {_BATCH_WHERE}
+        GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET
+            sessions = sessions + excluded.sessions,
+            first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+            last_seen = MAX(COALESCE(last_seen, excluded.last_seen), excluded.last_seen)
+    """, params)
+    cur = await db.execute(f"DELETE FROM eat_sessions WHERE {_BATCH_WHERE}", params)
+    return cur.rowcount, hi
+
+
+async def incremental_vacuum(db, pages: int):
+    """Возвращает до pages свободных страниц ОС. -> сколько освобождено.
+
+    Только вне транзакции (pool.write(..., exclusive=True)): sqlite3.execute делает
+    один шаг pragma и освобождает одну страницу, executescript доводит её до конца.
+    """
+    cur = await db.execute("PRAGMA freelist_count")
+    before = (await cur.fetchone())[0]
+    await db.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    cur = await db.execute("PRAGMA freelist_count")
+    after = (await cur.fetchone())[0]
+    return before - after
+
+
+class RetentionStats:
+    def __init__(self):
+        self.runs = 0
+        self.batches = 0
+        self.archived_total = 0
+        self.last_run_at = None
+        self.last_run_ms = 0.0
+        self.last_archived = 0
+        self.last_batch_ms = 0.0
+        self.max_batch_ms = 0.0
+        self.pages_vacuumed = 0
+        self.errors = 0
+        self.backlog_oldest = None   # expires_at самой старой строки, ожидающей архивации
+        self.freelist_pages = None
+        self.notif_purged_total = 0
+        self.notif_collapsed_total = 0
+        self.notif_collapse_cursor = None   # id, до которого опросные уведомления уже схлопнуты (retention_state)
+
+    def as_dict(self):
+        lag_s = None
+        if self.backlog_oldest:
+            try:
+                oldest = datetime.strptime(self.backlog_oldest, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+                cutoff = datetime.now(timezone.utc) - timedelta(hours=SESSION_RETENTION_HOURS)
+                lag_s = max(0, int((cutoff - oldest).total_seconds()))
+            except ValueError:
+                pass
+        return {
+            "retention_hours": SESSION_RETENTION_HOURS,
+            "runs": self.runs,
+            "batches": self.batches,
+            "archived_total": self.archived_total,
+            "last_run_at": self.last_run_at,
+            "last_run_ms": round(self.last_run_ms, 3),
+            "last_archived": self.last_archived,
+            "last_batch_ms": round(self.last_batch_ms, 3),
+            "max_batch_ms": round(self.max_batch_ms, 3),
+            "pages_vacuumed": self.pages_vacuumed,
+            "freelist_pages": self.freelist_pages,
+            "errors": self.errors,
+            "backlog_oldest_expires_at": self.backlog_oldest,
+            "lag_s": lag_s,   # насколько самая старая строка просрочила окно ретеншна
+            "notif_retention_days": NOTIF_RETENTION_DAYS,
+            "notif_purged_total": self.notif_purged_total,
+            "notif_collapsed_total": self.notif_collapsed_total,
+            "notif_collapse_cursor": self.notif_collapse_cursor,
+        }
+
+
+retention_stats = RetentionStats()
+
+
+async def run_retention_once(stop_event: asyncio.Event = None, now: datetime = None):
+    """Один проход: пачки до исчерпания (или stop_event), затем incremental vacuum."""
+    st = retention_stats
+    pool = get_pool()
+    now = now or datetime.now(timezone.utc)
+    cutoff_s = (now - timedelta(hours=SESSION_RETENTION_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+    t_run = time.perf_counter()
+    archived = 0
+    while stop_event is None or not stop_event.is_set():
+        t0 = time.perf_counter()
+
+        async def _batch(db):
+            return await archive_batch(db, cutoff_s, RETENTION_BATCH)
+        n, _ = await pool.write(_batch)
+        dt = (time.perf_counter() - t0) * 1000
+        if n:
+            st.batches += 1
+            st.last_batch_ms = dt
+            st.max_batch_ms = max(st.max_batch_ms, dt)
+            archived += n
+            st.archived_total += n
+        if n < RETENTION_BATCH:
+            break
+        # между пачками отдаём writer остальным запросам
+        await asyncio.sleep(0)
+
+    if stop_event is None or not stop_event.is_set():
+        await run_notification_retention(now, stop_event)
+
+    if RETENTION_VACUUM_PAGES > 0:
+        async def _vacuum(db):
+            return await incremental_vacuum(db, RETENTION_VACUUM_PAGES)
+        st.pages_vacuumed += await pool.write(_vacuum, exclusive=True)
+
+    async with pool.reader() as db:
+        cur = await db.execute("SELECT expires_at FROM eat_sessions WHERE active = 0 ORDER BY id LIMIT 1")
+        row = await cur.fetchone()
+        st.backlog_oldest = row[0] if row else None
+        cur = await db.execute("PRAGMA freelist_count")
+        st.freelist_pages = (await cur.fetchone())[0]
+
+    st.runs += 1
+    st.last_archived = archived
+    st.last_run_at = now.strftime('%Y-%m-%d %H:%M:%S')
+    st.last_run_ms = (time.perf_counter() - t_run) * 1000
+    return archived
+
+
+async def run_notification_retention(now: datetime, stop_event: asyncio.Event = None):
+    """Схлопывает устаревшие опросы и удаляет старые прочитанные уведомления пачками. -> (схлопнуто, удалено)."""
+    st = retention_stats
+    pool = get_pool()
+    collapsed = 0
+    while stop_event is None or not stop_event.is_set():
+        # курсор читается и сдвигается в той же транзакции, что и удаление пачки
+        async def _collapse(db):
+            after_id = await get_state(db, "notif_collapse_cursor")
+            n, hi = await collapse_superseded_batch(db, after_id, RETENTION_BATCH)
+            if hi is not None:
+                await set_state(db, "notif_collapse_cursor", hi)
+            return n, hi, after_id
+        n, hi, after_id = await pool.write(_collapse)
+        if hi is None:
+            st.notif_collapse_cursor = after_id
+            break
+        st.notif_collapse_cursor = hi
+        collapsed += n
+        st.notif_collapsed_total += n
+        await asyncio.sleep(0)
+
+    purged = 0
+    if NOTIF_RETENTION_DAYS > 0:
+        cutoff_s = (now - timedelta(days=NOTIF_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        # id растут вместе с created_at: первая строка моложе cutoff ограничивает пачки сверху,
+        # и проход не сканирует свежую часть таблицы
+        async with pool.reader() as db:
+            cur = await db.execute("SELECT id FROM notifications WHERE created_at >= ? ORDER BY id LIMIT 1", (cutoff_s,))
+            row = await cur.fetchone()
+        below_id = row[0] if row else 2 ** 63 - 1
+        after_id = 0
+        while stop_event is None or not stop_event.is_set():
+            async def _purge(db):
+                return await purge_read_batch(db, after_id, below_id, cutoff_s, RETENTION_BATCH)
+            n, hi = await pool.write(_purge)
+            if hi is None:
+                break
+            after_id = hi
+            purged += n
+            st.notif_purged_total += n
+            await asyncio.sleep(0)
+    if collapsed or purged:
+        logging.info("retention: notifications collapsed %d, purged %d", collapsed, purged)
+    return collapsed, purged
+
+
+async def retention_loop(stop_event: asyncio.Event):
+    try:
+        while not stop_event.is_set():
+            try:
+                n = await run_retention_once(stop_event)
+                if n:
+                    logging.info("retention: archived %d sessions", n)
+            except Exception:
+                retention_stats.errors += 1
+                logging.exception("retention_loop: pass failed")
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=RETENTION_INTERVAL_S)
+            except asyncio.TimeoutError:
+                continue
+    except asyncio.CancelledError:
+        logging.info("retention_loop cancelled")
+        return
@@ -0,0 +1,67 @@
+# app/reviews.py
+
+import logging
+
+# Счётчики реакций по пользователю: review_counts меняется в той же транзакции,
+# что и reviews, так что профиль читает несколько строк по первичному ключу
+# вместо GROUP BY по всем отзывам. Сверка/пересчёт: python -m app.maintenance.
+
+REBUILD_SQL = """
+    INSERT INTO review_counts (target_user_id, reaction, cnt)
+    SELECT target_user_id, reaction, COUNT(*) FROM reviews GROUP BY target_user_id, reaction
+"""
+
+
+async def create_review_counts_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS review_counts (
+            target_user_id INTEGER NOT NULL,
+            reaction TEXT NOT NULL,
+            cnt INTEGER NOT NULL,
+            PRIMARY KEY (target_user_id, reaction)
+        ) WITHOUT ROWID;
+    """)
+    # миграция: пустая таблица при непустых reviews - досчитываем один раз
+    cur = await db.execute("SELECT EXISTS(SELECT 1 FROM review_counts), EXISTS(SELECT 1 FROM reviews)")
+    has_counts, has_reviews = await cur.fetchone()
+    if has_reviews and not has_counts:
+        await db.execute(REBUILD_SQL)
+        logging.info("init_db: review_counts backfilled from reviews")
+
+
+async def add_review(db, reviewer_id: int, target_id: int, reaction: str) -> bool:
+    """Добавить реакцию (повтор - не ошибка). -> True, если строка добавлена."""
+    cur = await db.execute(
+        "INSERT OR IGNORE INTO reviews (reviewer_id, target_user_id, reaction, created_at) VALUES (?, ?, ?, datetime('now'))",
+        (reviewer_id, target_id, reaction)
+    )
+    if not cur.rowcount:
+        return False
+    await db.execute(
+        "INSERT INTO review_counts (target_user_id, reaction, cnt) VALUES (?, ?, 1) "
+        "ON CONFLICT(target_user_id, reaction) DO UPDATE SET cnt = cnt + 1",
+        (target_id, reaction)
+    )
+    return True
+
+
+async def remove_review(db, reviewer_id: int, target_id: int, reaction: str) -> bool:
+    """Снять реакцию. -> True, если она была."""
+    cur = await db.execute(
+        "DELETE FROM reviews WHERE reviewer_id = ? AND target_user_id = ? AND reaction = ?",
+        (reviewer_id, target_id, reaction)
+    )
+    if not cur.rowcount:
+        return False
+    await db.execute(
+        "UPDATE review_counts SET cnt = cnt - 1 WHERE target_user_id = ? AND reaction = ?", (target_id, reaction)
+    )
+    await db.execute(
+        "DELETE FROM review_counts WHERE target_user_id = ? AND reaction = ? AND cnt <= 0", (target_id, reaction)
+    )
+    return True
+
+
+async def get_review_counts(db, user_id: int) -> dict:
+    cur = await db.execute("SELECT reaction, cnt FROM review_counts WHERE target_user_id = ?", (user_id,))
+    return {r[0]: int(r[1]) for r in await cur.fetchall()}
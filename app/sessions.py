@@ -0,0 +1,290 @@
+# app/sessions.py
+
+import math
+import heapq
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+# R*Tree по активным eat_sessions: в индексе только живые сессии, поэтому /nearby
+# - это проба по индексу, а не скан всей истории сессий.
+# id в R*Tree совпадает с eat_sessions.id; точка хранится как вырожденный прямоугольник.
+RTREE_TABLE = "eat_sessions_rtree"
+
+# сколько живёт сессия после /start или heartbeat
+SESSION_TTL = timedelta(hours=1)
+
+
+async def create_rtree(db):
+    await db.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} USING rtree(
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon
+        );
+    """)
+
+
+async def rebuild_rtree(db, now_s: str):
+    """Пересобирает R*Tree из eat_sessions (вызывается при старте)."""
+    await db.execute("UPDATE eat_sessions SET active = 0 WHERE active = 1 AND expires_at <= ?", (now_s,))
+    await db.execute(f"DELETE FROM {RTREE_TABLE}")
+    await db.execute(f"""
+        INSERT INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, lat, lat, lon, lon FROM eat_sessions WHERE active = 1
+    """)
+
+
+# users.last_seen - последняя активность (старт сессии или heartbeat с записью), индексирована:
+# "недавние пользователи" - обратный проход по idx_users_last_seen вместо GROUP BY по истории.
+# Для миграции: последняя сессия, а для заархивированной истории - user_activity.
+USER_LAST_SEEN_SQL = """
+    SELECT user_id, MAX(last_seen) AS last_seen FROM (
+        SELECT user_id, MAX(started_at) AS last_seen FROM eat_sessions GROUP BY user_id
+        UNION ALL
+        SELECT user_id, last_seen FROM user_activity
+    ) GROUP BY user_id
+"""
+
+BACKFILL_LAST_SEEN_SQL = f"""
+    UPDATE users SET last_seen = s.last_seen
+    FROM ({USER_LAST_SEEN_SQL}) AS s
+    WHERE s.user_id = users.id AND users.last_seen IS NULL
+"""
+
+
+async def migrate_users_last_seen(db):
+    """Добавляет users.last_seen + индекс; при добавлении колонки заполняет её из истории."""
+    cur = await db.execute("PRAGMA table_info(users)")
+    if "last_seen" not in [r[1] for r in await cur.fetchall()]:
+        await db.execute("ALTER TABLE users ADD COLUMN last_seen TEXT")
+        await db.execute(BACKFILL_LAST_SEEN_SQL)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+
+
+async def touch_user(db, user_id: int, now_s: str):
+    await db.execute("UPDATE users SET last_seen = ? WHERE id = ?", (now_s, user_id))
+
+
+async def rtree_add(db, sid: int, lat: float, lon: float):
+    await db.execute(
+        f"INSERT OR REPLACE INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+        (sid, lat, lat, lon, lon)
+    )
+
+
+async def deactivate_user_sessions(db, user_id: int):
+    """Снимает активные сессии пользователя и убирает их из R*Tree. Возвращает их id."""
+    cur = await db.execute("SELECT id FROM eat_sessions WHERE user_id = ? AND active = 1", (user_id,))
+    ids = [(row[0],) for row in await cur.fetchall()]
+    if ids:
+        await db.executemany(f"DELETE FROM {RTREE_TABLE} WHERE id = ?", ids)
+        await db.executemany("UPDATE eat_sessions SET active = 0 WHERE id = ?", ids)
+    return [i for (i,) in ids]
+
+
+async def start_user_session(db, user_id: int, lat: float, lon: float, now_s: str, expires_s: str):
+    """Новая сессия вместо активных: -> (id снятых сессий, id новой)."""
+    old_ids = await deactivate_user_sessions(db, user_id)
+    cur = await db.execute(
+        "INSERT INTO eat_sessions (user_id, lat, lon, started_at, expires_at, active) VALUES (?, ?, ?, ?, ?, 1)",
+        (user_id, lat, lon, now_s, expires_s)
+    )
+    await rtree_add(db, cur.lastrowid, lat, lon)
+    await touch_user(db, user_id, now_s)
+    return old_ids, cur.lastrowid
+
+
+async def expire_sessions(db, now_s: str):
+    """Гасит истёкшие сессии. Кандидатов ищем через R*Tree (там только активные),
+    а не сканом eat_sessions; обновления - по первичному ключу."""
+    cur = await db.execute(f"""
+        SELECT r.id FROM {RTREE_TABLE} r
+        JOIN eat_sessions e ON e.id = r.id
+        WHERE e.expires_at <= ?
+    """, (now_s,))
+    ids = [(row[0],) for row in await cur.fetchall()]
+    if ids:
+        await db.executemany("UPDATE eat_sessions SET active = 0 WHERE id = ?", ids)
+        await db.executemany(f"DELETE FROM {RTREE_TABLE} WHERE id = ?", ids)
+    return [i for (i,) in ids]
+
+
+async def expire_session_ids(db, ids, now_s: str):
+    """Гасит ровно эти сессии, если они всё ещё активны и срок вышел (heartbeat мог продлить)."""
+    expired = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        marks = ",".join("?" for _ in chunk)
+        cur = await db.execute(
+            f"SELECT id FROM eat_sessions WHERE id IN ({marks}) AND active = 1 AND expires_at <= ?",
+            (*chunk, now_s)
+        )
+        expired += [row[0] for row in await cur.fetchall()]
+    if expired:
+        rows = [(i,) for i in expired]
+        await db.executemany("UPDATE eat_sessions SET active = 0 WHERE id = ?", rows)
+        await db.executemany(f"DELETE FROM {RTREE_TABLE} WHERE id = ?", rows)
+    return expired
+
+
+def bbox(lat: float, lon: float, radius_km: float):
+    """(min_lat, max_lat, min_lon, max_lon) для окружности radius_km вокруг точки."""
+    lat_deg = radius_km / 111.0
+    lon_deg = radius_km / (111.0 * max(0.00001, math.cos(math.radians(lat))))
+    return lat - lat_deg, lat + lat_deg, lon - lon_deg, lon + lon_deg
+
+
+# R*Tree хранит координаты во float32 и округляет границы наружу,
+# поэтому ищем пересечение прямоугольников, а точную отсечку делает haversine.
+NEARBY_RTREE_SQL = f"""
+    SELECT e.id AS sid, e.lat, e.lon, e.started_at, e.expires_at, u.id AS user_id, u.tg_id,
+           u.name AS name, u.avatar AS avatar, u.username AS username, u.age AS age
+    FROM {RTREE_TABLE} r
+    JOIN eat_sessions e ON e.id = r.id
+    JOIN users u ON u.id = e.user_id
+    WHERE r.max_lat >= ? AND r.min_lat <= ?
+      AND r.max_lon >= ? AND r.min_lon <= ?
+      AND e.active = 1 AND e.expires_at > ?
+    LIMIT ?
+"""
+
+
+# то же, но ближайшие первыми (equirectangular-приближение; точную дистанцию считает haversine),
+# чтобы LIMIT отсекал дальних, а не случайных
+NEARBY_RTREE_NEAREST_SQL = f"""
+    SELECT e.id AS sid, e.lat, e.lon, e.started_at, e.expires_at, u.id AS user_id, u.tg_id,
+           u.name AS name, u.avatar AS avatar, u.username AS username, u.age AS age
+    FROM {RTREE_TABLE} r
+    JOIN eat_sessions e ON e.id = r.id
+    JOIN users u ON u.id = e.user_id
+    WHERE r.max_lat >= ? AND r.min_lat <= ?
+      AND r.max_lon >= ? AND r.min_lon <= ?
+      AND e.active = 1 AND e.expires_at > ? AND u.tg_id != ?
+    ORDER BY (e.lat - ?) * (e.lat - ?) + (e.lon - ?) * (e.lon - ?) * ?, e.id
+    LIMIT ?
+"""
+
+
+async def nearest_from_rtree(db, lat: float, lon: float, radius_km: float, now_s: str,
+                             exclude_tg: int = None, limit: int = 100):
+    """Живые сессии в радиусе из R*Tree, ближайшие первыми: строки aiosqlite.Row."""
+    min_lat, max_lat, min_lon, max_lon = bbox(lat, lon, radius_km)
+    cos2 = math.cos(math.radians(lat)) ** 2
+    cur = await db.execute(NEARBY_RTREE_NEAREST_SQL, (
+        min_lat, max_lat, min_lon, max_lon, now_s, exclude_tg if exclude_tg is not None else -1,
+        lat, lat, lon, lon, cos2, limit))
+    return await cur.fetchall()
+
+
+# все живые сессии с полями пользователя - прогрев и сверка in-memory сетки (app/geo.py)
+LIVE_SESSIONS_SQL = f"""
+    SELECT e.id AS sid, e.lat, e.lon, e.started_at, e.expires_at, u.id AS user_id, u.tg_id,
+           u.name AS name, u.avatar AS avatar, u.username AS username, u.age AS age
+    FROM {RTREE_TABLE} r
+    JOIN eat_sessions e ON e.id = r.id
+    JOIN users u ON u.id = e.user_id
+    WHERE e.active = 1 AND e.expires_at > ?
+"""
+
+
+def _parse_ts(s: str) -> datetime:
+    return datetime.strptime(s, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+
+class ExpiryHeap:
+    """Min-heap дедлайнов живых сессий (expires_at, sid).
+
+    Продление/закрытие не ищет запись в куче: актуальный дедлайн хранится в
+    _deadline, а устаревшие записи отбрасываются при извлечении (lazy deletion).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadline = {}   # sid -> expires_at
+        self._wakeup = asyncio.Event()
+        self.expired = 0
+        self.stale_pops = 0
+        self.late_total = 0.0   # секунды между дедлайном и фактическим гашением
+        self.late_max = 0.0
+        self.sweeps = 0
+        self.sweep_found = 0    # сессии, которые погасил страховочный sweep, а не куча
+
+    def __len__(self):
+        return len(self._deadline)
+
+    def load(self, items):
+        self._deadline = {sid: exp for sid, exp in items}
+        self._heap = [(exp, sid) for sid, exp in self._deadline.items()]
+        heapq.heapify(self._heap)
+        self._wakeup = asyncio.Event()  # привязывается к loop текущего lifespan
+
+    def push(self, sid: int, expires_s: str):
+        self._deadline[sid] = expires_s
+        heapq.heappush(self._heap, (expires_s, sid))
+        if self._heap[0] == (expires_s, sid):
+            self._wakeup.set()   # новый ближайший дедлайн - будим таск раньше
+        # устаревших записей стало слишком много - перестраиваем
+        if len(self._heap) > 2 * len(self._deadline) + 1024:
+            self._heap = [(exp, sid) for sid, exp in self._deadline.items()]
+            heapq.heapify(self._heap)
+
+    def discard(self, sids):
+        for sid in sids:
+            self._deadline.pop(sid, None)
+
+    def next_deadline(self):
+        while self._heap:
+            exp, sid = self._heap[0]
+            if self._deadline.get(sid) == exp:
+                return exp
+            heapq.heappop(self._heap)
+            self.stale_pops += 1
+        return None
+
+    def pop_due(self, now_s: str):
+        due = []
+        while True:
+            exp = self.next_deadline()
+            if exp is None or exp > now_s:
+                return due
+            _, sid = heapq.heappop(self._heap)
+            del self._deadline[sid]
+            due.append((sid, exp))
+
+    def record_expired(self, due, now: datetime):
+        for _, exp in due:
+            late = max(0.0, (now - _parse_ts(exp)).total_seconds())
+            self.late_total += late
+            self.late_max = max(self.late_max, late)
+        self.expired += len(due)
+
+    async def wait(self, timeout: float):
+        """Спим до timeout или до push с более ранним дедлайном."""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def seconds_until_next(self, now: datetime, cap: float):
+        exp = self.next_deadline()
+        if exp is None:
+            return cap
+        # expires_at с точностью до секунды: гасим, когда now_s >= expires_at
+        return min(cap, max(0.0, (_parse_ts(exp) - now).total_seconds()))
+
+    def stats(self):
+        return {
+            "tracked": len(self._deadline),
+            "heap_entries": len(self._heap),
+            "next_deadline": self.next_deadline(),
+            "expired": self.expired,
+            "stale_pops": self.stale_pops,
+            "late_avg_ms": round(self.late_total * 1000 / self.expired, 1) if self.expired else 0.0,
+            "late_max_ms": round(self.late_max * 1000, 1),
+            "sweeps": self.sweeps,
+            "sweep_found": self.sweep_found,
+        }
+
+
+session_expiry = ExpiryHeap()
@@ -0,0 +1,155 @@
+# app/tag_index.py
+
+import sys
+import heapq
+import bisect
+import logging
+from array import array
+from itertools import chain
+from collections import Counter
+
+# In-memory инвертированный индекс тегов для /api/users/similar:
+# tag -> отсортированный array('i') user_id. Кандидаты считаются одним проходом
+# Counter по спискам тегов пользователя (цикл в C), top-k - heapq.nlargest.
+# last_seen (users.last_seen, см. app/sessions.py) хранится рядом и обновляется после
+# коммита /start и heartbeat, так что профили дочитываются только для top-k.
+# SQLite остаётся источником правды: индекс строится при старте, правится после
+# коммита /api/profile/tags; расхождение видно в /api/stats/tag_index/check
+# (починка - POST /api/stats/tag_index/repair).
+
+LAST_SEEN_SQL = "SELECT id, last_seen FROM users WHERE last_seen IS NOT NULL"
+
+METRICS = ("overlap", "jaccard")
+
+
+class TagIndex:
+    """Все методы синхронные и вызываются из event loop, блокировки не нужны."""
+
+    def __init__(self):
+        self.ready = False
+        self._postings = {}    # tag -> array('i') user_id по возрастанию
+        self._tags = {}        # user_id -> tuple(tags)
+        self._last_seen = {}   # user_id -> 'YYYY-mm-dd HH:MM:SS'
+        self.queries = 0
+        self.candidates = 0
+        self.updates = 0
+
+    def load(self, tag_rows, last_seen_rows):
+        """tag_rows: (user_id, tag), last_seen_rows: (user_id, last_seen)."""
+        by_tag = {}
+        by_user = {}
+        for user_id, tag in tag_rows:
+            by_tag.setdefault(tag, []).append(user_id)
+            by_user.setdefault(user_id, []).append(tag)
+        self._postings = {t: array("i", sorted(ids)) for t, ids in by_tag.items()}
+        self._tags = {u: tuple(ts) for u, ts in by_user.items()}
+        self._last_seen = {u: ls for u, ls in last_seen_rows if ls}
+        self.ready = True
+
+    def tags_of(self, user_id: int):
+        return self._tags.get(user_id, ())
+
+    def set_tags(self, user_id: int, tags):
+        """Заменить теги пользователя (после коммита /api/profile/tags)."""
+        old = set(self._tags.get(user_id, ()))
+        new = set(tags)
+        for t in old - new:
+            ids = self._postings.get(t)
+            if ids is None:
+                continue
+            i = bisect.bisect_left(ids, user_id)
+            if i < len(ids) and ids[i] == user_id:
+                del ids[i]
+            if not ids:
+                del self._postings[t]
+        for t in new - old:
+            ids = self._postings.setdefault(t, array("i"))
+            i = bisect.bisect_left(ids, user_id)
+            if i == len(ids) or ids[i] != user_id:
+                ids.insert(i, user_id)
+        if tags:
+            self._tags[user_id] = tuple(tags)
+        else:
+            self._tags.pop(user_id, None)
+        self.updates += 1
+
+    def touch(self, user_id: int, seen_at: str):
+        """Старт сессии / heartbeat: last_seen только растёт."""
+        cur = self._last_seen.get(user_id)
+        if cur is None or seen_at > cur:
+            self._last_seen[user_id] = seen_at
+
+    def last_seen(self, user_id: int):
+        return self._last_seen.get(user_id)
+
+    def similar(self, user_id: int, k: int, metric: str = "overlap"):
+        """-> [(user_id, common, score)] по убыванию (score, last_seen).
+
+        overlap: score = число общих тегов; jaccard: common / |A ∪ B|.
+        """
+        self.queries += 1
+        mine = self._tags.get(user_id)
+        if not mine or k <= 0:
+            return []
+        counts = Counter(chain.from_iterable(self._postings.get(t, ()) for t in mine))
+        counts.pop(user_id, None)
+        self.candidates += len(counts)
+        ls = self._last_seen
+        if metric == "jaccard":
+            n = len(mine)
+            tags = self._tags
+
+            def key(item):
+                uid, c = item
+                return c / (n + len(tags[uid]) - c), ls.get(uid) or ""
+        else:
+            def key(item):
+                return item[1], ls.get(item[0]) or ""
+        top = heapq.nlargest(k, counts.items(), key=key)
+        return [(uid, c, key((uid, c))[0]) for uid, c in top]
+
+    def snapshot(self):
+        """user_id -> frozenset(tags), для сверки с БД."""
+        return {u: frozenset(ts) for u, ts in self._tags.items()}
+
+    def stats(self, top: int = 10):
+        sizes = sorted(((len(ids), t) for t, ids in self._postings.items()), reverse=True)
+        nbytes = sum(sys.getsizeof(ids) for ids in self._postings.values())
+        return {
+            "ready": self.ready,
+            "tags": len(self._postings),
+            "users": len(self._tags),
+            "postings": sum(n for n, _ in sizes),
+            "postings_bytes": nbytes,
+            "last_seen_users": len(self._last_seen),
+            "largest": [{"tag": t, "users": n} for n, t in sizes[:top]],
+            "queries": self.queries,
+            "avg_candidates": round(self.candidates / self.queries, 1) if self.queries else 0.0,
+            "updates": self.updates,
+        }
+
+
+def diff_with_db(index: TagIndex, db_rows, sample: int = 20):
+    """Сравнивает теги в индексе с user_tags (строки (user_id, tag))."""
+    db_map = {}
+    for user_id, tag in db_rows:
+        db_map.setdefault(user_id, set()).add(tag)
+    mem_map = index.snapshot()
+    missing = sorted(set(db_map) - set(mem_map))
+    stale = sorted(set(mem_map) - set(db_map))
+    mismatched = sorted(u for u in set(db_map) & set(mem_map) if db_map[u] != mem_map[u])
+    ok = not (missing or stale or mismatched)
+    if not ok:
+        logging.warning("tag index drift: missing=%d stale=%d mismatched=%d",
+                        len(missing), len(stale), len(mismatched))
+    return {
+        "ok": ok,
+        "db": len(db_map),
+        "memory": len(mem_map),
+        "missing": missing[:sample],
+        "stale": stale[:sample],
+        "mismatched": mismatched[:sample],
+    }
+
+
+tag_index = TagIndex()
@@ -0,0 +1,104 @@
+# app/tags.py
+
+import heapq
+import logging
+
+# Популярность тегов: tag_counts ведётся в той же транзакции, что и user_tags
+# (/api/profile/tags), поэтому /api/tags читает первые limit строк индекса по cnt,
+# а /api/tags/suggest - диапазон первичного ключа по префиксу (или индекс по cnt, если
+# тегов с префиксом много), без GROUP BY по user_tags.
+
+# префикс с не больше чем столькими тегами ранжируется по диапазону первичного ключа;
+# если тегов больше - идём по индексу (cnt DESC, tag) от самых популярных, но не дальше
+# SUGGEST_WALK_MAX записей; не нашли limit тегов - сортировка всего диапазона префикса.
+# Итого suggest читает не больше SUGGEST_SCAN_MAX + 1 + SUGGEST_WALK_MAX + (тегов с префиксом) строк;
+# на 500k тегов обход индекса - ~2 мс при любом распределении cnt.
+SUGGEST_SCAN_MAX = 1000
+SUGGEST_WALK_MAX = 5000
+
+TOP_TAGS_SQL = "SELECT tag, cnt FROM tag_counts ORDER BY cnt DESC, tag ASC LIMIT ?"
+
+# {upper} - "AND tag < ?" или пусто, если у диапазона префикса нет верхней границы (prefix_range)
+SUGGEST_RANGE_SQL = f"SELECT tag, cnt FROM tag_counts WHERE tag >= ? {{upper}} ORDER BY tag LIMIT {SUGGEST_SCAN_MAX + 1}"
+
+# короткий префикс с тысячами тегов: популярные с этим префиксом встречаются в начале индекса
+SUGGEST_BY_CNT_SQL = f"""
+    SELECT tag, cnt FROM (
+        SELECT tag, cnt FROM tag_counts INDEXED BY idx_tag_counts_cnt
+        ORDER BY cnt DESC, tag ASC LIMIT {SUGGEST_WALK_MAX}
+    )
+    WHERE tag >= ? {{upper}}
+    ORDER BY cnt DESC, tag ASC LIMIT ?
+"""
+
+# популярных с префиксом в начале индекса нет: top-k сортировка по диапазону первичного ключа
+SUGGEST_RANGE_TOP_SQL = "SELECT tag, cnt FROM tag_counts NOT INDEXED WHERE tag >= ? {upper} ORDER BY cnt DESC, tag ASC LIMIT ?"
+
+REBUILD_SQL = "INSERT INTO tag_counts (tag, cnt) SELECT tag, COUNT(*) FROM user_tags GROUP BY tag"
+
+
+async def create_tag_counts_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tag_counts (
+            tag TEXT PRIMARY KEY,
+            cnt INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tag_counts_cnt
+            ON tag_counts(cnt DESC, tag);
+    """)
+    # миграция: пустая таблица при непустых user_tags - досчитываем один раз
+    cur = await db.execute("SELECT EXISTS(SELECT 1 FROM tag_counts), EXISTS(SELECT 1 FROM user_tags)")
+    has_counts, has_tags = await cur.fetchone()
+    if has_tags and not has_counts:
+        await db.execute(REBUILD_SQL)
+        logging.info("init_db: tag_counts backfilled from user_tags")
+
+
+async def apply_tag_diff(db, removed, added):
+    """Поправить счётчики после удаления/добавления строк user_tags (в той же транзакции)."""
+    if removed:
+        marks = ",".join("?" for _ in removed)
+        await db.execute(f"UPDATE tag_counts SET cnt = cnt - 1 WHERE tag IN ({marks})", list(removed))
+        await db.execute(f"DELETE FROM tag_counts WHERE tag IN ({marks}) AND cnt <= 0", list(removed))
+    if added:
+        await db.executemany(
+            "INSERT INTO tag_counts (tag, cnt) VALUES (?, 1) ON CONFLICT(tag) DO UPDATE SET cnt = cnt + 1",
+            [(t,) for t in added]
+        )
+
+
+async def suggest_tags(db, prefix: str, limit: int):
+    """Самые популярные теги с префиксом, по (cnt DESC, tag)."""
+    lo, hi = prefix_range(prefix)
+    upper, bounds = ("AND tag < ?", (lo, hi)) if hi is not None else ("", (lo,))
+    cur = await db.execute(SUGGEST_RANGE_SQL.format(upper=upper), bounds)
+    rows = await cur.fetchall()
+    if len(rows) <= SUGGEST_SCAN_MAX:
+        # все теги с префиксом уже прочитаны - ранжируем их сами
+        return heapq.nsmallest(limit, rows, key=lambda r: (-r[1], r[0]))
+    cur = await db.execute(SUGGEST_BY_CNT_SQL.format(upper=upper), (*bounds, limit))
+    rows = await cur.fetchall()
+    if len(rows) == limit:
+        return rows
+    cur = await db.execute(SUGGEST_RANGE_TOP_SQL.format(upper=upper), (*bounds, limit))
+    return await cur.fetchall()
+
+
+_MAX_CHAR = 0x10FFFF
+_SURROGATES = range(0xD800, 0xE000)
+
+
+def prefix_range(prefix: str):
+    """-> (lo, hi): все строки s с префиксом prefix лежат в lo <= s < hi; hi=None - без верхней границы.
+
+    Порядок - по кодовым точкам (BINARY над UTF-8); суррогаты в UTF-8 не кодируются и пропускаются.
+    """
+    head = prefix.rstrip(chr(_MAX_CHAR))
+    if not head:
+        return prefix, None
+    nxt = ord(head[-1]) + 1
+    if nxt in _SURROGATES:
+        nxt = _SURROGATES.stop
+    return prefix, head[:-1] + chr(nxt)
@@ -1,93 +1,245 @@
 # app/telegram_utils.py
 
 import json
+import time
+import socket
 import asyncio
-import aiohttp 
+import aiohttp
 import logging
-import aiosqlite
 import html as _html
 
-from routes import DB_PATH
-from app.config import BOT_TOKEN
+from app.config import (BOT_TOKEN, TELEGRAM_API_BASE, TELEGRAM_BREAKER_COOLDOWN_S, TELEGRAM_BREAKER_FAILURES,
+                        TELEGRAM_DNS_TTL_S, TELEGRAM_POOL_LIMIT, TELEGRAM_TIMEOUT_S)
 
-import socket
 
-# helper - try to use shared session if available
-async def send_telegram_message(chat_id: int, text: str, reply_markup: dict = None, sess: aiohttp.ClientSession = None):
-    if not BOT_TOKEN:
-        logging.warning("send_telegram_message: BOT_TOKEN not set")
-        return None
+class CircuitOpenError(Exception):
+    """Bot API недоступен (breaker открыт) - запрос не отправлялся."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"telegram circuit open, retry in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """closed -> open после failures подряд сетевых ошибок/таймаутов/5xx;
+    через cooldown_s - half_open: один пробный запрос, успех закрывает, ошибка снова открывает."""
+
+    def __init__(self, failures: int, cooldown_s: float):
+        self.failures = failures
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._probe = False
+
+    def before(self):
+        """Разрешить запрос или бросить CircuitOpenError."""
+        if self.state == "closed":
+            return
+        now = time.monotonic()
+        retry_in = self.opened_at + self.cooldown_s - now
+        if self.state == "open" and retry_in <= 0:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probe:
+            self._probe = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(max(retry_in, 1.0))
+
+    def release(self):
+        # пробный запрос прерван (отмена) - результата нет, пропускаем следующий
+        self._probe = False
+
+    def success(self):
+        self.consecutive = 0
+        self._probe = False
+        self.state = "closed"
+
+    def failure(self):
+        self.consecutive += 1
+        self._probe = False
+        if self.state == "half_open" or self.consecutive >= self.failures:
+            if self.state != "open":
+                self.opens += 1
+                logging.warning("telegram circuit open (%d consecutive failures)", self.consecutive)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
+
+
+class MethodStats:
+    __slots__ = ("calls", "ok", "api_errors", "http_5xx", "timeouts", "network", "rate_limited",
+                 "total_s", "max_s", "last_error")
+
+    def __init__(self):
+        self.calls = self.ok = self.api_errors = self.http_5xx = 0
+        self.timeouts = self.network = self.rate_limited = 0
+        self.total_s = self.max_s = 0.0
+        self.last_error = None
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "ok": self.ok,
+            "api_errors": self.api_errors,     # ok=false с кодом < 500 (кроме 429)
+            "rate_limited": self.rate_limited,
+            "http_5xx": self.http_5xx,
+            "timeouts": self.timeouts,
+            "network": self.network,
+            "avg_ms": round(self.total_s * 1000 / self.calls, 1) if self.calls else 0.0,
+            "max_ms": round(self.max_s * 1000, 1),
+            "last_error": self.last_error,
+        }
+
+
+class TelegramClient:
+    """Единственный HTTP-клиент Bot API: одна сессия с keep-alive пулом и DNS-кэшем,
+    метрики по методам и circuit breaker. Открывается/закрывается в lifespan."""
+
+    def __init__(self, token: str = BOT_TOKEN, base: str = TELEGRAM_API_BASE):
+        self.token = token
+        self.base = base.rstrip("/")
+        self.breaker = CircuitBreaker(TELEGRAM_BREAKER_FAILURES, TELEGRAM_BREAKER_COOLDOWN_S)
+        self.methods = {}
+        self._sess = None
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    safe_text = _html.escape(text)
-    payload = {"chat_id": chat_id, "text": safe_text, "parse_mode": "HTML"}
+    async def start(self):
+        if self._sess is not None:
+            return
+        connector = aiohttp.TCPConnector(limit=TELEGRAM_POOL_LIMIT, family=socket.AF_INET,
+                                         use_dns_cache=True, ttl_dns_cache=TELEGRAM_DNS_TTL_S,
+                                         keepalive_timeout=60)
+        self._sess = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self._sess is not None:
+            await self._sess.close()
+            self._sess = None
+
+    async def call(self, method: str, payload: dict, timeout: float = TELEGRAM_TIMEOUT_S) -> dict:
+        """Один POST к Bot API без повторов (повторы решает вызывающий, см. app/outbox.py).
+
+        -> json ответа; для не-json ответа {"ok": False, "error_code": <http status>}.
+        Сетевые ошибки и таймаут пробрасываются, при открытом breaker - CircuitOpenError.
+        """
+        if not self.token:
+            return {"ok": False, "error_code": None, "description": "BOT_TOKEN not set"}
+        if self._sess is None:
+            raise RuntimeError("TelegramClient is not started")
+        self.breaker.before()
+        st = self.methods.get(method)
+        if st is None:
+            st = self.methods[method] = MethodStats()
+        st.calls += 1
+        t0 = time.perf_counter()
+        try:
+            async with self._sess.post(f"{self.base}/bot{self.token}/{method}", json=payload,
+                                       timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                try:
+                    j = await resp.json(content_type=None)
+                except Exception:
+                    j = {"ok": False, "error_code": resp.status, "description": "non-json response"}
+        except asyncio.TimeoutError:
+            st.timeouts += 1
+            st.last_error = "timeout"
+            self.breaker.failure()
+            raise
+        except aiohttp.ClientError as e:
+            st.network += 1
+            st.last_error = repr(e)[:200]
+            self.breaker.failure()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            st.total_s += dt
+            st.max_s = max(st.max_s, dt)
+
+        code = j.get("error_code") or 0
+        if j.get("ok"):
+            st.ok += 1
+        elif code >= 500:
+            st.http_5xx += 1
+        elif code == 429:
+            st.rate_limited += 1
+        else:
+            st.api_errors += 1
+        if not j.get("ok"):
+            st.last_error = str(j.get("description") or code)[:200]
+        # 5xx - Telegram нездоров; 4xx (в т.ч. 429) - живой ответ
+        if code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return j
+
+    def stats(self):
+        return {
+            "base": self.base,
+            "breaker": self.breaker.stats(),
+            "methods": {m: st.as_dict() for m, st in sorted(self.methods.items())},
+        }
+
+
+telegram = TelegramClient()
+
+
+def message_payload(chat_id: int, text: str, reply_markup: dict = None) -> dict:
+    """Параметры sendMessage: текст экранируется под parse_mode=HTML."""
+    payload = {"chat_id": chat_id, "text": _html.escape(text), "parse_mode": "HTML"}
     if reply_markup is not None:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
+    return payload
+
 
-    created_session = False
+# прямая отправка; хендлеры кладут сообщения в outbox (app/outbox.py)
+async def send_telegram_message(chat_id: int, text: str, reply_markup: dict = None):
+    if not BOT_TOKEN:
+        logging.warning("send_telegram_message: BOT_TOKEN not set")
+        return None
     try:
-        # prefer passed session, then global app.session if available, else create one forced to IPv4
-        if sess is None:
-            # try to get global session created in main.lifespan
-            try:
-                from fastapi import Request
-                # lazy import to avoid circular; assume main set app.state.http_session
-                from main import app as main_app
-                sess = getattr(main_app.state, "http_session", None)
-            except Exception:
-                sess = None
-
-        if sess is None:
-            sess = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50, family=socket.AF_INET))
-            created_session = True
-
-        MAX_ATTEMPTS = 3
-        TIMEOUT = 15  # seconds
-        for attempt in range(1, MAX_ATTEMPTS + 1):
-            try:
-                async with sess.post(url, json=payload, timeout=TIMEOUT) as resp:
-                    try:
-                        j = await resp.json()
-                    except Exception:
-                        j = {"ok": False, "http_status": resp.status}
-                    if not j.get("ok"):
-                        logging.warning("telegram send failed (chat=%s) resp=%s", chat_id, j)
-                    return j
-            except asyncio.TimeoutError:
-                logging.warning("send_telegram_message timeout for chat_id=%s attempt=%d", chat_id, attempt)
-                if attempt < MAX_ATTEMPTS:
-                    await asyncio.sleep(1.0 * attempt)
-                    continue
-                return None
-            except aiohttp.ClientError as e:
-                logging.warning("send_telegram_message client error for chat_id=%s: %s", chat_id, e)
-                return None
-    finally:
-        if created_session and sess is not None:
-            await sess.close()
+        j = await telegram.call("sendMessage", message_payload(chat_id, text, reply_markup))
+    except asyncio.TimeoutError:
+        logging.warning("send_telegram_message timeout for chat_id=%s", chat_id)
+        return None
+    except (aiohttp.ClientError, CircuitOpenError) as e:
+        logging.warning("send_telegram_message client error for chat_id=%s: %s", chat_id, e)
+        return None
+    if not j.get("ok"):
+        logging.warning("telegram send failed (chat=%s) resp=%s", chat_id, j)
+    return j
 
 
 async def answer_callback_query(callback_query_id: str, text: str = None, show_alert: bool = False):
     if not BOT_TOKEN:
         return
-    
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery"
+
     payload = {"callback_query_id": callback_query_id, "show_alert": bool(show_alert)}
     if text:
         payload["text"] = text
     try:
-        async with aiohttp.ClientSession() as sess:
-            await sess.post(url, json=payload, timeout=5)
+        await telegram.call("answerCallbackQuery", payload, timeout=5)
+    except CircuitOpenError as e:
+        logging.warning("answerCallbackQuery skipped: %s", e)
     except Exception:
         logging.exception("answerCallbackQuery failed")
 
 
-        
 async def edit_message_reply_markup(chat_id: int = None, message_id: int = None, inline_message_id: str = None, reply_markup: dict = None):
     if not BOT_TOKEN:
         return
-    
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/editMessageReplyMarkup"
+
     payload = {}
     if chat_id is not None and message_id is not None:
         payload["chat_id"] = chat_id
@@ -97,8 +249,9 @@ async def edit_message_reply_markup(chat_id: int = None, message_id: int = None,
     if reply_markup is not None:
         payload["reply_markup"] = json.dumps(reply_markup, ensure_ascii=False)
     try:
-        async with aiohttp.ClientSession() as sess:
-            await sess.post(url, json=payload, timeout=5)
+        await telegram.call("editMessageReplyMarkup", payload, timeout=5)
+    except CircuitOpenError as e:
+        logging.warning("editMessageReplyMarkup skipped: %s", e)
     except Exception:
         logging.exception("editMessageReplyMarkup failed")
 
@@ -106,8 +259,7 @@ async def edit_message_reply_markup(chat_id: int = None, message_id: int = None,
 async def edit_message_text(chat_id: int = None, message_id: int = None, inline_message_id: str = None, text: str = None):
     if not BOT_TOKEN:
         return
-    
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/editMessageText"
+
     payload = {"parse_mode": "HTML"}
     if chat_id is not None and message_id is not None:
         payload["chat_id"] = chat_id
@@ -116,8 +268,9 @@ async def edit_message_text(chat_id: int = None, message_id: int = None, inline_
         payload["inline_message_id"] = inline_message_id
     payload["text"] = text or ""
     try:
-        async with aiohttp.ClientSession() as sess:
-            await sess.post(url, json=payload, timeout=5)
+        await telegram.call("editMessageText", payload, timeout=5)
+    except CircuitOpenError as e:
+        logging.warning("editMessageText skipped: %s", e)
     except Exception:
         logging.exception("editMessageText failed")
 
@@ -130,96 +283,3 @@ async def edit_message_text(chat_id: int = None, message_id: int = None, inline_
 #             [{"text":"Нет","callback_data": f"survey:{invite_id}:no"}]
 #         ]
 #     }
-
-
-async def dispatch_surveys_once():
-    """Ищет accepted invites с ответом >=10 секунд назад и survey_sent=0, создает notifications и отправляет telegram."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-
-        # cur = await db.execute("""
-        #     SELECT i.id, i.from_user_id, i.to_user_id, i.place_name, i.responded_at, i.meal_type,
-        #            fu.tg_id AS from_tg, tu.tg_id AS to_tg, fu.name AS from_name, tu.name AS to_name
-        #     FROM invites i
-        #     JOIN users fu ON fu.id = i.from_user_id
-        #     JOIN users tu ON tu.id = i.to_user_id
-        #     WHERE i.status = 'accepted' AND IFNULL(i.survey_sent,0) = 0
-        #       AND strftime('%s', replace(replace(i.responded_at,'T',' '),'Z','')) <= strftime('%s', 'now', '-10 seconds')
-        # """)
-        cur = await db.execute("""
-            SELECT i.id, i.from_user_id, i.to_user_id, i.place_name, i.responded_at, i.meal_type,
-                fu.tg_id AS from_tg, tu.tg_id AS to_tg, fu.name AS from_name, tu.name AS to_name
-            FROM invites i
-            JOIN users fu ON fu.id = i.from_user_id
-            JOIN users tu ON tu.id = i.to_user_id
-            WHERE i.status = 'accepted' AND IFNULL(i.survey_sent,0) = 0
-            AND strftime('%s', replace(replace(i.responded_at,'T',' '),'Z','')) <= strftime('%s', 'now', '-1 hour')
-        """)
-        rows = await cur.fetchall()
-        if not rows:
-            return
-
-        for row in rows:
-            r = dict(row)  # безопасный словарь
-            invite_id = r.get("id")
-
-            # попытка пометить invite как отправленный (race-safe)
-            try:
-                await db.execute("UPDATE invites SET survey_sent = 1 WHERE id = ? AND IFNULL(survey_sent,0) = 0", (invite_id,))
-                await db.commit()
-                cur_changes = await db.execute("SELECT changes() AS cnt")
-                ch = await cur_changes.fetchone()
-                if not ch or int(ch["cnt"]) == 0:
-                    continue
-            except Exception:
-                logging.exception("failed to mark survey_sent for invite %s", invite_id)
-                continue
-
-            # payload для уведомления в мини-аппе
-            payload_from = {
-                "invite_id": invite_id,
-                "place_name": r.get("place_name"),
-                "partner_name": r.get("to_name"),
-                "partner_tg": r.get("to_tg"),
-                "role": "initiator"
-            }
-            payload_to = {
-                "invite_id": invite_id,
-                "place_name": r.get("place_name"),
-                "partner_name": r.get("from_name"),
-                "partner_tg": r.get("from_tg"),
-                "role": "responder"
-            }
-
-            # формируем дружелюбные тексты с запасными значениями
-            place = r.get("place_name") or ""
-            place_text = f' в "{place}"' if place else ""
-            meal_type = (r.get("meal_type") or "встречу").strip()
-            from_display = r.get("from_name") or (("@%s" % r.get("from_tg")) if r.get("from_tg") else "пользователь")
-            to_display = r.get("to_name") or (("@%s" % r.get("to_tg")) if r.get("to_tg") else "пользователь")
-
-            text_for_from = f'Сходили ли вы с "{to_display}" на {meal_type}{place_text}?Зайдите в мини-апп и ответься пожалуйста))'
-            text_for_to   = f'Сходили ли вы с "{from_display}" на {meal_type}{place_text}?\nЗайдите в мини-апп и ответься пожалуйста))'
-
-            # вставляем notifications в БД (initiator и responder)
-            try:
-                await db.execute(
-                    "INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                    (r.get("from_user_id"), "survey", json.dumps(payload_from, ensure_ascii=False))
-                )
-                await db.execute(
-                    "INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                    (r.get("to_user_id"), "survey", json.dumps(payload_to, ensure_ascii=False))
-                )
-                await db.commit()
-            except Exception:
-                logging.exception("failed to insert notifications for invite %s", invite_id)
-
-            # best-effort: отправляем telegram (текст тем, кто должен ответить)
-            try:
-                if r.get("from_tg"):
-                    await send_telegram_message(r.get("from_tg"), text_for_from)
-                if r.get("to_tg"):
-                    await send_telegram_message(r.get("to_tg"), text_for_to)
-            except Exception:
-                logging.exception("survey send telegram failed for invite %s", invite_id)
\ No newline at end of file
@@ -0,0 +1,291 @@
+# app/webhook.py
+
+import json
+import time
+import asyncio
+import logging
+
+from app.config import WEBHOOK_KEEP_HOURS, WEBHOOK_QUEUE_SIZE, WEBHOOK_RESCAN_S, WEBHOOK_STOP_TIMEOUT_S, WEBHOOK_WORKERS
+from app.db import get_pool
+
+# /telegram/webhook только сохраняет апдейт (update_id - PRIMARY KEY, повторная доставка
+# Telegram'ом отсекается INSERT OR IGNORE) и сразу отвечает 200. Обработка - пул воркеров:
+# апдейты одного пользователя всегда попадают в один воркер и идут по порядку.
+# Переполненный шард не блокирует webhook: апдейт уже в БД, шард дочитывается из неё.
+
+# _refill: страница pending-апдейтов после update_id; меньше REFILL_PAGE_MIN не читаем
+REFILL_SQL = """
+    SELECT update_id, kind, user_id, payload, received_at
+    FROM telegram_updates INDEXED BY idx_telegram_updates_pending
+    WHERE status = 'pending' AND update_id > ?
+    ORDER BY update_id LIMIT ?
+"""
+REFILL_PAGE_MIN = 100
+
+UPDATE_HANDLERS = {}
+
+
+def update_handler(kind: str):
+    """Регистрирует async-обработчик апдейтов вида kind ("callback_query", ...): handler(body)."""
+    def deco(fn):
+        UPDATE_HANDLERS[kind] = fn
+        return fn
+    return deco
+
+
+async def create_updates_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS telegram_updates (
+            update_id INTEGER PRIMARY KEY,     -- id апдейта от Telegram: дедупликация доставок
+            kind TEXT NOT NULL,
+            user_id INTEGER,                   -- tg id отправителя, ключ шардирования
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | done | failed
+            received_at REAL NOT NULL,         -- unix time
+            processed_at REAL,
+            last_error TEXT
+        );
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_telegram_updates_status
+            ON telegram_updates(status, received_at);
+    """)
+    # _refill: страницы pending по update_id - поиск по индексу, без обхода обработанных и сортировки
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_telegram_updates_pending
+            ON telegram_updates(update_id) WHERE status = 'pending';
+    """)
+
+
+class WebhookDispatcher:
+
+    def __init__(self):
+        self._queues = []
+        self._tasks = []
+        self._queued = set()      # update_id в очередях и в обработке
+        self._backlog = []        # шард переполнялся - новые апдейты берём из БД по порядку
+        self._missed = []         # сколько апдейтов шард пропустил в backlog-режиме
+        self._finished = None     # update_id, завершённые за время чтения в _refill
+        self._rescan = None
+        self.received = 0
+        self.duplicates = 0
+        self.ignored = 0
+        self.processed = 0
+        self.failed = 0
+        self.overflow = 0
+        self.lag_total = 0.0      # от приёма до начала обработки
+        self.lag_max = 0.0
+        self.proc_total = 0.0
+        self.proc_max = 0.0
+
+    def start(self, workers: int = WEBHOOK_WORKERS):
+        # очереди/события привязываются к loop текущего lifespan
+        self._queues = [asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+        self._backlog = [True] * workers  # при старте дочитываем необработанное из БД
+        self._missed = [0] * workers
+        self._queued = set()
+        self._rescan = asyncio.Event()
+        self._rescan.set()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(workers)]
+        self._tasks.append(asyncio.create_task(self._rescan_loop()))
+
+    async def stop(self, timeout: float = WEBHOOK_STOP_TIMEOUT_S):
+        """Воркеры доделывают текущий апдейт; что не успели - останется pending до рестарта."""
+        if not self._tasks:
+            return
+        rescan_t = self._tasks.pop()
+        rescan_t.cancel()
+        for q in self._queues:
+            # очередь могла быть полной - вычищаем её, апдейты остаются pending в БД
+            while not q.empty():
+                item = q.get_nowait()
+                if item is not None:
+                    self._queued.discard(item[0])
+            q.put_nowait(None)
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._tasks, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("webhook: workers did not stop in %.1fs", timeout)
+            for t in self._tasks:
+                t.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.gather(rescan_t, return_exceptions=True)
+        self._tasks = []
+
+    def _shard(self, user_id) -> int:
+        return hash(user_id) % len(self._queues)
+
+    async def accept(self, update: dict) -> bool:
+        """Сохраняет апдейт и ставит в очередь. -> False для дубля или неизвестного вида."""
+        update_id = update.get("update_id")
+        kind = next((k for k in UPDATE_HANDLERS if k in update), None)
+        if update_id is None or kind is None:
+            self.ignored += 1
+            return False
+        body = update[kind]
+        user_id = (body.get("from") or {}).get("id")
+        received = time.time()
+
+        async def _op(db):
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO telegram_updates (update_id, kind, user_id, payload, received_at) VALUES (?, ?, ?, ?, ?)",
+                (update_id, kind, user_id, json.dumps(body, ensure_ascii=False), received)
+            )
+            return cur.rowcount
+        if not await get_pool().write(_op):
+            self.duplicates += 1
+            return False
+        self.received += 1
+        if self._queues:
+            self._submit(update_id, kind, user_id, body, received)
+        return True
+
+    def _submit(self, update_id, kind, user_id, body, received):
+        i = self._shard(user_id)
+        if update_id in self._queued:
+            return
+        if self._backlog[i]:
+            self._missed[i] += 1
+            self._rescan.set()
+            return
+        try:
+            self._queues[i].put_nowait((update_id, kind, body, received))
+            self._queued.add(update_id)
+        except asyncio.QueueFull:
+            self.overflow += 1
+            self._backlog[i] = True
+
+    async def _rescan_loop(self):
+        last_purge = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._rescan.wait(), WEBHOOK_RESCAN_S)
+            except asyncio.TimeoutError:
+                pass
+            self._rescan.clear()
+            try:
+                await self._refill()
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    await self._purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("webhook: rescan failed")
+
+    async def _refill(self):
+        """Дочитать pending из БД в шарды с backlog (по update_id, т.е. в порядке поступления).
+
+        Читаем страницами по числу свободных мест в этих шардах и останавливаемся, когда все они полны.
+        """
+        shards = [i for i, b in enumerate(self._backlog) if b]
+        if not shards:
+            return
+        missed = list(self._missed)
+        self._finished = set()
+        full = set()
+        after = 0
+        try:
+            async with get_pool().reader() as db:
+                while len(full) < len(shards):
+                    free = sum(self._queues[i].maxsize - self._queues[i].qsize() for i in shards if i not in full)
+                    page = max(free, REFILL_PAGE_MIN)
+                    cur = await db.execute(REFILL_SQL, (after, page))
+                    rows = await cur.fetchall()
+                    for r in rows:
+                        i = self._shard(r["user_id"])
+                        # строка могла быть pending на момент SELECT, но уже обработана
+                        if (not self._backlog[i] or i in full or r["update_id"] in self._queued
+                                or r["update_id"] in self._finished):
+                            continue
+                        try:
+                            self._queues[i].put_nowait((r["update_id"], r["kind"], json.loads(r["payload"]),
+                                                        r["received_at"]))
+                            self._queued.add(r["update_id"])
+                        except asyncio.QueueFull:
+                            full.add(i)
+                    if len(rows) < page:
+                        break
+                    after = rows[-1]["update_id"]
+        finally:
+            self._finished = None
+        # шард, в который влезло всё оставшееся, снова принимает апдейты напрямую;
+        # если за время SELECT в него пришли новые - ещё один проход
+        for i in shards:
+            if i in full:
+                continue
+            if self._missed[i] != missed[i]:
+                self._rescan.set()
+            else:
+                self._backlog[i] = False
+
+    async def _purge(self):
+        cutoff = time.time() - WEBHOOK_KEEP_HOURS * 3600
+
+        async def _op(db):
+            await db.execute("DELETE FROM telegram_updates WHERE status != 'pending' AND received_at < ?", (cutoff,))
+        await get_pool().write(_op)
+
+    async def _worker(self, i: int):
+        q = self._queues[i]
+        while True:
+            item = await q.get()
+            if item is None:
+                return
+            update_id, kind, body, received = item
+            t0 = time.time()
+            lag = max(0.0, t0 - received)
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            status, err = "done", None
+            try:
+                await UPDATE_HANDLERS[kind](body)
+            except Exception as e:
+                logging.exception("webhook: update %s (%s) failed", update_id, kind)
+                status, err = "failed", repr(e)[:500]
+            dt = time.time() - t0
+            self.proc_total += dt
+            self.proc_max = max(self.proc_max, dt)
+            if status == "done":
+                self.processed += 1
+            else:
+                self.failed += 1
+
+            async def _op(db):
+                await db.execute(
+                    "UPDATE telegram_updates SET status = ?, processed_at = ?, last_error = ? WHERE update_id = ?",
+                    (status, time.time(), err, update_id)
+                )
+            try:
+                await get_pool().write(_op)
+            except Exception:
+                logging.exception("webhook: failed to mark update %s", update_id)
+            finally:
+                self._queued.discard(update_id)
+                if self._finished is not None:
+                    self._finished.add(update_id)
+            if self._backlog[i] and q.empty():
+                self._rescan.set()
+
+    def stats(self):
+        n = self.processed + self.failed
+        return {
+            "workers": len(self._queues),
+            "queue_depth": sum(q.qsize() for q in self._queues),
+            "queue_depth_max": max((q.qsize() for q in self._queues), default=0),
+            "in_flight": len(self._queued),
+            "backlog_shards": sum(1 for b in self._backlog if b),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "ignored": self.ignored,
+            "processed": self.processed,
+            "failed": self.failed,
+            "overflow": self.overflow,
+            "lag_avg_ms": round(self.lag_total * 1000 / n, 1) if n else 0.0,
+            "lag_max_ms": round(self.lag_max * 1000, 1),
+            "proc_avg_ms": round(self.proc_total * 1000 / n, 1) if n else 0.0,
+            "proc_max_ms": round(self.proc_max * 1000, 1),
+        }
+
+
+webhook_dispatcher = WebhookDispatcher()
@@ -0,0 +1,374 @@
+# bench/chat_ws.py
+#
+# Нагрузка на WebSocket-чат (/ws/chat, app/chat.py): --pairs пар сматченных
+# пользователей (accepted-инвайт), у каждого --conns соединений (вкладок);
+# каждый пользователь шлёт собеседнику --rate сообщений/с. Отчёт: сколько
+# соединений открыто и за сколько, сообщений/с отправлено и доставлено,
+# задержка доставки p50/p95/p99, разрывы медленных потребителей и счётчики
+# хаба из /api/stats (размер пачек записи в messages).
+#
+#   python -m bench.chat_ws --pairs 1000 --rate 2 --duration 20
+#   python -m bench.chat_ws --pairs 200 --rate 20 --slow 0.05     # 5% соединений не читают
+#   python -m bench.chat_ws --url http://127.0.0.1:8000 --pairs 200
+#
+# Без --url приложение работает в процессе через ASGI (без сети, как bench.loadtest)
+# на своей БД - меряется сам хаб и запись пачками. С --url пары создаются
+# через /api/invite + /api/invite/respond на сервере (uvicorn, один воркер).
+# Соединения аутентифицируются подписанным initData ({"type": "auth"} первым
+# сообщением): с --url нужен тот же BOT_TOKEN, что у сервера (--bot-token или env).
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import sqlite3
+import tempfile
+from contextlib import AsyncExitStack
+from urllib.parse import urlencode
+
+import aiohttp
+
+from utils import init_data_hash
+
+TG_BASE = 900_000_000       # tg_id пользователей бенчмарка: TG_BASE + 2k и TG_BASE + 2k + 1 - пара k
+BENCH_BOT_TOKEN = "bench:token"     # in-process, если BOT_TOKEN не задан
+
+
+def _pct(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(-(-p * len(sorted_vals) // 1)) - 1))
+    return sorted_vals[k]
+
+
+class AsgiWebSocket:
+    """Клиент WebSocket поверх ASGI-приложения в процессе.
+
+    Очередь входящих ограничена buffer: не читающий клиент блокирует send
+    приложения так же, как заполненный TCP-буфер у настоящего сокета.
+    """
+
+    def __init__(self, app, path: str, params: dict, buffer: int):
+        self._app = app
+        self._scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "ws",
+            "path": path, "raw_path": path.encode(), "query_string": urlencode(params).encode(),
+            "root_path": "", "headers": [], "subprotocols": [], "server": ("app", 80), "client": ("bench", 1),
+        }
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue(maxsize=buffer)
+        self._accepted = asyncio.Event()
+        self._closed = asyncio.Event()
+        self.close_code = None
+        self._task = None
+
+    async def connect(self):
+        self._to_app.put_nowait({"type": "websocket.connect"})
+        self._task = asyncio.create_task(self._app(self._scope, self._to_app.get, self._send))
+        await asyncio.wait({asyncio.ensure_future(self._accepted.wait()), asyncio.ensure_future(self._closed.wait())},
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not self._accepted.is_set():
+            raise ConnectionError(f"rejected: {self.close_code}")
+
+    async def _send(self, message):
+        t = message["type"]
+        if t == "websocket.accept":
+            self._accepted.set()
+        elif t == "websocket.send":
+            await self._from_app.put(message.get("text"))
+        elif t == "websocket.close":
+            # close-фрейм идёт мимо буфера, ответ клиента на него - disconnect
+            self.close_code = message.get("code", 1000)
+            self._closed.set()
+            self._to_app.put_nowait({"type": "websocket.disconnect", "code": self.close_code})
+
+    async def send(self, text: str):
+        if not self._closed.is_set():
+            self._to_app.put_nowait({"type": "websocket.receive", "text": text})
+
+    async def recv(self):
+        """-> текст или None, если соединение закрыто."""
+        if self._from_app.empty() and self._closed.is_set():
+            return None
+        get = asyncio.ensure_future(self._from_app.get())
+        closed = asyncio.ensure_future(self._closed.wait())
+        await asyncio.wait({get, closed}, return_when=asyncio.FIRST_COMPLETED)
+        closed.cancel()
+        if get.done():
+            return get.result()
+        get.cancel()
+        return None
+
+    async def close(self):
+        if not self._closed.is_set():
+            self._closed.set()
+            self._to_app.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        if self._task is not None:
+            # не читающий клиент мог оставить приложение в send - освобождаем буфер
+            while not self._from_app.empty():
+                self._from_app.get_nowait()
+            try:
+                await asyncio.wait_for(self._task, 5)
+            except Exception:
+                self._task.cancel()
+
+
+class AiohttpWebSocket:
+
+    def __init__(self, session: aiohttp.ClientSession, path: str, params: dict):
+        self._session = session
+        self._path = path
+        self._params = params
+        self._ws = None
+        self.close_code = None
+
+    async def connect(self):
+        self._ws = await self._session.ws_connect(self._path, params=self._params, max_msg_size=0)
+
+    async def send(self, text: str):
+        if not self._ws.closed:
+            await self._ws.send_str(text)
+
+    async def recv(self):
+        msg = await self._ws.receive()
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            return msg.data
+        self.close_code = self._ws.close_code
+        return None
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+            if self.close_code is None:
+                self.close_code = self._ws.close_code
+
+
+class ChatMetrics:
+
+    def __init__(self):
+        self.connect = []        # s
+        self.latency = []        # s, отправка -> получение собеседником
+        self.connect_errors = 0
+        self.sent = 0
+        self.delivered = 0
+        self.echoed = 0          # собственные сообщения на других вкладках отправителя
+        self.errors = 0
+        self.drops = 0           # закрыто сервером с 1013 (медленный потребитель)
+        self.t_start = None
+        self.t_send_end = None
+        self.t_end = None
+
+    def report(self, conns: int, slow: int):
+        elapsed = self.t_end - self.t_start
+        sending = self.t_send_end - self.t_start
+        c = sorted(self.connect)
+        lat = sorted(self.latency)
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "connections": conns,
+            "slow_connections": slow,
+            "connect_errors": self.connect_errors,
+            "connect_p50_ms": round(_pct(c, 0.50) * 1000, 2),
+            "connect_p99_ms": round(_pct(c, 0.99) * 1000, 2),
+            "sent": self.sent,
+            "sent_per_s": round(self.sent / sending, 1) if sending else 0.0,
+            "delivered": self.delivered,
+            "delivered_per_s": round(self.delivered / sending, 1) if sending else 0.0,
+            "latency_p50_ms": round(_pct(lat, 0.50) * 1000, 2),
+            "latency_p95_ms": round(_pct(lat, 0.95) * 1000, 2),
+            "latency_p99_ms": round(_pct(lat, 0.99) * 1000, 2),
+            "latency_max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+            "errors": self.errors,
+            "dropped_slow": self.drops,
+        }
+
+
+async def _reader(conn, tg: int, m: ChatMetrics):
+    while True:
+        raw = await conn.recv()
+        if raw is None:
+            return
+        ev = json.loads(raw)
+        if ev.get("type") == "message":
+            if ev.get("to_tg") == tg:
+                m.delivered += 1
+                m.latency.append(time.perf_counter() - float(ev["client_id"]))
+            else:
+                m.echoed += 1
+        elif ev.get("type") == "error":
+            m.errors += 1
+
+
+async def _sender(conn, peer_tg: int, rate: float, stop_at: float, rnd: random.Random, m: ChatMetrics):
+    await asyncio.sleep(rnd.uniform(0, 1.0 / rate))
+    n = 0
+    while time.perf_counter() < stop_at:
+        n += 1
+        await conn.send(json.dumps({"type": "send", "to": peer_tg, "text": f"bench message {n}",
+                                    "client_id": f"{time.perf_counter():.6f}"}))
+        m.sent += 1
+        await asyncio.sleep(min(rnd.expovariate(rate), max(0.0, stop_at - time.perf_counter())))
+
+
+def _auth_message(tg: int, bot_token: str) -> str:
+    """Первое сообщение /ws/chat: initData, подписанный как у Telegram."""
+    init_data = {"auth_date": str(int(time.time())), "user": json.dumps({"id": tg}, separators=(",", ":"))}
+    init_data["hash"] = init_data_hash(init_data, bot_token)
+    return json.dumps({"type": "auth", "init_data": urlencode(init_data)})
+
+
+async def run_chat(open_ws, bot_token: str, pairs: int, conns: int, rate: float, duration: float, slow: float,
+                   seed: int):
+    """open_ws(tg) -> не подключённый клиент. Каждая пара: два пользователя по conns соединений."""
+    m = ChatMetrics()
+    rnd = random.Random(seed)
+    clients = []    # (conn, tg, peer_tg, slow, sends)
+    for k in range(pairs):
+        a, b = TG_BASE + 2 * k, TG_BASE + 2 * k + 1
+        for tg, peer in ((a, b), (b, a)):
+            for j in range(conns):
+                clients.append((open_ws(tg), tg, peer, rnd.random() < slow, j == 0))
+
+    async def connect(c):
+        t0 = time.perf_counter()
+        try:
+            await c[0].connect()
+            await c[0].send(_auth_message(c[1], bot_token))
+        except Exception:
+            m.connect_errors += 1
+            return False
+        m.connect.append(time.perf_counter() - t0)
+        return True
+
+    # подключаемся пачками, чтобы не мерить штурм accept
+    opened = []
+    for i in range(0, len(clients), 200):
+        chunk = clients[i:i + 200]
+        ok = await asyncio.gather(*(connect(c) for c in chunk))
+        opened += [c for c, good in zip(chunk, ok) if good]
+    print(f"connected {len(opened)}/{len(clients)} websockets")
+
+    m.t_start = time.perf_counter()
+    stop_at = m.t_start + duration
+    readers = [asyncio.create_task(_reader(c[0], c[1], m)) for c in opened if not c[3]]
+    senders = [_sender(c[0], c[2], rate, stop_at, random.Random(seed * 7919 + n), m)
+               for n, c in enumerate(opened) if c[4]]
+    await asyncio.gather(*senders)
+    m.t_send_end = time.perf_counter()
+    await asyncio.sleep(1.0)    # хвост доставки
+    m.t_end = time.perf_counter()
+
+    for c in opened:
+        if c[0].close_code == 1013:
+            m.drops += 1
+    for c in opened:
+        await c[0].close()
+    await asyncio.gather(*readers, return_exceptions=True)
+    return m, len(opened), sum(1 for c in opened if c[3])
+
+
+def _seed_pairs(path: str, pairs: int):
+    """In-process: пользователи и accepted-инвайты прямо в БД (без Telegram и задач)."""
+    db = sqlite3.connect(path)
+    with db:
+        db.executemany("INSERT OR IGNORE INTO users (tg_id, name, created_at, updated_at) "
+                       "VALUES (?, ?, datetime('now'), datetime('now'))",
+                       [(TG_BASE + i, f"chat bench {i}") for i in range(2 * pairs)])
+        db.execute("""
+            INSERT INTO invites (from_user_id, to_user_id, status, responder_user_id, responded_at, survey_sent, created_at)
+            SELECT a.id, b.id, 'accepted', b.id, datetime('now'), 1, datetime('now')
+            FROM users a JOIN users b ON b.tg_id = a.tg_id + 1
+            WHERE a.tg_id >= ? AND a.tg_id < ? AND (a.tg_id - ?) % 2 = 0
+        """, (TG_BASE, TG_BASE + 2 * pairs, TG_BASE))
+    db.close()
+
+
+async def _in_process(args):
+    try:
+        import httpx
+    except ImportError:
+        sys.exit("in-process mode needs httpx (pip install httpx) - or use --url")
+    tmp = tempfile.mkdtemp(prefix="meeteat-chat-")
+    path = os.path.join(tmp, "chat.sqlite3")
+    # config читается при импорте: окружение до import main
+    os.environ["DB_PATH"] = path
+    os.environ.setdefault("BOT_TOKEN", BENCH_BOT_TOKEN)
+    import main
+    await main.init_db(path)
+    await asyncio.to_thread(_seed_pairs, path, args.pairs)
+
+    async with AsyncExitStack() as stack:
+        await stack.enter_async_context(main.lifespan(main.app))
+        http = await stack.enter_async_context(
+            httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://app"))
+
+        def open_ws(tg):
+            return AsgiWebSocket(main.app, "/ws/chat", {}, args.client_buffer)
+
+        res = await run_chat(open_ws, os.environ["BOT_TOKEN"], args.pairs, args.conns, args.rate, args.duration, args.slow, args.seed)
+        stats = (await http.get("/api/stats")).json()
+    return res, stats
+
+
+async def _over_http(args):
+    if not args.bot_token:
+        sys.exit("--url mode needs the server's BOT_TOKEN (--bot-token or env) to sign initData")
+    conn = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(base_url=args.url, connector=conn) as http:
+        print(f"matching {args.pairs} pairs via /api/invite + /api/invite/respond")
+        sem = asyncio.Semaphore(50)
+
+        async def match(k):
+            a, b = TG_BASE + 2 * k, TG_BASE + 2 * k + 1
+            async with sem:
+                async with http.post("/api/invite", json={"from_tg_id": a, "to_tg_id": b}) as r:
+                    inv = await r.json()
+                async with http.post("/api/invite/respond", json={"invite_id": inv["invite_id"],
+                                                                   "responder_tg_id": b, "action": "accept"}) as r:
+                    await r.read()
+        await asyncio.gather(*(match(k) for k in range(args.pairs)))
+
+        def open_ws(tg):
+            return AiohttpWebSocket(http, "/ws/chat", {})
+
+        res = await run_chat(open_ws, args.bot_token, args.pairs, args.conns, args.rate, args.duration, args.slow, args.seed)
+        try:
+            async with http.get("/api/stats") as r:
+                stats = await r.json(content_type=None)
+        except Exception:
+            stats = None
+    return res, stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description="meet&eat websocket chat benchmark")
+    ap.add_argument("--url", default=None, help="HTTP-режим: адрес запущенного сервера (иначе in-process)")
+    ap.add_argument("--bot-token", default=os.getenv("BOT_TOKEN"), help="HTTP-режим: BOT_TOKEN сервера для initData")
+    ap.add_argument("--pairs", type=int, default=500)
+    ap.add_argument("--conns", type=int, default=1, help="соединений (вкладок) на пользователя")
+    ap.add_argument("--rate", type=float, default=2.0, help="сообщений/с от каждого пользователя")
+    ap.add_argument("--duration", type=float, default=20.0)
+    ap.add_argument("--slow", type=float, default=0.0, help="доля соединений, которые не читают")
+    ap.add_argument("--client-buffer", type=int, default=64, help="in-process: входящий буфер клиента")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", default=None, help="записать отчёт (и /api/stats сервера) в файл")
+    args = ap.parse_args()
+
+    (m, conns, slow), stats = asyncio.run(_over_http(args) if args.url else _in_process(args))
+    rep = m.report(conns, slow)
+    chat = (stats or {}).get("chat")
+    for k, v in rep.items():
+        print(f"{k:<20} {v}")
+    if chat:
+        print(f"{'server chat':<20} {chat}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "report": rep, "server_stats": stats}, f, ensure_ascii=False, indent=2)
+        print(f"written {args.json}")
+
+
+if __name__ == "__main__":
+    main()
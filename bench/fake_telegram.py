@@ -0,0 +1,215 @@
+# bench/fake_telegram.py
+#
+# Локальная замена Bot API для нагрузочных и fault-тестов: sendMessage,
+# answerCallbackQuery, editMessageText, editMessageReplyMarkup с настраиваемой
+# задержкой, 429/retry_after, таймаутами, 5xx и 403 ("bot was blocked").
+# Может сам соблюдать лимиты Telegram (--enforce-limits): чат чаще раза в
+# секунду или бот чаще --global-limit в секунду -> 429, как настоящий API.
+#
+#   python -m bench.fake_telegram --port 8081 --latency-ms 80 --jitter-ms 40 --rate-429 0.02
+#   TELEGRAM_FAKE_API=http://127.0.0.1:8081 uvicorn main:app --port 8000
+#
+# Управление на лету: POST /_control {"error_rate": 0.5} (любые поля FakeConfig),
+# статистика: GET /_stats, сброс счётчиков: POST /_reset.
+
+import time
+import random
+import asyncio
+import argparse
+from aiohttp import web
+from dataclasses import dataclass, asdict, fields
+
+METHODS = ("sendMessage", "answerCallbackQuery", "editMessageText", "editMessageReplyMarkup")
+
+
+@dataclass
+class FakeConfig:
+    latency_ms: float = 50.0
+    jitter_ms: float = 20.0
+    rate_429: float = 0.0          # доля случайных 429
+    retry_after: int = 1
+    timeout_rate: float = 0.0      # доля запросов, на которые ответ придёт через timeout_s
+    timeout_s: float = 30.0
+    error_rate: float = 0.0        # доля 500
+    blocked_rate: float = 0.0      # доля 403 для sendMessage
+    enforce_limits: bool = False
+    global_limit: float = 30.0     # сообщений/с на бота
+    per_chat_interval_s: float = 1.0
+
+
+class FakeStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.by_method = {}
+        self.outcomes = {}
+        self.chats = {}            # chat_id -> последний sendMessage (monotonic)
+        self.chat_violations = 0   # сообщения в чат чаще per_chat_interval_s
+        self.window = []           # время sendMessage за последнюю секунду
+        self.peak_rate = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def count(self, method: str, outcome: str):
+        self.by_method[method] = self.by_method.get(method, 0) + 1
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self.started
+        total = sum(self.by_method.values())
+        return {
+            "elapsed_s": round(elapsed, 1),
+            "requests": total,
+            "rps": round(total / elapsed, 1) if elapsed else 0.0,
+            "by_method": self.by_method,
+            "outcomes": self.outcomes,
+            "chats": len(self.chats),
+            "chat_violations": self.chat_violations,
+            "peak_send_rate": self.peak_rate,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+        }
+
+
+def _error(code: int, description: str, retry_after: int = None):
+    body = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        body["parameters"] = {"retry_after": retry_after}
+    return web.json_response(body, status=code)
+
+
+def make_app(cfg: FakeConfig = None, seed: int = None) -> web.Application:
+    app = web.Application()
+    app["cfg"] = cfg or FakeConfig()
+    app["stats"] = FakeStats()
+    app["rnd"] = random.Random(seed)
+    app["message_id"] = 0
+
+    async def bot_method(request: web.Request):
+        cfg, st, rnd = request.app["cfg"], request.app["stats"], request.app["rnd"]
+        method = request.match_info["method"]
+        if method not in METHODS:
+            st.count(method, "404")
+            return _error(404, "Not Found: method not found")
+        try:
+            if request.content_type == "application/json":
+                params = await request.json()
+            else:
+                params = dict(await request.post())
+        except Exception:
+            st.count(method, "400")
+            return _error(400, "Bad Request: can't parse request body")
+
+        st.in_flight += 1
+        st.peak_in_flight = max(st.peak_in_flight, st.in_flight)
+        try:
+            delay = max(0.0, cfg.latency_ms + rnd.uniform(-cfg.jitter_ms, cfg.jitter_ms)) / 1000
+            if rnd.random() < cfg.timeout_rate:
+                delay = cfg.timeout_s
+            await asyncio.sleep(delay)
+
+            if rnd.random() < cfg.error_rate:
+                st.count(method, "500")
+                return _error(500, "Internal Server Error")
+            if rnd.random() < cfg.rate_429:
+                st.count(method, "429")
+                return _error(429, f"Too Many Requests: retry after {cfg.retry_after}", cfg.retry_after)
+
+            if method == "answerCallbackQuery":
+                st.count(method, "ok")
+                return web.json_response({"ok": True, "result": True})
+
+            chat_id = params.get("chat_id")
+            if chat_id is None and not params.get("inline_message_id"):
+                st.count(method, "400")
+                return _error(400, "Bad Request: chat_id is empty")
+
+            if method == "sendMessage":
+                if not params.get("text"):
+                    st.count(method, "400")
+                    return _error(400, "Bad Request: message text is empty")
+                if rnd.random() < cfg.blocked_rate:
+                    st.count(method, "403")
+                    return _error(403, "Forbidden: bot was blocked by the user")
+                now = time.monotonic()
+                st.window = [t for t in st.window if t > now - 1.0]
+                last = st.chats.get(chat_id)
+                chat_too_fast = last is not None and now - last < cfg.per_chat_interval_s
+                if cfg.enforce_limits and (chat_too_fast or len(st.window) >= cfg.global_limit):
+                    st.count(method, "429")
+                    return _error(429, f"Too Many Requests: retry after {cfg.retry_after}", cfg.retry_after)
+                if chat_too_fast:
+                    st.chat_violations += 1
+                st.chats[chat_id] = now
+                st.window.append(now)
+                st.peak_rate = max(st.peak_rate, len(st.window))
+                request.app["message_id"] += 1
+                st.count(method, "ok")
+                return web.json_response({"ok": True, "result": {
+                    "message_id": request.app["message_id"],
+                    "chat": {"id": chat_id, "type": "private"},
+                    "date": int(time.time()),
+                    "text": params.get("text"),
+                }})
+
+            # editMessageText / editMessageReplyMarkup
+            st.count(method, "ok")
+            return web.json_response({"ok": True, "result": {
+                "message_id": params.get("message_id"),
+                "chat": {"id": chat_id, "type": "private"},
+                "date": int(time.time()),
+            }})
+        finally:
+            st.in_flight -= 1
+
+    async def control(request: web.Request):
+        cfg = request.app["cfg"]
+        body = await request.json()
+        names = {f.name: f.type for f in fields(FakeConfig)}
+        for k, v in body.items():
+            if k not in names:
+                return _error(400, f"unknown field {k}")
+            setattr(cfg, k, bool(v) if names[k] in (bool, "bool") else type(getattr(cfg, k))(v))
+        return web.json_response({"ok": True, "config": asdict(cfg)})
+
+    async def stats(request: web.Request):
+        return web.json_response({"ok": True, "config": asdict(request.app["cfg"]),
+                                  "stats": request.app["stats"].as_dict()})
+
+    async def reset(request: web.Request):
+        request.app["stats"] = FakeStats()
+        return web.json_response({"ok": True})
+
+    app.router.add_post("/bot{token}/{method}", bot_method)
+    app.router.add_post("/_control", control)
+    app.router.add_get("/_stats", stats)
+    app.router.add_post("/_reset", reset)
+    return app
+
+
+async def start_fake_telegram(host: str = "127.0.0.1", port: int = 8081, cfg: FakeConfig = None, seed: int = None):
+    """Запуск внутри уже работающего loop (для bench-скриптов). -> runner; остановка: await runner.cleanup()."""
+    runner = web.AppRunner(make_app(cfg, seed))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    ap = argparse.ArgumentParser(description="fake Telegram Bot API for offline load/fault testing")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--seed", type=int, default=None)
+    for f in fields(FakeConfig):
+        flag = "--" + f.name.replace("_", "-")
+        if f.type in (bool, "bool"):
+            ap.add_argument(flag, action="store_true")
+        else:
+            ap.add_argument(flag, type=type(f.default), default=f.default)
+    args = ap.parse_args()
+    cfg = FakeConfig(**{f.name: getattr(args, f.name) for f in fields(FakeConfig)})
+    print(f"fake telegram on http://{args.host}:{args.port}  {asdict(cfg)}")
+    web.run_app(make_app(cfg, args.seed), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
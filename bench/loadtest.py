@@ -0,0 +1,481 @@
+# bench/loadtest.py
+#
+# Нагрузочный прогон: виртуальные пользователи повторяют поведение мини-аппа
+# (таймеры и запросы из static/ui-and-screens.js и static/geo-and-session.js)
+# против приложения в процессе (ASGI, своя свежая популяция и fake Telegram)
+# или по HTTP против уже запущенного сервера. Отчёт: p50/p95/p99, throughput
+# и доля ошибок по каждому эндпоинту.
+#
+#   python -m bench.loadtest --users 100000 --vus 500 --duration 60 --speed 10
+#   python -m bench.loadtest --url http://127.0.0.1:8000 --pop-users 100000 --vus 200
+#
+# --speed N сжимает время клиента: heartbeat раз в 30 с идёт раз в 30/N с, long-poll
+# /api/invites/wait держится 25/N с, то есть 500 VU при --speed 10 дают нагрузку примерно
+# 5000 реальных открытых мини-аппов. Уведомления, как у клиента, приходят по SSE
+# (/api/notifications/stream, одно соединение на VU на весь прогон); в отчёте "SSE ..." -
+# время до ответа сервера, "GET /api/invites/wait" - вместе с ожиданием.
+
+import os
+import sys
+import json
+import codecs
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import tempfile
+from contextlib import AsyncExitStack
+from urllib.parse import urlencode
+
+import aiohttp
+
+try:
+    import httpx
+except ImportError:  # нужен только для in-process режима
+    httpx = None
+
+from bench.population import REACTIONS, TAGS, tg_of, user_home
+
+# интервалы клиента, секунды реального времени
+INVITE_WAIT_S = 25.0        # INVITE_WAIT_TIMEOUT_S: сколько сервер держит long-poll
+INVITE_WAIT_RETRY_S = 5.0   # INVITE_WAIT_RETRY_MS: пауза после ошибки
+NOTIF_MARK_DELAY_S = 0.3    # NOTIF_MARK_DELAY: показанные помечаются одним mark_read_bulk
+HEARTBEAT_S = 30.0          # startUpdateLoop
+BROWSE_S = 45.0             # переходы по экранам: похожие, профили, отзывы, теги
+EAT_MINUTES = (10, 40)      # сколько пользователь "ест" до /stop
+IDLE_MINUTES = (5, 60)      # пауза между сессиями
+P_EATER = 0.35              # доля VU, которые открывают мини-апп чтобы поесть
+P_INVITE = 0.08             # шанс пригласить кого-то из /nearby за тик heartbeat
+P_RESPOND = 0.5             # шанс ответить на входящее приглашение при опросе
+P_REVIEW = 0.05             # шанс поставить реакцию при просмотре профиля
+
+
+class Metrics:
+    def __init__(self):
+        self.samples = {}   # endpoint -> [latency_s]
+        self.errors = {}    # endpoint -> count
+        self.statuses = {}  # endpoint -> {status: count}
+        self.sse_events = 0
+        self.t_start = None
+        self.t_end = None
+
+    def add(self, name: str, dt: float, status: int):
+        self.samples.setdefault(name, []).append(dt)
+        st = self.statuses.setdefault(name, {})
+        st[status] = st.get(status, 0) + 1
+        if status == 0 or status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    @staticmethod
+    def _pct(sorted_vals, p):
+        if not sorted_vals:
+            return 0.0
+        k = max(0, min(len(sorted_vals) - 1, int(-(-p * len(sorted_vals) // 1)) - 1))
+        return sorted_vals[k]
+
+    def report(self):
+        elapsed = (self.t_end or time.perf_counter()) - self.t_start
+        rows = {}
+        for name, vals in sorted(self.samples.items()):
+            v = sorted(vals)
+            n = len(v)
+            rows[name] = {
+                "count": n,
+                "rps": round(n / elapsed, 2),
+                "p50_ms": round(self._pct(v, 0.50) * 1000, 2),
+                "p95_ms": round(self._pct(v, 0.95) * 1000, 2),
+                "p99_ms": round(self._pct(v, 0.99) * 1000, 2),
+                "max_ms": round(v[-1] * 1000, 2),
+                "errors": self.errors.get(name, 0),
+                "error_rate": round(self.errors.get(name, 0) / n, 4),
+                "statuses": {str(k): c for k, c in sorted(self.statuses[name].items())},
+            }
+        total = sum(r["count"] for r in rows.values())
+        errors = sum(r["errors"] for r in rows.values())
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "requests": total,
+            "rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "errors": errors,
+            "error_rate": round(errors / total, 4) if total else 0.0,
+            "sse_events": self.sse_events,
+            "endpoints": rows,
+        }
+
+
+class SseParser:
+    """Разбор text/event-stream по кускам: on_event(event, data) на каждое событие."""
+
+    def __init__(self, on_event):
+        self._on_event = on_event
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._event = None
+        self._data = []
+
+    def feed(self, chunk: bytes):
+        # кусок может оборваться посреди UTF-8 символа
+        self._buf += self._decoder.decode(chunk)
+        *lines, self._buf = self._buf.split("\n")
+        for line in lines:
+            line = line.rstrip("\r")
+            if not line:
+                if self._data:
+                    self._on_event(self._event or "message", "\n".join(self._data))
+                self._event, self._data = None, []
+            elif line.startswith("event:"):
+                self._event = line[6:].strip()
+            elif line.startswith("data:"):
+                self._data.append(line[5:].lstrip())
+
+
+class Client:
+    """Единый интерфейс запросов поверх httpx (ASGI) или aiohttp (HTTP).
+
+    request_fn(method, path, params, body, hold) -> (status, json); hold - долгий запрос (long-poll).
+    sse_fn(path, params, on_open, parser, stop_at) - держит SSE-поток до stop_at.
+    """
+
+    def __init__(self, metrics: Metrics, request_fn, sse_fn):
+        self.metrics = metrics
+        self._request = request_fn
+        self._sse = sse_fn
+
+    async def call(self, method: str, path: str, params: dict = None, body: dict = None, hold: bool = False):
+        name = f"{method} {path}"
+        t0 = time.perf_counter()
+        try:
+            status, data = await self._request(method, path, params, body, hold)
+        except Exception:
+            status, data = 0, None
+        self.metrics.add(name, time.perf_counter() - t0, status)
+        return data if status == 200 else None
+
+    async def stream(self, path: str, params: dict, on_event, stop_at: float):
+        """SSE до stop_at (или пока сервер не закроет); в метрики - время до заголовков ответа."""
+        name = f"SSE {path}"
+        t0 = time.perf_counter()
+        opened = False
+
+        def on_open(status):
+            nonlocal opened
+            opened = True
+            self.metrics.add(name, time.perf_counter() - t0, status)
+
+        def counted(event, data):
+            self.metrics.sse_events += 1
+            on_event(event, data)
+
+        try:
+            await self._sse(path, params, on_open, SseParser(counted), stop_at)
+        except Exception:
+            if not opened:
+                self.metrics.add(name, time.perf_counter() - t0, 0)
+
+
+class VirtualUser:
+
+    def __init__(self, i: int, seed: int, rnd: random.Random, speed: float, pop_users: int):
+        self.i = i
+        self.tg = tg_of(i)
+        _, self.lat, self.lon = user_home(i, seed)
+        self.rnd = rnd
+        self.speed = speed
+        self.pop_users = pop_users
+        self.eater = rnd.random() < P_EATER
+        self.eating = False
+        self.nearby = []
+        self._to_mark = []
+        self._mark_task = None
+
+    def _s(self, seconds: float) -> float:
+        # интервал клиента -> секунды прогона, с джиттером чтобы VU не шли строем
+        return seconds / self.speed * self.rnd.uniform(0.8, 1.2)
+
+    def _peer(self) -> int:
+        return tg_of(self.rnd.randrange(self.pop_users))
+
+    async def open_app(self, c: Client):
+        # экран профиля + главная: профиль, теги, похожие, места, сразу по опросу
+        await c.call("GET", "/api/profile", {"tg_id": self.tg})
+        await c.call("GET", "/api/tags", {"limit": 50})
+        await c.call("GET", "/api/users/similar", {"tg_id": self.tg, "limit": 12})
+        await c.call("GET", "/api/places", {"limit": 20})
+
+    async def wait_invites(self, c: Client, stop_at: float):
+        # inviteWaitLoop: сервер держит запрос до нового инвайта; отвечаем на первый показанный
+        since_id = 0
+        while True:
+            left = stop_at - time.perf_counter()
+            if left <= 0:
+                return
+            timeout = round(min(INVITE_WAIT_S / self.speed, left), 3)
+            data = await c.call("GET", "/api/invites/wait", {"tg_id": self.tg, "since_id": since_id,
+                                                             "timeout": timeout}, hold=True)
+            if data is None:
+                await asyncio.sleep(min(self._s(INVITE_WAIT_RETRY_S), max(0.0, stop_at - time.perf_counter())))
+                continue
+            since_id = max(since_id, data.get("last_id") or 0)
+            for inv in data.get("invites", [])[:1]:
+                if self.rnd.random() < P_RESPOND:
+                    await c.call("POST", "/api/invite/respond", body={
+                        "invite_id": inv["id"], "responder_tg_id": self.tg,
+                        "action": "accept" if self.rnd.random() < 0.7 else "decline"})
+
+    def on_notification(self, c: Client, event: str, data: str):
+        if event != "notification":
+            return
+        self._to_mark.append(json.loads(data)["id"])
+        if self._mark_task is None:
+            self._mark_task = asyncio.create_task(self._flush_marks(c))
+
+    async def _flush_marks(self, c: Client):
+        # как showNotification: показанные за NOTIF_MARK_DELAY помечаются одним mark_read_bulk
+        await asyncio.sleep(self._s(NOTIF_MARK_DELAY_S))
+        ids, self._to_mark, self._mark_task = self._to_mark, [], None
+        await c.call("POST", "/api/notifications/mark_read_bulk", body={"tg_id": self.tg, "ids": ids})
+
+    async def start_eating(self, c: Client):
+        await c.call("POST", "/start", body={"tg_id": self.tg, "lat": self.lat, "lon": self.lon})
+        data = await c.call("GET", "/nearby", {"tg_id": self.tg, "lat": self.lat, "lon": self.lon, "radius_km": 3.0})
+        self.nearby = (data or {}).get("nearby", []) if isinstance(data, dict) else []
+        self.eating = True
+
+    async def heartbeat(self, c: Client):
+        self.lat += self.rnd.gauss(0, 0.0002)
+        self.lon += self.rnd.gauss(0, 0.0002)
+        data = await c.call("POST", "/heartbeat", body={"tg_id": self.tg, "lat": self.lat, "lon": self.lon,
+                                                        "radius_km": 3.0})
+        if data:
+            self.nearby = data.get("nearby") or []
+        if self.nearby and self.rnd.random() < P_INVITE:
+            peer = self.rnd.choice(self.nearby)
+            if peer.get("tg_id"):
+                await c.call("POST", "/api/invite", body={"from_tg_id": self.tg, "to_tg_id": peer["tg_id"],
+                                                          "time_iso": None, "meal_type": "обед"})
+
+    async def stop_eating(self, c: Client):
+        await c.call("POST", "/stop", body={"tg_id": self.tg})
+        self.eating = False
+
+    async def browse(self, c: Client):
+        r = self.rnd.random()
+        if r < 0.4:
+            await c.call("GET", "/api/users/similar", {"tg_id": self.tg, "limit": 12})
+        elif r < 0.8:
+            peer = self._peer()
+            await c.call("GET", "/api/profile", {"tg_id": peer})
+            await c.call("GET", "/api/reviews", {"tg_id": peer, "viewer_tg_id": self.tg})
+            if self.rnd.random() < P_REVIEW:
+                await c.call("POST", "/api/review/toggle", body={"reviewer_tg_id": self.tg, "target_tg_id": peer,
+                                                                 "reaction": self.rnd.choice(REACTIONS)})
+        elif r < 0.95:
+            await c.call("GET", "/api/tags", {"limit": 50})
+        else:
+            await c.call("POST", "/api/profile/tags", body={"tg_id": self.tg,
+                                                            "tags": self.rnd.sample(TAGS, self.rnd.randint(1, 5))})
+
+    async def run(self, c: Client, stop_at: float, start_delay: float):
+        await asyncio.sleep(start_delay)
+        if time.perf_counter() >= stop_at:
+            return
+        await self.open_app(c)
+        # SSE и long-poll живут весь прогон, как у открытого мини-аппа
+        background = [
+            asyncio.create_task(c.stream("/api/notifications/stream", {"tg_id": self.tg},
+                                         lambda ev, data: self.on_notification(c, ev, data), stop_at)),
+            asyncio.create_task(self.wait_invites(c, stop_at)),
+        ]
+        now = time.perf_counter()
+        timers = [(now + self._s(BROWSE_S), "browse")]
+        if self.eater:
+            await self.start_eating(c)
+            timers.append((now + self._s(HEARTBEAT_S), "heartbeat"))
+            timers.append((now + self._s(60 * self.rnd.uniform(*EAT_MINUTES)), "stop"))
+        heapq.heapify(timers)
+        while timers:
+            due, what = heapq.heappop(timers)
+            if due >= stop_at:
+                break
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            now = time.perf_counter()
+            if what == "browse":
+                await self.browse(c)
+                heapq.heappush(timers, (now + self._s(BROWSE_S), what))
+            elif what == "heartbeat" and self.eating:
+                await self.heartbeat(c)
+                heapq.heappush(timers, (now + self._s(HEARTBEAT_S), what))
+            elif what == "stop":
+                await self.stop_eating(c)
+                heapq.heappush(timers, (now + self._s(60 * self.rnd.uniform(*IDLE_MINUTES)), "start"))
+            elif what == "start":
+                await self.start_eating(c)
+                heapq.heappush(timers, (now + self._s(HEARTBEAT_S), "heartbeat"))
+                heapq.heappush(timers, (now + self._s(60 * self.rnd.uniform(*EAT_MINUTES)), "stop"))
+        await asyncio.gather(*background)
+        if self._mark_task is not None:
+            await self._mark_task
+
+
+async def _asgi_sse(app, path: str, params: dict, on_open, parser: SseParser, stop_at: float):
+    """SSE к приложению в процессе: httpx.ASGITransport отдаёт тело только целиком."""
+    stop = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await stop.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            on_open(message["status"])
+        elif message["type"] == "http.response.body":
+            parser.feed(message.get("body", b""))
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": urlencode(params).encode(), "root_path": "",
+        "headers": [(b"host", b"app"), (b"accept", b"text/event-stream")], "server": ("app", 80),
+        "client": ("bench", 1),
+    }
+    task = asyncio.create_task(app(scope, receive, send))
+    try:
+        await asyncio.wait_for(asyncio.shield(task), max(0.0, stop_at - time.perf_counter()))
+    except asyncio.TimeoutError:
+        # клиент ушёл: приложение видит http.disconnect и закрывает поток
+        stop.set()
+        try:
+            await asyncio.wait_for(task, 5)
+        except Exception:
+            task.cancel()
+
+
+async def run_load(request_fn, sse_fn, pop_users: int, seed: int, vus: int, duration: float, ramp: float, speed: float):
+    metrics = Metrics()
+    client = Client(metrics, request_fn, sse_fn)
+    rnd = random.Random(seed + 7)
+    picked = rnd.sample(range(pop_users), min(vus, pop_users))
+    users = [VirtualUser(i, seed, random.Random(seed * 31 + i), speed, pop_users) for i in picked]
+    metrics.t_start = time.perf_counter()
+    stop_at = metrics.t_start + duration
+    await asyncio.gather(*(u.run(client, stop_at, ramp * k / max(1, len(users))) for k, u in enumerate(users)))
+    metrics.t_end = time.perf_counter()
+    return metrics
+
+
+def print_report(rep: dict):
+    print(f"\n{'endpoint':<34} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>9} {'err%':>6}")
+    for name, r in rep["endpoints"].items():
+        print(f"{name:<34} {r['count']:>7} {r['rps']:>8.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+              f"{r['p99_ms']:>8.2f} {r['max_ms']:>9.2f} {r['error_rate'] * 100:>6.2f}")
+    print(f"\ntotal: {rep['requests']} requests in {rep['elapsed_s']}s = {rep['rps']} rps, "
+          f"errors {rep['errors']} ({rep['error_rate'] * 100:.2f}%)")
+
+
+async def _in_process(args):
+    """Своя БД с популяцией, fake Telegram и приложение через ASGI-транспорт httpx."""
+    if httpx is None:
+        sys.exit("in-process mode needs httpx (pip install httpx) - or use --url")
+    from bench.fake_telegram import FakeConfig, start_fake_telegram
+    from bench.population import seed_population
+
+    tmp = tempfile.mkdtemp(prefix="meeteat-load-")
+    path = args.db or os.path.join(tmp, "load.sqlite3")
+    # config читается при импорте: окружение до import main (его импортирует и seed_population)
+    os.environ["DB_PATH"] = path
+    os.environ["TELEGRAM_FAKE_API"] = f"http://127.0.0.1:{args.fake_port}"
+    if not args.db:
+        print(f"seeding {args.users} users into {path}")
+        await asyncio.to_thread(seed_population, path, args.users, seed=args.seed)
+    import main
+
+    async with AsyncExitStack() as stack:
+        runner = await start_fake_telegram("127.0.0.1", args.fake_port,
+                                           FakeConfig(latency_ms=args.fake_latency_ms, enforce_limits=True))
+        stack.push_async_callback(runner.cleanup)
+        await stack.enter_async_context(main.lifespan(main.app))
+        transport = httpx.ASGITransport(app=main.app)
+        http = await stack.enter_async_context(httpx.AsyncClient(transport=transport, base_url="http://app"))
+
+        async def request(method, path, params, body, hold):
+            r = await http.request(method, path, params=params, json=body)
+            return r.status_code, (r.json() if r.status_code == 200 else None)
+
+        async def sse(path, params, on_open, parser, stop_at):
+            await _asgi_sse(main.app, path, params, on_open, parser, stop_at)
+
+        metrics = await run_load(request, sse, args.users, args.seed, args.vus, args.duration, args.ramp, args.speed)
+        stats = (await http.get("/api/stats")).json()
+    return metrics, stats
+
+
+async def _over_http(args):
+    conn = aiohttp.TCPConnector(limit=args.connections)
+    # SSE и long-poll держат по соединению на VU - отдельный пул без лимита, чтобы не занимать общий
+    hold_conn = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(base_url=args.url, connector=conn) as http, \
+            aiohttp.ClientSession(base_url=args.url, connector=hold_conn) as hold_http:
+
+        async def request(method, path, params, body, hold):
+            if params:
+                params = {k: str(v) for k, v in params.items()}
+            async with (hold_http if hold else http).request(method, path, params=params, json=body) as r:
+                return r.status, (await r.json(content_type=None) if r.status == 200 else None)
+
+        async def sse(path, params, on_open, parser, stop_at):
+            params = {k: str(v) for k, v in params.items()}
+            async with hold_http.get(path, params=params, timeout=aiohttp.ClientTimeout(total=None)) as r:
+                on_open(r.status)
+                if r.status != 200:
+                    return
+
+                async def read():
+                    async for chunk in r.content.iter_any():
+                        parser.feed(chunk)
+                try:
+                    await asyncio.wait_for(read(), max(0.0, stop_at - time.perf_counter()))
+                except asyncio.TimeoutError:
+                    pass
+
+        metrics = await run_load(request, sse, args.pop_users, args.seed, args.vus, args.duration, args.ramp, args.speed)
+        try:
+            async with http.get("/api/stats") as r:
+                stats = await r.json(content_type=None)
+        except Exception:
+            stats = None
+    return metrics, stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description="meet&eat end-to-end load test")
+    ap.add_argument("--url", default=None, help="HTTP-режим: адрес запущенного сервера (иначе in-process)")
+    ap.add_argument("--users", type=int, default=10_000, help="in-process: размер сидируемой популяции")
+    ap.add_argument("--db", default=None, help="in-process: готовая БД из bench.population вместо сидирования")
+    ap.add_argument("--pop-users", type=int, default=10_000, help="HTTP-режим: размер популяции на сервере")
+    ap.add_argument("--seed", type=int, default=1, help="тот же seed, что при сидировании")
+    ap.add_argument("--vus", type=int, default=200)
+    ap.add_argument("--duration", type=float, default=60.0)
+    ap.add_argument("--ramp", type=float, default=10.0)
+    ap.add_argument("--speed", type=float, default=10.0)
+    ap.add_argument("--connections", type=int, default=100, help="HTTP-режим: размер пула соединений")
+    ap.add_argument("--fake-port", type=int, default=8081)
+    ap.add_argument("--fake-latency-ms", type=float, default=50.0)
+    ap.add_argument("--json", default=None, help="записать отчёт (и /api/stats сервера) в файл")
+    args = ap.parse_args()
+
+    metrics, stats = asyncio.run(_over_http(args) if args.url else _in_process(args))
+    rep = metrics.report()
+    print_report(rep)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "report": rep, "server_stats": stats}, f, ensure_ascii=False, indent=2)
+        print(f"written {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+# bench/micro.py
+#
+# Микробенчмарки горячих чистых функций, которые вызываются на каждый запрос:
+# haversine_km, parse_float/parse_int, safe_avatar_url, _validate_time_field,
+# нормализация тегов (/api/profile/tags) и HMAC initData (/verify_init).
+#
+#   python -m bench.micro                         # прогон + сравнение с bench/baselines/micro.json
+#   python -m bench.micro --save                  # записать текущие результаты как baseline
+#   python -m bench.micro --json /tmp/micro.json  # результаты для сравнения между коммитами
+#   python -m bench.micro --compare a.json b.json # сравнить два сохранённых прогона
+#   python -m bench.micro --filter tags --threshold 0.15
+#
+# Каждый кейс прогоняется --repeat раз по number вызовов (короткие кейсы - по несколько
+# проходов, чтобы замер длился не меньше MIN_RUN_S); сравнивается лучший прогон
+# (как советует timeit: остальные медленнее из-за шума системы, а не кода), GC на время замера выключен.
+# Чтобы baseline переносился между машинами, время делится на калибровочный цикл
+# чистого Python, замеренный рядом с каждым прогоном ("norm" - медиана отношений);
+# регрессия = norm вырос больше чем на --threshold.
+# Код выхода 1, если есть регрессия.
+
+import gc
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import statistics
+
+from places import _validate_time_field, safe_avatar_url
+from utils import haversine_km, init_data_hash, normalize_tags, parse_float, parse_int
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "micro.json")
+DEFAULT_THRESHOLD = 0.25
+# один замер короче этого шумит сильнее, чем регрессии, которые мы ловим
+MIN_RUN_S = 0.02
+
+CASES = {}
+
+
+def case(name: str, number: int):
+    """Регистрирует кейс: fn(rnd) -> callable без аргументов, делающий number вызовов."""
+    def deco(fn):
+        CASES[name] = (fn, number)
+        return fn
+    return deco
+
+
+_CALIB_N = 50_000
+
+
+def _calib_loop():
+    # эталон "скорости интерпретатора": простой цикл с арифметикой
+    x = 0
+    for i in range(_CALIB_N):
+        x += i & 7
+    return x
+
+
+def _timed(fn, loops: int = 1) -> float:
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        return time.perf_counter() - t0
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _autorange(fn) -> int:
+    """Сколько проходов fn нужно, чтобы замер длился не меньше MIN_RUN_S (как timeit.autorange)."""
+    loops = 1
+    while True:
+        if _timed(fn, loops) >= MIN_RUN_S:
+            return loops
+        loops *= 2
+
+
+# ----------------------
+# кейсы
+# ----------------------
+@case("haversine_km", 20_000)
+def _haversine(rnd):
+    pts = [(43.2 + rnd.uniform(-0.1, 0.1), 76.9 + rnd.uniform(-0.1, 0.1),
+            43.2 + rnd.uniform(-0.1, 0.1), 76.9 + rnd.uniform(-0.1, 0.1)) for _ in range(20_000)]
+
+    def run():
+        for a, b, c, d in pts:
+            haversine_km(a, b, c, d)
+    return run
+
+
+@case("parse_float", 20_000)
+def _parse_float(rnd):
+    vals = [rnd.choice((f"{rnd.uniform(-90, 90):.6f}", rnd.uniform(-90, 90), rnd.randint(-90, 90)))
+            for _ in range(20_000)]
+
+    def run():
+        for v in vals:
+            parse_float(v, "lat")
+    return run
+
+
+@case("parse_int", 20_000)
+def _parse_int(rnd):
+    vals = [rnd.choice((str(rnd.randint(1, 10**10)), rnd.randint(1, 10**10))) for _ in range(20_000)]
+
+    def run():
+        for v in vals:
+            parse_int(v, "tg_id")
+    return run
+
+
+@case("parse_float_invalid", 2_000)
+def _parse_float_invalid(rnd):
+    # путь с исключением (HTTPException 400) - битые координаты от клиента
+    vals = [rnd.choice(("", "abc", None, "1,5", {})) for _ in range(2_000)]
+
+    def run():
+        for v in vals:
+            try:
+                parse_float(v, "lat")
+            except Exception:
+                pass
+    return run
+
+
+@case("safe_avatar_url", 10_000)
+def _safe_avatar(rnd):
+    pool = ("https://t.me/i/userpic/320/abcdefghijklmnop.jpg", "http://example.com/a.png", None, "",
+            "javascript:alert(1)", "data:image/png;base64,AAAA", "https://cdn.example.com/" + "x" * 1200,
+            "  https://example.com/spaced.png  ")
+    vals = [rnd.choice(pool) for _ in range(10_000)]
+
+    def run():
+        for v in vals:
+            safe_avatar_url(v)
+    return run
+
+
+@case("validate_time_field", 20_000)
+def _validate_time(rnd):
+    pool = ("09:00", "23:59", " 7:5 ", "24:00", "12-00", "", None, "noon", 930)
+    vals = [rnd.choice(pool) for _ in range(20_000)]
+
+    def run():
+        for v in vals:
+            _validate_time_field(v)
+    return run
+
+
+@case("normalize_tags", 2_000)
+def _normalize(rnd):
+    words = ("Кофе", "IT", "спорт", " бег ", "Книги", "кино", "", "  ", "Python", "python", "x" * 100, 42)
+    lists = [[rnd.choice(words) for _ in range(rnd.randint(3, 15))] for _ in range(2_000)]
+
+    def run():
+        for tags in lists:
+            normalize_tags(tags)
+    return run
+
+
+@case("init_data_hash", 5_000)
+def _init_hash(rnd):
+    token = "123456:AAbbCCddEEffGGhhIIjjKKllMMnnOOppQQr"
+    datas = []
+    for i in range(5_000):
+        user = json.dumps({"id": 10_000_000 + i, "first_name": "Имя", "username": f"user{i}",
+                           "language_code": "ru", "photo_url": f"https://t.me/i/userpic/320/{i}.jpg"},
+                          separators=(",", ":"), ensure_ascii=False)
+        d = {"query_id": f"AAH{rnd.getrandbits(64):x}", "user": user, "auth_date": str(1_700_000_000 + i),
+             "signature": f"{rnd.getrandbits(256):x}"}
+        d["hash"] = init_data_hash(d, token)
+        datas.append(d)
+
+    def run():
+        for d in datas:
+            init_data_hash(d, token)
+    return run
+
+
+# ----------------------
+# прогон / сравнение
+# ----------------------
+def run_cases(names, repeat: int, seed: int = 1, verbose: bool = True):
+    # калибровочный цикл меряется вплотную к каждому прогону кейса: нагрузка на машине
+    # меняется за время прогона, и общий для всех кейсов эталон даёт сдвиг всего столбца
+    calib_loops = _autorange(_calib_loop)
+    calibs = []
+    results = {}
+    for name in names:
+        fn, number = CASES[name]
+        run = fn(random.Random(seed))
+        loops = _autorange(run)  # заодно прогрев
+        times, ratios = [], []
+        for _ in range(repeat):
+            c = _timed(_calib_loop, calib_loops) * 1e9 / (_CALIB_N * calib_loops)
+            t = _timed(run, loops) * 1e9 / (number * loops)
+            calibs.append(c)
+            times.append(t)
+            ratios.append(t / c)
+        results[name] = {
+            "number": number,
+            "loops": loops,
+            "repeat": repeat,
+            "ns_per_call": round(min(times), 1),
+            "median_ns": round(statistics.median(times), 1),
+            "stdev_ns": round(statistics.stdev(times), 1) if len(times) > 1 else 0.0,
+            # медиана отношений соседних замеров: шум, задевший оба, сокращается
+            "norm": round(statistics.median(ratios), 4),
+        }
+        if verbose:
+            r = results[name]
+            print(f"{name:<22} {r['ns_per_call']:>10.1f} ns  (median {r['median_ns']:.1f}, sd {r['stdev_ns']:.1f})")
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "calibration_ns": round(min(calibs), 3),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+        },
+        "results": results,
+    }
+
+
+def compare(base: dict, cur: dict, threshold: float, key: str = "norm"):
+    """-> [(name, base, cur, delta)] и список регрессий (delta > threshold)."""
+    rows, regressions = [], []
+    for name, r in cur["results"].items():
+        b = base.get("results", {}).get(name)
+        if b is None or not b.get(key):
+            rows.append((name, None, r[key], None))
+            continue
+        delta = r[key] / b[key] - 1.0
+        rows.append((name, b[key], r[key], delta))
+        if delta > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_compare(rows, regressions, threshold: float, key: str):
+    print(f"\n{'case':<22} {'baseline':>10} {'current':>10} {'delta':>8}   ({key}, threshold +{threshold:.0%})")
+    for name, b, c, d in rows:
+        if d is None:
+            print(f"{name:<22} {'-':>10} {c:>10.3f} {'new':>8}")
+        else:
+            mark = "  REGRESSION" if name in regressions else ""
+            print(f"{name:<22} {b:>10.3f} {c:>10.3f} {d:>+8.1%}{mark}")
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _dump(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="microbenchmarks for hot pure functions")
+    ap.add_argument("--filter", default=None, help="только кейсы, в имени которых есть подстрока")
+    ap.add_argument("--repeat", type=int, default=15)
+    ap.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="допустимый рост norm (0.25 = +25%%)")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--save", action="store_true", help="записать результат в --baseline")
+    ap.add_argument("--json", default=None, help="записать результат в файл")
+    ap.add_argument("--raw", action="store_true", help="сравнивать ns_per_call, а не нормированное время")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "CURRENT"), help="сравнить два сохранённых прогона")
+    args = ap.parse_args()
+    key = "ns_per_call" if args.raw else "norm"
+
+    if args.compare:
+        rows, regressions = compare(_load(args.compare[0]), _load(args.compare[1]), args.threshold, key)
+        print_compare(rows, regressions, args.threshold, key)
+        sys.exit(1 if regressions else 0)
+
+    names = [n for n in CASES if not args.filter or args.filter in n]
+    if not names:
+        ap.error(f"no cases match {args.filter!r}")
+    cur = run_cases(names, args.repeat)
+    print(f"calibration: {cur['meta']['calibration_ns']} ns/iter")
+    if args.json:
+        _dump(args.json, cur)
+        print(f"written {args.json}")
+    if args.save:
+        # частичный прогон (--filter) обновляет только свои кейсы
+        base = _load(args.baseline) if os.path.exists(args.baseline) else {"results": {}}
+        base["meta"] = cur["meta"]
+        base["results"].update(cur["results"])
+        _dump(args.baseline, base)
+        print(f"baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline} - run with --save")
+        return
+    rows, regressions = compare(_load(args.baseline), cur, args.threshold, key)
+    print_compare(rows, regressions, args.threshold, key)
+    if regressions:
+        print(f"\nregressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# bench/population.py
+#
+# Синтетическая популяция для нагрузочных тестов: свежая БД (через main.init_db)
+# с пользователями вокруг центров городов, тегами (zipf), живыми и историческими
+# сессиями, приглашениями, уведомлениями, отзывами и заведениями.
+#
+#   python -m bench.population --users 100000 --out /tmp/pop.sqlite3
+#
+# Домашняя точка пользователя - детерминированная функция (seed, номер), поэтому
+# bench/loadtest.py восстанавливает её без отдельного файла: user_home(i, seed).
+
+import os
+import time
+import math
+import random
+import asyncio
+import sqlite3
+import argparse
+import aiosqlite
+from datetime import datetime, timedelta, timezone
+
+from app.sessions import BACKFILL_LAST_SEEN_SQL, rebuild_rtree
+
+# (город, lat, lon, вес, sigma_km) - вес ~ доля пользователей
+CITIES = (
+    ("Алматы", 43.238, 76.945, 0.40, 6.0),
+    ("Астана", 51.169, 71.449, 0.30, 5.0),
+    ("Шымкент", 42.341, 69.590, 0.15, 4.0),
+    ("Караганда", 49.806, 73.085, 0.10, 3.5),
+    ("Актобе", 50.283, 57.167, 0.05, 3.0),
+)
+
+TAGS = ("кофе", "it", "спорт", "бег", "книги", "кино", "музыка", "путешествия", "стартапы", "дизайн",
+        "йога", "футбол", "настолки", "фото", "маркетинг", "финансы", "английский", "вегетарианство",
+        "горы", "велосипед", "искусство", "театр", "python", "js", "product", "hr", "медицина",
+        "юриспруденция", "архитектура", "блогинг", "аниме", "шахматы", "танцы", "кулинария", "вино")
+
+REACTIONS = ("Приятный собеседник", "Мыслит нестандартно", "Крутой нетворкер", "Любит свое дело",
+             "Позитивный и энергичный")
+
+TG_BASE = 10_000_000
+_TS = '%Y-%m-%d %H:%M:%S'
+_CUM = []
+_acc = 0.0
+for _c in CITIES:
+    _acc += _c[3]
+    _CUM.append(_acc)
+
+
+def tg_of(i: int) -> int:
+    return TG_BASE + i
+
+
+def user_home(i: int, seed: int = 1):
+    """-> (city_index, lat, lon) для i-го пользователя; одинаково при сидировании и в loadtest."""
+    rnd = random.Random(seed * 1_000_003 + i)
+    x = rnd.random() * _acc
+    ci = next(k for k, c in enumerate(_CUM) if x <= c)
+    _, lat0, lon0, _, sigma_km = CITIES[ci]
+    dlat = rnd.gauss(0, sigma_km) / 111.0
+    dlon = rnd.gauss(0, sigma_km) / (111.0 * math.cos(math.radians(lat0)))
+    return ci, lat0 + dlat, lon0 + dlon
+
+
+def _zipf_tags(rnd: random.Random, k: int):
+    # частота тега ~ 1/rank: "кофе" у многих, "вино" у единиц
+    weights = [1.0 / (r + 1) for r in range(len(TAGS))]
+    out = set()
+    while len(out) < k:
+        out.add(rnd.choices(TAGS, weights)[0])
+    return out
+
+
+def seed_population(path: str, users: int, active_frac: float = 0.02, history_per_user: float = 3.0,
+                    invites_per_user: float = 0.5, reviews_per_user: float = 1.0, places: int = 200,
+                    seed: int = 1, verbose: bool = True):
+    """Создаёт БД по path и наполняет её. -> сводка (dict)."""
+    from main import init_db
+
+    t0 = time.perf_counter()
+    asyncio.run(init_db(path))
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+
+    def log(msg):
+        if verbose:
+            print(f"[{time.perf_counter() - t0:7.1f}s] {msg}", flush=True)
+
+    # users: id == i + 1 (свежая таблица, AUTOINCREMENT с 1)
+    homes = [user_home(i, seed) for i in range(users)]
+    db.executemany(
+        "INSERT INTO users (tg_id, name, username, age, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+        ((tg_of(i), f"User {i}", f"user{i}", rnd.randint(18, 55),
+          (now - timedelta(days=rnd.randint(0, 365))).strftime(_TS), now.strftime(_TS))
+         for i in range(users))
+    )
+    log(f"users: {users}")
+
+    def gen_tags():
+        for i in range(users):
+            for tag in _zipf_tags(rnd, rnd.randint(0, 6)):
+                yield (i + 1, tag)
+    db.executemany("INSERT OR IGNORE INTO user_tags (user_id, tag) VALUES (?, ?)", gen_tags())
+    log("tags")
+
+    # история: погасшие сессии за последние полгода рядом с домом
+    sql = "INSERT INTO eat_sessions (user_id, lat, lon, started_at, expires_at, active) VALUES (?, ?, ?, ?, ?, ?)"
+
+    def gen_history():
+        for _ in range(int(users * history_per_user)):
+            i = rnd.randrange(users)
+            _, lat, lon = homes[i]
+            start = now - timedelta(hours=rnd.uniform(2, 24 * 180))
+            yield (i + 1, lat + rnd.gauss(0, 0.005), lon + rnd.gauss(0, 0.005),
+                   start.strftime(_TS), (start + timedelta(hours=1)).strftime(_TS), 0)
+    db.executemany(sql, gen_history())
+    log("history sessions")
+
+    active = rnd.sample(range(users), int(users * active_frac))
+
+    def gen_active():
+        for i in active:
+            _, lat, lon = homes[i]
+            start = now - timedelta(minutes=rnd.uniform(0, 50))
+            yield (i + 1, lat, lon, start.strftime(_TS), (start + timedelta(hours=1)).strftime(_TS), 1)
+    db.executemany(sql, gen_active())
+    log(f"active sessions: {len(active)}")
+
+    # приглашения между пользователями одного города; часть принята/отклонена
+    by_city = {}
+    for i, (ci, _, _) in enumerate(homes):
+        by_city.setdefault(ci, []).append(i)
+    n_inv = int(users * invites_per_user)
+    statuses = ("pending", "accepted", "declined")
+    inv_rows, notif_rows = [], []
+    for k in range(n_inv):
+        a = rnd.randrange(users)
+        peers = by_city[homes[a][0]]
+        b = rnd.choice(peers)
+        if a == b:
+            continue
+        st = rnd.choices(statuses, (0.3, 0.5, 0.2))[0]
+        created = now - timedelta(hours=rnd.uniform(0, 24 * 30))
+        responded = (created + timedelta(minutes=rnd.uniform(1, 600))).strftime(_TS) if st != "pending" else None
+        inv_rows.append((a + 1, b + 1, (created + timedelta(days=1)).isoformat(), rnd.choice(("обед", "кофе", "ужин")),
+                         st, b + 1 if responded else None, responded, 1 if st == "accepted" else 0,
+                         created.strftime(_TS), created.strftime(_TS)))
+        if st != "pending":
+            notif_rows.append((a + 1, "invite_response", '{"status": "%s"}' % st, rnd.random() < 0.7,
+                               responded))
+    db.executemany(
+        "INSERT INTO invites (from_user_id, to_user_id, time_iso, meal_type, status, responder_user_id, responded_at, "
+        "survey_sent, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", inv_rows)
+    db.executemany("INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, ?, ?)",
+                   notif_rows)
+    log(f"invites: {len(inv_rows)}, notifications: {len(notif_rows)}")
+
+    def gen_reviews():
+        for _ in range(int(users * reviews_per_user)):
+            a = rnd.randrange(users)
+            b = rnd.choice(by_city[homes[a][0]])
+            if a != b:
+                yield (a + 1, b + 1, rnd.choice(REACTIONS),
+                       (now - timedelta(hours=rnd.uniform(0, 24 * 90))).strftime(_TS))
+    db.executemany("INSERT OR IGNORE INTO reviews (reviewer_id, target_user_id, reaction, created_at) VALUES (?, ?, ?, ?)",
+                   gen_reviews())
+    log("reviews")
+
+    db.executemany(
+        "INSERT INTO places (name, category, rating, open_time, close_time, address) VALUES (?, ?, ?, ?, ?, ?)",
+        ((f"Place {k}", rnd.choice(("кафе", "ресторан", "кофейня", "бар")), round(rnd.uniform(3, 5), 1),
+          "09:00", "23:00", f"{CITIES[k % len(CITIES)][0]}, ул. {k}") for k in range(places))
+    )
+    db.execute(BACKFILL_LAST_SEEN_SQL)
+    log("users.last_seen")
+    db.commit()
+    db.close()
+
+    async def _rebuild():
+        async with aiosqlite.connect(path) as adb:
+            await rebuild_rtree(adb, now.strftime(_TS))
+            await adb.commit()
+    asyncio.run(_rebuild())
+    # производные таблицы/индексы, которые init_db строит из данных, досчитываем повторным init
+    asyncio.run(init_db(path))
+    log("done")
+    return {
+        "path": path,
+        "users": users,
+        "seed": seed,
+        "active": len(active),
+        "active_users": active,
+        "invites": len(inv_rows),
+        "size_mb": round(os.path.getsize(path) / 1e6, 1),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="seed a synthetic meet&eat population")
+    ap.add_argument("--out", required=True, help="путь к новой БД (файл не должен существовать)")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--active-frac", type=float, default=0.02)
+    ap.add_argument("--history", type=float, default=3.0, help="погасших сессий на пользователя")
+    ap.add_argument("--invites", type=float, default=0.5, help="приглашений на пользователя")
+    ap.add_argument("--reviews", type=float, default=1.0, help="отзывов на пользователя")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    if os.path.exists(args.out):
+        ap.error(f"{args.out} already exists")
+    info = seed_population(args.out, args.users, args.active_frac, args.history, args.invites, args.reviews,
+                           seed=args.seed)
+    info.pop("active_users")
+    print(info)
+
+
+if __name__ == "__main__":
+    main()
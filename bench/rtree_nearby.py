@@ -0,0 +1,151 @@
+# bench/rtree_nearby.py
+#
+# Латентность /nearby: старый BETWEEN-скан по eat_sessions против пробы по R*Tree
+# и in-memory geohash-сетки
+# при разном объёме истории сессий (живых сессий всегда --active штук).
+#
+#   python -m bench.rtree_nearby                      # 10k, 100k, 1M
+#   python -m bench.rtree_nearby --rows 10000 --queries 500
+
+import os
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import aiosqlite
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+
+from app.geo import LiveSession, SessionGrid
+from app.sessions import LIVE_SESSIONS_SQL, NEARBY_RTREE_SQL, bbox, rebuild_rtree
+
+# старый запрос /nearby; "{hint}" = "NOT INDEXED" воспроизводит исходную схему без индексов
+LEGACY_SQL = """
+    SELECT e.id AS sid, e.lat, e.lon, e.started_at, e.expires_at, u.id AS user_id, u.tg_id,
+           u.name AS name, u.avatar AS avatar, u.username AS username, u.age AS age
+    FROM eat_sessions e {hint}
+    JOIN users u ON u.id = e.user_id
+    WHERE e.active = 1 AND e.expires_at > ?
+      AND e.lat BETWEEN ? AND ?
+      AND e.lon BETWEEN ? AND ?
+    LIMIT ?
+"""
+
+CITY = (43.238, 76.945)  # Алматы
+SPREAD_DEG = 0.15
+
+
+def _fmt(dt):
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def seed(path: str, rows: int, active: int, users: int):
+    from main import init_db
+
+    asyncio.run(init_db(path))
+    rnd = random.Random(42)
+    now = datetime.now(timezone.utc)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+    db.executemany("INSERT INTO users (tg_id, name) VALUES (?, ?)",
+                   ((100000 + i, f"user{i}") for i in range(users)))
+
+    def gen(n, is_active):
+        for i in range(n):
+            start = now - (timedelta(minutes=rnd.randint(0, 50)) if is_active else timedelta(hours=rnd.randint(2, 24 * 180)))
+            yield (rnd.randint(1, users),
+                   CITY[0] + rnd.uniform(-SPREAD_DEG, SPREAD_DEG),
+                   CITY[1] + rnd.uniform(-SPREAD_DEG, SPREAD_DEG),
+                   _fmt(start), _fmt(start + timedelta(hours=1)), 1 if is_active else 0)
+
+    sql = "INSERT INTO eat_sessions (user_id, lat, lon, started_at, expires_at, active) VALUES (?, ?, ?, ?, ?, ?)"
+    db.executemany(sql, gen(rows - active, False))
+    db.executemany(sql, gen(active, True))
+    db.commit()
+    db.close()
+
+    async def _rebuild():
+        async with aiosqlite.connect(path) as adb:
+            await rebuild_rtree(adb, _fmt(now))
+            await adb.commit()
+    asyncio.run(_rebuild())
+
+
+def run_queries(path: str, sql: str, rtree: bool, points, radius_km: float):
+    db = sqlite3.connect(path)
+    now_s = _fmt(datetime.now(timezone.utc))
+    timings = []
+    found = 0
+    for lat, lon in points:
+        min_lat, max_lat, min_lon, max_lon = bbox(lat, lon, radius_km)
+        params = ((min_lat, max_lat, min_lon, max_lon, now_s, 100) if rtree
+                  else (now_s, min_lat, max_lat, min_lon, max_lon, 100))
+        t0 = time.perf_counter()
+        found += len(db.execute(sql, params).fetchall())
+        timings.append((time.perf_counter() - t0) * 1000)
+    db.close()
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "avg_rows": found / len(points),
+    }
+
+
+def run_grid(path: str, points, radius_km: float):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    now_s = _fmt(datetime.now(timezone.utc))
+    grid = SessionGrid()
+    grid.load(LiveSession.from_row(r) for r in db.execute(LIVE_SESSIONS_SQL, (now_s,)))
+    timings = []
+    found = 0
+    for lat, lon in points:
+        t0 = time.perf_counter()
+        found += len(grid.query(lat, lon, radius_km, *bbox(lat, lon, radius_km), now_s)[0][:100])
+        timings.append((time.perf_counter() - t0) * 1000)
+    db.close()
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "avg_rows": found / len(points),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="R*Tree vs BETWEEN latency for /nearby")
+    ap.add_argument("--rows", type=int, nargs="*", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--active", type=int, default=2000, help="живых сессий среди rows")
+    ap.add_argument("--users", type=int, default=20000)
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--radius-km", type=float, default=3.0)
+    args = ap.parse_args()
+
+    rnd = random.Random(7)
+    points = [(CITY[0] + rnd.uniform(-SPREAD_DEG, SPREAD_DEG), CITY[1] + rnd.uniform(-SPREAD_DEG, SPREAD_DEG))
+              for _ in range(args.queries)]
+
+    print(f"{'rows':>10} {'query':>10} {'p50 ms':>9} {'p95 ms':>9} {'rows/q':>7}")
+    for n in args.rows:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "bench.sqlite3")
+            seed(path, n, min(args.active, n), args.users)
+            variants = (
+                ("scan", LEGACY_SQL.format(hint="NOT INDEXED"), False),         # как было: полный скан
+                ("active-ix", LEGACY_SQL.format(hint=""), False),              # BETWEEN + частичный индекс active=1
+                ("rtree", NEARBY_RTREE_SQL, True),
+            )
+            for name, sql, rtree in variants:
+                r = run_queries(path, sql, rtree, points, args.radius_km)
+                print(f"{n:>10} {name:>10} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['avg_rows']:>7.1f}")
+            # in-memory сетка (app/geo.py); rows/q - уже после отсечки по радиусу
+            r = run_grid(path, points, args.radius_km)
+            print(f"{n:>10} {'grid':>10} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['avg_rows']:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,46 @@
 # main.py
 
+import time
 import logging
 import asyncio
-import aiohttp
 import aiosqlite
-from app.config import DB_PATH
+from app.config import DB_PATH, SESSION_SWEEP_INTERVAL_S
+from app.chat import chat_hub, create_messages_table
+from app.db import init_pool, close_pool, get_pool
+from app.geo import LiveSession, session_grid
+from app.invites import backfill_invite_jobs, invite_waiters
+from app.jobs import create_jobs_table, job_worker_loop
+from app.notifications import create_notification_unread_table, notification_hub
+from app.outbox import create_outbox_table, outbox
+from app.retention import create_retention_tables, retention_loop
+from app.reviews import create_review_counts_table
+from app.tag_index import LAST_SEEN_SQL, tag_index
+from app.tags import create_tag_counts_table
+from app.telegram_utils import telegram
+from app.webhook import create_updates_table, webhook_dispatcher
+from app.sessions import (LIVE_SESSIONS_SQL, create_rtree, expire_session_ids, expire_sessions,
+                          migrate_users_last_seen, rebuild_rtree, session_expiry)
+from datetime import datetime, timezone
 from fastapi import FastAPI, Request
 from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
 
 from routes import router as api_router
-from routes import survey_dispatcher_loop
 
 
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+async def init_db(path: str = DB_PATH):
+    async with aiosqlite.connect(path) as db:
+        # incremental auto_vacuum: ретеншн возвращает место без полного VACUUM.
+        # На новой базе pragma действует сразу, существующую один раз перестраиваем.
+        cur = await db.execute("PRAGMA auto_vacuum")
+        if (await cur.fetchone())[0] != 2:
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            cur = await db.execute("SELECT count(*) FROM sqlite_master")
+            if (await cur.fetchone())[0]:
+                logging.info("init_db: switching to auto_vacuum=INCREMENTAL (one-time VACUUM)")
+                await db.execute("VACUUM;")
+
         await db.execute("PRAGMA journal_mode=WAL;")
         await db.execute("PRAGMA busy_timeout = 5000;")  # ms
         await db.commit()
@@ -62,6 +87,19 @@ async def init_db():
             CREATE INDEX IF NOT EXISTS idx_user_tags_tag 
                 ON user_tags(tag);
         """)
+        # счётчики популярности тегов для /api/tags и /api/tags/suggest
+        await create_tag_counts_table(db)
+        # активная сессия пользователя ищется на каждом /start и /stop
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_eat_sessions_user_active
+                ON eat_sessions(user_id) WHERE active = 1;
+        """)
+        # пространственный индекс по активным сессиям для /nearby
+        await create_rtree(db)
+        # архив старых сессий и сводка по пользователям
+        await create_retention_tables(db)
+        # users.last_seen для списков "недавно были" (нужны eat_sessions и user_activity)
+        await migrate_users_last_seen(db)
 
         await db.execute("""
             CREATE TABLE IF NOT EXISTS notifications (
@@ -73,6 +111,14 @@ async def init_db():
                 created_at TEXT DEFAULT (datetime('now'))
             );
         """)
+        # непрочитанные пользователя новыми первыми (/api/notifications, SSE, mark_read up_to_id) -
+        # диапазон индекса вместо скана всей таблицы
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_notifications_user_read
+                ON notifications(user_id, read, id);
+        """)
+        # число непрочитанных по пользователю (бейдж без COUNT по notifications)
+        await create_notification_unread_table(db)
         await db.execute("""
             CREATE TABLE IF NOT EXISTS invites (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -93,10 +139,27 @@ async def init_db():
                 FOREIGN KEY(to_user_id) REFERENCES users(id)
             );
         """)
+        # входящие pending-инвайты (/api/invites, /api/invites/wait) - без сортировки во временном B-дереве;
+        # idx_invites_to(to_user_id) - его префикс, больше не нужен
         await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_invites_to 
-                ON invites(to_user_id);
+            CREATE INDEX IF NOT EXISTS idx_invites_to_status
+                ON invites(to_user_id, status, created_at);
         """)
+        await db.execute("DROP INDEX IF EXISTS idx_invites_to;")
+        # исходящие accepted-инвайты - собеседники чата (/api/chat/contacts)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_invites_from_status
+                ON invites(from_user_id, status);
+        """)
+        # отложенные задачи (опрос после accept, протухание pending-инвайтов)
+        await create_jobs_table(db)
+        await backfill_invite_jobs(db)
+        # исходящие сообщения Telegram
+        await create_outbox_table(db)
+        # входящие апдейты webhook (дедупликация по update_id)
+        await create_updates_table(db)
+        # сообщения чата /ws/chat
+        await create_messages_table(db)
         await db.execute("""
             CREATE TABLE IF NOT EXISTS invite_surveys (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -124,6 +187,8 @@ async def init_db():
             CREATE INDEX IF NOT EXISTS idx_reviews_target 
                 ON reviews(target_user_id);
         """)
+        # счётчики реакций по пользователю для профиля
+        await create_review_counts_table(db)
 
         # places (заведения)
         await db.execute("""
@@ -146,6 +211,10 @@ async def init_db():
 
         await db.commit()
 
+        # R*Tree синхронизируется на /start, /stop и при истечении; при старте пересобираем
+        await rebuild_rtree(db, datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        await db.commit()
+
         try:
             await db.commit()
         except Exception:
@@ -153,29 +222,65 @@ async def init_db():
 
 
 async def cleanup_task(stop_event: asyncio.Event):
+    """Гасит сессии ровно по дедлайну из кучи session_expiry (точечно по id);
+    раз в SESSION_SWEEP_INTERVAL_S - страховочный sweep через R*Tree."""
+    last_sweep = time.monotonic()
     try:
         while not stop_event.is_set():
+            now = datetime.now(timezone.utc)
+            now_s = now.strftime('%Y-%m-%d %H:%M:%S')
             try:
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute(
-                        "UPDATE eat_sessions SET active = 0 WHERE expires_at <= datetime('now') AND active = 1"
-                    )
-                    await db.commit()
+                due = session_expiry.pop_due(now_s)
+                if due:
+                    async def _expire_due(db):
+                        return await expire_session_ids(db, [sid for sid, _ in due], now_s)
+                    session_grid.remove_sids(await get_pool().write(_expire_due))
+                    session_expiry.record_expired(due, now)
+
+                if time.monotonic() - last_sweep >= SESSION_SWEEP_INTERVAL_S:
+                    last_sweep = time.monotonic()
+
+                    async def _expire(db):
+                        return await expire_sessions(db, now_s)
+                    missed = await get_pool().write(_expire)
+                    session_expiry.sweeps += 1
+                    session_expiry.sweep_found += len(missed)
+                    session_expiry.discard(missed)
+                    session_grid.remove_sids(missed)
             except Exception as e:
                 logger = logging.getLogger("root")
                 logger.exception("cleanup_task: db update failed: %s", e)
+                await asyncio.sleep(1.0)
 
-            # ждём либо событие стопа, либо таймаут - но таймаут не должен завершать таск с ошибкой
-            try:
-                await asyncio.wait_for(stop_event.wait(), timeout=60.0)
-            except asyncio.TimeoutError:
-                continue
+            # спим до ближайшего дедлайна; /start с более ранним дедлайном будит раньше
+            now = datetime.now(timezone.utc)
+            sweep_in = max(0.0, SESSION_SWEEP_INTERVAL_S - (time.monotonic() - last_sweep))
+            await session_expiry.wait(session_expiry.seconds_until_next(now, sweep_in))
     except asyncio.CancelledError:
         # ожидаемо при shutdown
         logger = logging.getLogger("root")
         logger.info("cleanup_task cancelled")
         return
 
+async def warm_session_grid():
+    now_s = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    async with get_pool().reader() as db:
+        cur = await db.execute(LIVE_SESSIONS_SQL, (now_s,))
+        rows = await cur.fetchall()
+    session_grid.load(LiveSession.from_row(r) for r in rows)
+    session_expiry.load((r["sid"], r["expires_at"]) for r in rows)
+    logging.info("session grid warmed: %d sessions", len(session_grid))
+
+
+async def warm_tag_index():
+    async with get_pool().reader() as db:
+        cur = await db.execute("SELECT user_id, tag FROM user_tags")
+        tag_rows = [(r[0], r[1]) for r in await cur.fetchall()]
+        cur = await db.execute(LAST_SEEN_SQL)
+        seen_rows = [(r[0], r[1]) for r in await cur.fetchall()]
+    tag_index.load(tag_rows, seen_rows)
+    st = tag_index.stats(top=0)
+    logging.info("tag index warmed: %d users, %d tags", st["users"], st["tags"])
 
 
 @asynccontextmanager
@@ -183,20 +288,53 @@ async def lifespan(app: FastAPI):
     # инициализация БД
     await init_db()
 
-    # глобальная http сессия для всего приложения (для Telegram и других запросов)
-    import socket
-    app.state.http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50, family=socket.AF_INET))
+    # общий пул соединений: чтение через Depends(read_db), запись через очередь pool.write(op)
+    await init_pool()
+
+    # прогрев in-memory сетки живых сессий для /nearby и кучи дедлайнов для cleanup_task
+    try:
+        await warm_session_grid()
+    except Exception:
+        logging.exception("session grid warm-up failed, /nearby falls back to R*Tree")
+        session_expiry.load([])
+
+    # инвертированный индекс тегов для /api/users/similar
+    try:
+        await warm_tag_index()
+    except Exception:
+        logging.exception("tag index warm-up failed, /api/users/similar falls back to SQL")
+
+    # единый клиент Bot API (keep-alive пул, DNS-кэш, circuit breaker)
+    await telegram.start()
+    app.state.telegram = telegram
+
+    # отправка исходящих Telegram из outbox с лимитами Bot API
+    outbox.start()
+
+    # обработка апдейтов /telegram/webhook
+    webhook_dispatcher.start()
+
+    # SSE-подписки на уведомления и long-poll входящих инвайтов
+    notification_hub.start()
+    invite_waiters.start()
+
+    # WebSocket-чат: id сообщений продолжаются с MAX(id), запись в messages пачками
+    await chat_hub.start()
 
     stop_event = asyncio.Event()
 
     # один cleanup таск
     cleanup_t = asyncio.create_task(cleanup_task(stop_event))
 
-    # стартуем survey worker; если survey_dispatcher_loop требует args - передайте их
-    survey_task = asyncio.create_task(survey_dispatcher_loop())
+    # архивация старой истории eat_sessions
+    retention_t = asyncio.create_task(retention_loop(stop_event))
+
+    # воркер scheduled_jobs: спит до ближайшего due_at
+    jobs_t = asyncio.create_task(job_worker_loop())
 
-    app.state._survey_task = survey_task
+    app.state._jobs_task = jobs_t
     app.state._cleanup_task = cleanup_t
+    app.state._retention_task = retention_t
 
     try:
         yield
@@ -204,12 +342,16 @@ async def lifespan(app: FastAPI):
         # начинаем аккуратный shutdown
         stop_event.set()
 
+        # открытые SSE-стримы и long-poll запросы не должны держать shutdown
+        notification_hub.close()
+        invite_waiters.close()
+
         # отменяем таски и ждём их завершения аккуратно
-        for t in (cleanup_t, survey_task):
+        for t in (cleanup_t, retention_t, jobs_t):
             t.cancel()
 
         # дождёмся с обработкой CancelledError
-        for t in (cleanup_t, survey_task):
+        for t in (cleanup_t, retention_t, jobs_t):
             try:
                 await t
             except asyncio.CancelledError:
@@ -217,11 +359,38 @@ async def lifespan(app: FastAPI):
             except Exception:
                 logging.exception("Error awaiting task %s during shutdown", t)
 
-        # закроем http сессию
+        # закрываем WebSocket-чаты и дописываем накопленные сообщения
+        try:
+            await chat_hub.stop()
+        except Exception:
+            logging.exception("Error stopping chat hub")
+
+        # webhook-воркеры останавливаем раньше outbox: они ставят в него сообщения
+        try:
+            await webhook_dispatcher.stop()
+        except Exception:
+            logging.exception("Error stopping webhook workers")
+
+        # досылаем созревшие сообщения outbox, пока живы http клиент и пул
+        try:
+            await outbox.stop()
+        except Exception:
+            logging.exception("Error draining outbox")
+
+        # закроем http клиент Telegram
+        try:
+            await telegram.close()
+        except Exception:
+            logging.exception("Error closing telegram client")
+
+        session_grid.ready = False
+        tag_index.ready = False
+
+        # закроем пул соединений последним - таски выше могли ещё писать в БД
         try:
-            await app.state.http_session.close()
+            await close_pool()
         except Exception:
-            logging.exception("Error closing http_session")
+            logging.exception("Error closing db pool")
 
 
 app = FastAPI(lifespan=lifespan, title="meet&eat")
@@ -1,6 +1,8 @@
 import aiosqlite
 from urllib.parse import urlparse
-from fastapi import Body, HTTPException, Request
+from fastapi import Body, Depends, HTTPException, Request
+
+from app.db import DBPool, db_pool, read_db
 
 def _clamp_rating(v):
     try:
@@ -55,40 +57,38 @@ def safe_avatar_url(url):
     
 
 
-def places_router(router, DB_PATH, templates):
+def places_router(router, templates):
     @router.get("/places")
     async def places_page(request: Request):
         return templates.TemplateResponse("places.html", {"request": request})
 
     @router.get("/api/places")
-    async def api_get_places(limit: int = 50, category: str = None):
+    async def api_get_places(limit: int = 50, category: str = None, db: aiosqlite.Connection = Depends(read_db)):
         """Возвращает список мест. Опционально фильтр по category."""
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            if category:
-                cur = await db.execute("SELECT * FROM places WHERE category = ? ORDER BY created_at DESC LIMIT ?", (category, limit))
-            else:
-                cur = await db.execute("SELECT * FROM places ORDER BY created_at DESC LIMIT ?", (limit,))
-            rows = await cur.fetchall()
-            out = []
-            for r in rows:
-                out.append({
-                    "id": r["id"],
-                    "name": r["name"],
-                    "category": r["category"],
-                    "rating": float(r["rating"]) if r["rating"] is not None else 0.0,
-                    "open_time": r["open_time"],
-                    "close_time": r["close_time"],
-                    "address": r["address"],
-                    "photo": safe_avatar_url(r["photo"]) if r["photo"] else None,  # reuse safe_avatar_url helper
-                    "created_by_tg_id": r["created_by_tg_id"],
-                    "created_at": r["created_at"]
-                })
+        if category:
+            cur = await db.execute("SELECT * FROM places WHERE category = ? ORDER BY created_at DESC LIMIT ?", (category, limit))
+        else:
+            cur = await db.execute("SELECT * FROM places ORDER BY created_at DESC LIMIT ?", (limit,))
+        rows = await cur.fetchall()
+        out = []
+        for r in rows:
+            out.append({
+                "id": r["id"],
+                "name": r["name"],
+                "category": r["category"],
+                "rating": float(r["rating"]) if r["rating"] is not None else 0.0,
+                "open_time": r["open_time"],
+                "close_time": r["close_time"],
+                "address": r["address"],
+                "photo": safe_avatar_url(r["photo"]) if r["photo"] else None,  # reuse safe_avatar_url helper
+                "created_by_tg_id": r["created_by_tg_id"],
+                "created_at": r["created_at"]
+            })
         return {"ok": True, "places": out}
 
 
     @router.post("/api/places")
-    async def api_create_place(request: Request):
+    async def api_create_place(request: Request, pool: DBPool = Depends(db_pool)):
         """body JSON:
         {
         "name": "Cafe",
@@ -123,49 +123,44 @@ def places_router(router, DB_PATH, templates):
         except Exception:
             created_by = None
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            # <- Важно: надо получить Row-объекты, чтобы обращаться по имени колонок
-            db.row_factory = aiosqlite.Row
-
+        async def _insert(db):
             cur = await db.execute(
                 "INSERT INTO places (name, category, rating, open_time, close_time, address, photo, created_by_tg_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                 (name, category, rating, open_time, close_time, address, photo, created_by)
             )
-            await db.commit()
+            return cur.lastrowid
 
-            place_id = cur.lastrowid
+        place_id = await pool.write(_insert)
 
-            # Выборка вставленной записи - теперь fetchone() вернёт aiosqlite.Row
+        # Выборка вставленной записи - запись уже закоммичена, читаем через reader
+        async with pool.reader() as db:
             cur2 = await db.execute("SELECT id, name, category, rating, open_time, close_time, address, photo, created_by_tg_id, created_at FROM places WHERE id = ?", (place_id,))
             r = await cur2.fetchone()
 
-            if not r:
-                # Нечто пошло не так - возвращаем ошибку
-                raise HTTPException(status_code=500, detail="failed to fetch inserted place")
-
-            resp = {
-                "id": r["id"],
-                "name": r["name"],
-                "category": r["category"],
-                "rating": float(r["rating"]) if r["rating"] is not None else 0.0,
-                "open_time": r["open_time"],
-                "close_time": r["close_time"],
-                "address": r["address"],
-                "photo": safe_avatar_url(r["photo"]) if r["photo"] else None,
-                "created_by_tg_id": r["created_by_tg_id"],
-                "created_at": r["created_at"]
-            }
+        if not r:
+            # Нечто пошло не так - возвращаем ошибку
+            raise HTTPException(status_code=500, detail="failed to fetch inserted place")
+
+        resp = {
+            "id": r["id"],
+            "name": r["name"],
+            "category": r["category"],
+            "rating": float(r["rating"]) if r["rating"] is not None else 0.0,
+            "open_time": r["open_time"],
+            "close_time": r["close_time"],
+            "address": r["address"],
+            "photo": safe_avatar_url(r["photo"]) if r["photo"] else None,
+            "created_by_tg_id": r["created_by_tg_id"],
+            "created_at": r["created_at"]
+        }
         return {"ok": True, "place": resp}
 
     @router.delete("/api/places/{place_id}")
-    async def api_delete_place(place_id: int):
+    async def api_delete_place(place_id: int, pool: DBPool = Depends(db_pool)):
         """Удаляет заведение по id.
         Возвращает { ok: True } или 404 если не найдено.
         """
-        async with aiosqlite.connect(DB_PATH) as db:
-            # хотим обращаться по именам колонок при проверке
-            db.row_factory = aiosqlite.Row
-
+        async def _delete(db):
             cur = await db.execute("SELECT id FROM places WHERE id = ?", (place_id,))
             row = await cur.fetchone()
             if not row:
@@ -173,6 +168,7 @@ def places_router(router, DB_PATH, templates):
 
             # простое удаление; можно заменить на soft-delete, если нужно
             await db.execute("DELETE FROM places WHERE id = ?", (place_id,))
-            await db.commit()
+
+        await pool.write(_delete)
 
         return {"ok": True}
@@ -6,38 +6,40 @@ import json
 import asyncio
 import logging
 import aiosqlite
-import hmac, hashlib
+import hashlib
 from zoneinfo import ZoneInfo
-from urllib.parse import parse_qsl
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from datetime import datetime, timedelta, timezone
-from fastapi import APIRouter, HTTPException, Request
-
-from app.config import BOT_TOKEN, DB_PATH
-from app.invites import handle_invite_response
-from app.telegram_utils import answer_callback_query, dispatch_surveys_once, edit_message_reply_markup, edit_message_text, send_telegram_message
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
+
+from app.config import (BOT_TOKEN, CHAT_AUTH_TIMEOUT_S, GEO_GRID_ENABLED, GEO_GRID_MAX_CELLS,
+                        HEARTBEAT_EXTEND_SLACK_S, HEARTBEAT_MIN_MOVE_M, INVITE_PENDING_TTL_HOURS, INVITE_WAIT_MAX_S,
+                        NEARBY_KNN_MAX_CANDIDATES, NEARBY_KNN_MAX_K, NEARBY_KNN_MAX_KM, NEARBY_KNN_MAX_RINGS,
+                        NEARBY_KNN_START_KM, TAG_INDEX_ENABLED)
+from app.chat import CONTACTS_SQL, HISTORY_SQL, chat_hub, load_peers, matched_peer, pair
+from app.db import DBPool, db_pool, get_pool, read_db
+from app.invites import PENDING_INVITES_SQL, handle_invite_response, invite_item, invite_waiters
+from app.jobs import due_in, job_scheduler, schedule_job
+from app.geo import (LiveSession, covering_cells_count, decode_cursor, diff_with_db, encode_cursor, knn_search,
+                     session_grid)
+from app.retention import retention_stats
+from app.reviews import add_review, get_review_counts, remove_review
+from app.tags import TOP_TAGS_SQL, apply_tag_diff, suggest_tags
+from app.tag_index import LAST_SEEN_SQL, METRICS as SIMILAR_METRICS, diff_with_db as tag_index_diff, tag_index
+from app.sessions import (LIVE_SESSIONS_SQL, SESSION_TTL, bbox, deactivate_user_sessions, nearest_from_rtree,
+                          rtree_add, session_expiry, start_user_session, touch_user)
+from app.notifications import (MARK_READ_MAX_IDS, UNREAD_COUNT_SQL, insert_notification, mark_read,
+                               notification_hub, notification_item)
+from app.outbox import enqueue_message, outbox, queue_telegram_message
+from app.telegram_utils import answer_callback_query, edit_message_reply_markup, edit_message_text, telegram
+from app.webhook import update_handler, webhook_dispatcher
 from places import safe_avatar_url, places_router
 from screens import safe_screen_template
-from utils import haversine_km, parse_float, parse_int
+from utils import check_init_data, haversine_km, normalize_tags, parse_float, parse_int, rank_by_distance
 
 router = APIRouter()
 
-async def survey_dispatcher_loop(poll_interval=60):
-    try:
-        await asyncio.sleep(5)
-        while True:
-            try:
-                await dispatch_surveys_once()
-            except asyncio.CancelledError:
-                break
-            except Exception:
-                logging.exception("survey_dispatcher_loop failed")
-            await asyncio.sleep(poll_interval)
-    except asyncio.CancelledError:
-        logging.info("survey_dispatcher_loop cancelled, cleaning up")
-        raise 
-    
 ALLOWED_REACTIONS = [
     "Приятный собеседник",
     "Мыслит нестандартно",
@@ -70,7 +72,7 @@ templates = Jinja2Templates(directory=TEMPLATES_DIR)
 secret_key = hashlib.sha256(BOT_TOKEN.encode()).digest()
 
 
-places_router(router, DB_PATH, templates)
+places_router(router, templates)
 
 @router.get("/")
 async def index(request: Request):
@@ -85,8 +87,29 @@ async def index(request: Request):
     return templates.TemplateResponse("index.html", context)
 
 
+def _session_live(live: LiveSession, seen_s: str):
+    session_grid.put(live)
+    session_expiry.push(live.sid, live.expires_at)
+    tag_index.touch(live.user_id, seen_s)
+
+
+def _sessions_closed(sids):
+    session_grid.remove_sids(sids)
+    session_expiry.discard(sids)
+
+
+async def _ensure_session_user(db, tg_id: int):
+    """-> (user_id, (name, username, avatar, age)); создаёт пользователя, если его нет."""
+    cur = await db.execute("SELECT id, name, username, avatar, age FROM users WHERE tg_id = ?", (tg_id,))
+    row = await cur.fetchone()
+    if row is None:
+        cur = await db.execute("INSERT INTO users (tg_id) VALUES (?)", (tg_id,))
+        return cur.lastrowid, (None, None, None, None)
+    return row["id"], (row["name"], row["username"], row["avatar"], row["age"])
+
+
 @router.post("/start")
-async def start_session(request: Request):
+async def start_session(request: Request, pool: DBPool = Depends(db_pool)):
     data = await request.json()
     print("POST /start body:", data)
     if not isinstance(data, dict):
@@ -99,102 +122,250 @@ async def start_session(request: Request):
     lon = parse_float(data["lon"], "lon")
 
     now = datetime.now(timezone.utc)
-    expires = now + timedelta(hours=1)
+    expires = now + SESSION_TTL
     now_s = now.strftime('%Y-%m-%d %H:%M:%S')
     expires_s = expires.strftime('%Y-%m-%d %H:%M:%S')
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if row is None:
-            cur = await db.execute("INSERT INTO users (tg_id) VALUES (?)", (tg_id,))
-            await db.commit()
-            user_id = cur.lastrowid
-        else:
-            user_id = row["id"]
+    async def _write(db):
+        user_id, profile = await _ensure_session_user(db, tg_id)
+        old_ids, sid = await start_user_session(db, user_id, lat, lon, now_s, expires_s)
+        return old_ids, LiveSession(sid, user_id, tg_id, lat, lon, now_s, expires_s, *profile)
 
-        await db.execute("UPDATE eat_sessions SET active = 0 WHERE user_id = ?", (user_id,))
-        await db.execute(
-            "INSERT INTO eat_sessions (user_id, lat, lon, started_at, expires_at, active) VALUES (?, ?, ?, ?, ?, 1)",
-            (user_id, lat, lon, now_s, expires_s)
-        )
-        await db.commit()
+    old_ids, live = await pool.write(_write)
+    # сетка и куча дедлайнов обновляются только после коммита
+    _sessions_closed(old_ids)
+    _session_live(live, now_s)
 
     return {"status": "ok", "expires_at": expires_s}
 
 
+@router.post("/heartbeat")
+async def heartbeat(request: Request, pool: DBPool = Depends(db_pool)):
+    """Периодическое обновление позиции: правит активную сессию на месте и сразу отдаёт nearby.
+
+    Сдвиг меньше HEARTBEAT_MIN_MOVE_M - только продление expires_at; если его продлевали
+    меньше HEARTBEAT_EXTEND_SLACK_S назад - записи нет вообще. Без активной сессии ведёт себя как /start.
+    """
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise HTTPException(400, "body must be json object")
+    if "tg_id" not in data or "lat" not in data or "lon" not in data:
+        raise HTTPException(400, "tg_id, lat and lon are required")
+
+    tg_id = parse_int(data["tg_id"], "tg_id")
+    lat = parse_float(data["lat"], "lat")
+    lon = parse_float(data["lon"], "lon")
+    radius_km = _clamp_radius(parse_float(data.get("radius_km", 3.0), "radius_km"))
+    max_rows = max(0, parse_int(data.get("max_rows", 100), "max_rows"))  # отрицательный - не "без лимита"
+
+    now = datetime.now(timezone.utc)
+    now_s = now.strftime('%Y-%m-%d %H:%M:%S')
+    expires_s = (now + SESSION_TTL).strftime('%Y-%m-%d %H:%M:%S')
+    min_move_km = HEARTBEAT_MIN_MOVE_M / 1000.0
+
+    # быстрый путь по in-memory сетке: на месте и продлевали недавно - в БД не пишем
+    live = session_grid.get_by_tg(tg_id) if session_grid.ready else None
+    fresh_s = (now + SESSION_TTL - timedelta(seconds=HEARTBEAT_EXTEND_SLACK_S)).strftime('%Y-%m-%d %H:%M:%S')
+    if (live is not None and live.expires_at > fresh_s
+            and haversine_km(live.lat, live.lon, lat, lon) < min_move_km):
+        result = "unchanged"
+    else:
+        async def _write(db):
+            user_id, profile = await _ensure_session_user(db, tg_id)
+            cur = await db.execute(
+                "SELECT id, lat, lon, started_at FROM eat_sessions "
+                "WHERE user_id = ? AND active = 1 AND expires_at > ? ORDER BY id DESC LIMIT 1",
+                (user_id, now_s)
+            )
+            sess = await cur.fetchone()
+            if sess is None:
+                old_ids, sid = await start_user_session(db, user_id, lat, lon, now_s, expires_s)
+                return "started", old_ids, LiveSession(sid, user_id, tg_id, lat, lon, now_s, expires_s, *profile)
+
+            await touch_user(db, user_id, now_s)
+            if haversine_km(sess["lat"], sess["lon"], lat, lon) < min_move_km:
+                await db.execute("UPDATE eat_sessions SET expires_at = ? WHERE id = ?", (expires_s, sess["id"]))
+                s_lat, s_lon, result = sess["lat"], sess["lon"], "extended"
+            else:
+                await db.execute("UPDATE eat_sessions SET lat = ?, lon = ?, expires_at = ? WHERE id = ?",
+                                 (lat, lon, expires_s, sess["id"]))
+                await rtree_add(db, sess["id"], lat, lon)
+                s_lat, s_lon, result = lat, lon, "moved"
+            return result, [], LiveSession(sess["id"], user_id, tg_id, s_lat, s_lon, sess["started_at"], expires_s, *profile)
+
+        result, old_ids, live = await pool.write(_write)
+        _sessions_closed(old_ids)
+        _session_live(live, now_s)
+
+    # reader берём только на время поиска, а не на всё ожидание записи
+    async with pool.reader() as db:
+        ranked, _ = await _nearby_ranked(db, lat, lon, radius_km, now_s, tg_id, limit=max_rows)
+    return {
+        "status": "ok",
+        "session": result,
+        "expires_at": live.expires_at,
+        "nearby": [_nearby_item(d, s) for d, s in ranked],
+    }
+
+
 @router.post("/stop")
-async def stop_session(request: Request):
+async def stop_session(request: Request, pool: DBPool = Depends(db_pool)):
     data = await request.json()
     if not isinstance(data, dict) or "tg_id" not in data:
         raise HTTPException(400, "tg_id required")
     tg_id = parse_int(data["tg_id"], "tg_id")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async def _write(db):
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         row = await cur.fetchone()
         if row is None:
             raise HTTPException(404, "user not found")
         user_id = row["id"]
-        await db.execute("""
-            UPDATE eat_sessions SET active = 0 WHERE user_id = ?
-        """, (user_id,))
-        await db.commit()
+        return await deactivate_user_sessions(db, user_id)
+
+    _sessions_closed(await pool.write(_write))
 
     return {"status": "ok"}
 
 
+def _nearby_item(d: float, s: LiveSession):
+    return {
+        "user_id": s.user_id,
+        "tg_id": s.tg_id,
+        "name": s.name,
+        "username": s.username,
+        "avatar": safe_avatar_url(s.avatar),
+        "age": s.age,
+        "distance_km": round(d, 3),
+        "started_at": s.started_at,
+        "expires_at": s.expires_at,
+    }
+
+
+def _clamp_radius(radius_km: float) -> float:
+    # перебор ячеек сетки растёт как квадрат радиуса и идёт прямо в event loop
+    return min(max(radius_km, 0.0), NEARBY_KNN_MAX_KM)
+
+
+async def _nearby_ranked(db, lat: float, lon: float, radius_km: float, now_s: str, tg_id: int, limit: int = None):
+    """([(distance_km, LiveSession)] в радиусе по (distance, sid); truncated): из памяти, либо из R*Tree,
+    пока сетка не прогрета или прямоугольник поиска покрывает больше GEO_GRID_MAX_CELLS ячеек.
+
+    Оба пути смотрят не больше NEARBY_KNN_MAX_CANDIDATES ближайших сессий; truncated - упёрлись в лимит.
+    """
+    box = bbox(lat, lon, radius_km)
+    if (GEO_GRID_ENABLED and session_grid.ready
+            and covering_cells_count(*box, session_grid.precision) <= GEO_GRID_MAX_CELLS):
+        return session_grid.query(lat, lon, radius_km, *box, now_s, exclude_tg=tg_id, limit=limit,
+                                  max_candidates=NEARBY_KNN_MAX_CANDIDATES)
+    cap = min(limit, NEARBY_KNN_MAX_CANDIDATES) if limit is not None else NEARBY_KNN_MAX_CANDIDATES
+    rows = await nearest_from_rtree(db, lat, lon, radius_km, now_s, exclude_tg=tg_id, limit=cap)
+    cand = sorted((LiveSession.from_row(r) for r in rows), key=lambda s: s.sid)
+    ranked = rank_by_distance(lat, lon, [s.lat for s in cand], [s.lon for s in cand], k=limit, max_km=radius_km)
+    return [(d, cand[i]) for i, d in ranked], len(rows) >= NEARBY_KNN_MAX_CANDIDATES
+
+
 @router.get("/nearby")
-async def nearby(tg_id: int, lat: float, lon: float, radius_km: float = 3.0, max_rows: int = 100):
-    lat_deg = radius_km / 111.0
-    lon_deg = radius_km / (111.0 * max(0.00001, math.cos(math.radians(lat))))
-    min_lat, max_lat = lat - lat_deg, lat + lat_deg
-    min_lon, max_lon = lon - lon_deg, lon + lon_deg
+async def nearby(tg_id: int, lat: float, lon: float, radius_km: float = 3.0, max_rows: int = 100,
+                 k: int = None, cursor: str = None, db: aiosqlite.Connection = Depends(read_db)):
+    now_s = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    radius_km = _clamp_radius(radius_km)
+    max_rows = max(0, max_rows)  # отрицательный - не "без лимита"
+
+    if k is None and cursor is None:
+        # обычный режим: все в radius_km, не больше max_rows ближайших
+        ranked, _ = await _nearby_ranked(db, lat, lon, radius_km, now_s, tg_id, limit=max_rows)
+        return {"nearby": [_nearby_item(d, s) for d, s in ranked]}
+
+    # k-NN: кольца расширяются, пока не наберётся k ближайших; курсор - ключ (distance, sid)
+    k = max(1, min(20 if k is None else k, NEARBY_KNN_MAX_K))
+    after = None
+    if cursor:
+        try:
+            lat, lon, after_d, after_sid = decode_cursor(cursor)  # страницы считаются от исходной точки
+        except ValueError:
+            raise HTTPException(400, "invalid cursor")
+        after = (after_d, after_sid)
+
+    async def _fetch(r):
+        return await _nearby_ranked(db, lat, lon, r, now_s, tg_id)
 
+    picked, reached_km, rings, next_after, truncated = await knn_search(
+        _fetch, k, after=after, start_km=NEARBY_KNN_START_KM, max_km=NEARBY_KNN_MAX_KM,
+        max_rings=NEARBY_KNN_MAX_RINGS)
+    return {
+        "nearby": [_nearby_item(d, s) for d, s in picked],
+        "next_cursor": encode_cursor(lat, lon, *next_after) if next_after else None,
+        "radius_km": round(reached_km, 3),
+        "rings": rings,
+        "truncated": truncated,   # упёрлись в NEARBY_KNN_MAX_CANDIDATES - дальше этих кандидатов не ищем
+    }
+
+
+
+
+
+
+
+
+@router.get("/api/stats")
+async def api_stats():
+    """Внутренние счётчики сервера (пул соединений и т.п.) для мониторинга."""
+    return {"ok": True, "db_pool": get_pool().stats(), "session_grid": session_grid.stats(),
+            "session_expiry": session_expiry.stats(), "retention": retention_stats.as_dict(),
+            "jobs": job_scheduler.stats(), "outbox": outbox.stats(),
+            "telegram": telegram.stats(), "webhook": webhook_dispatcher.stats(), "tag_index": tag_index.stats(),
+            "notifications": notification_hub.stats(), "invite_waiters": invite_waiters.stats(),
+            "chat": chat_hub.stats()}
+
+
+async def _session_grid_diff(db):
     now_s = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-    items = []
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        q = """
-            SELECT e.id AS sid, e.lat, e.lon, e.started_at, e.expires_at, u.id AS user_id, u.tg_id,
-                   u.name AS name, u.avatar AS avatar, u.username AS username, u.age AS age
-            FROM eat_sessions e
-            JOIN users u ON u.id = e.user_id
-            WHERE e.active = 1 AND e.expires_at > ?
-              AND e.lat BETWEEN ? AND ?
-              AND e.lon BETWEEN ? AND ?
-            LIMIT ?
-        """
-        cur = await db.execute(q, (now_s, min_lat, max_lat, min_lon, max_lon, max_rows))
-        rows = await cur.fetchall()
-        for r in rows:
-            if r["tg_id"] == tg_id:
-                continue
-            d = haversine_km(lat, lon, r["lat"], r["lon"])
-            if d <= radius_km:
-                items.append({
-                    "user_id": r["user_id"],
-                    "tg_id": r["tg_id"],
-                    "name": r["name"],
-                    "username": r["username"],
-                    "avatar": safe_avatar_url(r["avatar"]),
-                    "age": r["age"],
-                    "distance_km": round(d, 3),
-                    "started_at": r["started_at"],
-                    "expires_at": r["expires_at"],
-                })
-    items.sort(key=lambda x: x["distance_km"])
-    return {"nearby": items}
+    cur = await db.execute(LIVE_SESSIONS_SQL, (now_s,))
+    rows = await cur.fetchall()
+    return diff_with_db(session_grid, rows, now_s), rows
+
 
+@router.get("/api/stats/session_grid/check")
+async def api_session_grid_check(db: aiosqlite.Connection = Depends(read_db)):
+    """Сверяет in-memory сетку с активными сессиями в БД; только чтение, починка - POST .../repair."""
+    res, _ = await _session_grid_diff(db)
+    return res
 
 
+@router.post("/api/stats/session_grid/repair")
+async def api_session_grid_repair(db: aiosqlite.Connection = Depends(read_db)):
+    """Сверяет сетку с БД и при расхождении перезагружает её из БД."""
+    res, rows = await _session_grid_diff(db)
+    if not res["ok"]:
+        session_grid.load(LiveSession.from_row(r) for r in rows)
+        res["repaired"] = True
+    return res
 
 
+async def _tag_index_diff(db):
+    cur = await db.execute("SELECT user_id, tag FROM user_tags")
+    rows = [(r[0], r[1]) for r in await cur.fetchall()]
+    return tag_index_diff(tag_index, rows), rows
 
 
+@router.get("/api/stats/tag_index/check")
+async def api_tag_index_check(db: aiosqlite.Connection = Depends(read_db)):
+    """Сверяет индекс тегов с user_tags; только чтение, починка - POST .../repair."""
+    res, _ = await _tag_index_diff(db)
+    return res
+
+
+@router.post("/api/stats/tag_index/repair")
+async def api_tag_index_repair(db: aiosqlite.Connection = Depends(read_db)):
+    """Сверяет индекс тегов с user_tags и при расхождении перестраивает его из БД."""
+    res, rows = await _tag_index_diff(db)
+    if not res["ok"]:
+        cur = await db.execute(LAST_SEEN_SQL)
+        tag_index.load(rows, [(r[0], r[1]) for r in await cur.fetchall()])
+        res["repaired"] = True
+    return res
+
 
 @router.get("/screens/{name}.html")
 async def get_screen_with_ext(request: Request, name: str):
@@ -206,7 +377,7 @@ async def get_screen_with_ext(request: Request, name: str):
 
 
 @router.post("/api/survey/respond")
-async def api_survey_respond(request: Request):
+async def api_survey_respond(request: Request, pool: DBPool = Depends(db_pool)):
     body = await request.json()
     invite_id = int(body.get("invite_id"))
     tg_id = int(body.get("tg_id"))  # кто отвечает
@@ -216,8 +387,8 @@ async def api_survey_respond(request: Request):
     if answer not in ("yes", "no"):
         raise HTTPException(400, "answer must be 'yes' or 'no'")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    # в writer-таске только работа с БД; telegram ложится в outbox той же транзакцией
+    async def _write(db):
         # проверим user
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         user = await cur.fetchone()
@@ -232,7 +403,6 @@ async def api_survey_respond(request: Request):
 
         # insert response
         await db.execute("INSERT INTO invite_surveys (invite_id, user_id, answer) VALUES (?, ?, ?)", (invite_id, user_id, answer))
-        await db.commit()
 
         # get invite + partner info to craft follow-up
         cur = await db.execute("""
@@ -268,138 +438,192 @@ async def api_survey_respond(request: Request):
                 "prompt": f'Супер, оставьте отзыв об пользователе "{partner_name}" в нашем мини-аппе',
                 "reactions": ALLOWED_REACTIONS
             }
-            await db.execute(
-                "INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                (user_id, "survey_followup", json.dumps(payload, ensure_ascii=False))
-            )
-            await db.commit()
-
+            item = await insert_notification(db, user_id, "survey_followup", payload)
+            # Для Telegram - отправляем пользователю который ответил (not partner)
+            # kb = {"inline_keyboard": [[{"text": r, "callback_data": f"review:{invite_id}:{r}"}] for r in ALLOWED_REACTIONS]}
             if partner_tg:
-                try:
-                    # Для Telegram - отправляем пользователю который ответил (not partner)
-                    # kb = {"inline_keyboard": [[{"text": r, "callback_data": f"review:{invite_id}:{r}"}] for r in ALLOWED_REACTIONS]}
-                    # await send_telegram_message(tg_id, payload["prompt"], reply_markup=kb)
-                    await send_telegram_message(tg_id, payload["prompt"])
-                except Exception:
-                    logging.exception("telegram send followup failed")
-            return {"ok": True, "action": "ask_review"}
+                await enqueue_message(db, tg_id, payload["prompt"])
         else:
-            payload = {"message": f'Ничего страшного - найдете другого.'}
-            await db.execute("INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                             (user_id, "survey_negative", json.dumps(payload, ensure_ascii=False)))
-            await db.commit()
-            
-            try:
-                await send_telegram_message(tg_id, payload["message"])
-            except Exception:
-                pass
-            return {"ok": True, "action": "noted"}
+            payload = {"invite_id": invite_id, "message": f'Ничего страшного - найдете другого.'}
+            item = await insert_notification(db, user_id, "survey_negative", payload)
+            await enqueue_message(db, tg_id, payload["message"])
+        return {"ok": True, "payload": payload, "partner_tg": partner_tg, "item": item}
 
+    res = await pool.write(_write)
+    if not res.get("ok"):
+        return res
+    outbox.wake()
+    notification_hub.publish([res["item"]])
 
-@router.get("/api/notifications")
-async def api_notifications(tg_id: int, since_id: int = 0, limit: int = 20, include_read: bool = False):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            return {"ok": True, "notifications": []}
-        user_id = row["id"]
+    if answer == "yes":
+        return {"ok": True, "action": "ask_review"}
+    else:
+        return {"ok": True, "action": "noted"}
 
-        # Формируем SQL в зависимости от include_read и since_id
-        if include_read:
-            if since_id and since_id > 0:
-                cur = await db.execute(
-                    "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
-                    (user_id, since_id, limit)
-                )
-            else:
-                cur = await db.execute(
-                    "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? ORDER BY id DESC LIMIT ?",
-                    (user_id, limit)
-                )
+
+@router.get("/api/notifications")
+async def api_notifications(tg_id: int, since_id: int = 0, limit: int = 20, include_read: bool = False,
+                            db: aiosqlite.Connection = Depends(read_db)):
+    cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+    row = await cur.fetchone()
+    if not row:
+        return {"ok": True, "notifications": []}
+    user_id = row["id"]
+
+    # Формируем SQL в зависимости от include_read и since_id
+    if include_read:
+        if since_id and since_id > 0:
+            cur = await db.execute(
+                "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+                (user_id, since_id, limit)
+            )
         else:
-            # По умолчанию возвращаем только непрочитанные (read = 0)
-            if since_id and since_id > 0:
-                cur = await db.execute(
-                    "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? AND read = 0 AND id > ? ORDER BY id DESC LIMIT ?",
-                    (user_id, since_id, limit)
-                )
-            else:
-                cur = await db.execute(
-                    "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? AND read = 0 ORDER BY id DESC LIMIT ?",
-                    (user_id, limit)
-                )
+            cur = await db.execute(
+                "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit)
+            )
+    else:
+        # По умолчанию возвращаем только непрочитанные (read = 0)
+        if since_id and since_id > 0:
+            cur = await db.execute(
+                "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? AND read = 0 AND id > ? ORDER BY id DESC LIMIT ?",
+                (user_id, since_id, limit)
+            )
+        else:
+            cur = await db.execute(
+                "SELECT id, type, payload, read, created_at FROM notifications WHERE user_id = ? AND read = 0 ORDER BY id DESC LIMIT ?",
+                (user_id, limit)
+            )
 
-        rows = await cur.fetchall()
-        out = []
-        for r in rows:
-            try:
-                pl = json.loads(r["payload"]) if r["payload"] else {}
-            except Exception:
-                pl = {}
-            out.append({
-                "id": r["id"],
-                "type": r["type"],
-                "payload": pl,
-                "read": bool(r["read"]),
-                "created_at": r["created_at"]
-            })
-        return {"ok": True, "notifications": out}
+    rows = await cur.fetchall()
+    return {"ok": True, "notifications": [notification_item(r) for r in rows]}
+
+
+@router.get("/api/notifications/stream")
+async def api_notifications_stream(request: Request, tg_id: int, last_id: int = 0):
+    """SSE: непрочитанные уведомления и новые по мере появления (вместо опроса /api/notifications).
+
+    id события - notifications.id; при переподключении браузер сам шлёт Last-Event-ID.
+    """
+    # без read_db: зависимость держала бы reader пула, пока открыт стрим
+    async with get_pool().reader() as db:
+        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+        row = await cur.fetchone()
+    if not row:
+        raise HTTPException(404, "user not found")
+    try:
+        last_id = max(last_id, int(request.headers.get("last-event-id") or 0))
+    except ValueError:
+        pass
+    return StreamingResponse(
+        notification_hub.stream(row["id"], last_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.post("/api/notifications/mark_read")
-async def api_notifications_mark_read(request: Request):
+async def api_notifications_mark_read(request: Request, pool: DBPool = Depends(db_pool)):
     body = await request.json()
     tg_id = int(body.get("tg_id"))
     nid = int(body.get("notification_id"))
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async def _write(db):
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         row = await cur.fetchone()
         if not row:
             return {"ok": False}
-        user_id = row["id"]
-        await db.execute("UPDATE notifications SET read = 1 WHERE id = ? AND user_id = ?", (nid, user_id))
-        await db.commit()
-    return {"ok": True}
+        await mark_read(db, row["id"], ids=[nid])
+        return {"ok": True}
+
+    return await pool.write(_write)
+
+
+@router.post("/api/notifications/mark_read_bulk")
+async def api_notifications_mark_read_bulk(request: Request, pool: DBPool = Depends(db_pool)):
+    """body: { tg_id: int, ids?: [int], up_to_id?: int } - список и/или "всё до id N включительно".
+
+    Один UPDATE вместо запроса на каждое уведомление. -> {"marked": n, "unread": остаток}
+    """
+    body = await request.json()
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="json body required")
+    try:
+        tg_id = int(body.get("tg_id"))
+        ids = [int(x) for x in (body.get("ids") or [])]
+        up_to_id = int(body["up_to_id"]) if body.get("up_to_id") is not None else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="tg_id, ids: [int], up_to_id: int expected")
+    if not ids and up_to_id is None:
+        raise HTTPException(status_code=400, detail="ids or up_to_id required")
+    if len(ids) > MARK_READ_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"at most {MARK_READ_MAX_IDS} ids, use up_to_id")
+
+    async def _write(db):
+        cur = await db.execute(UNREAD_COUNT_SQL, (tg_id,))
+        row = await cur.fetchone()
+        if not row:
+            return None
+        marked = await mark_read(db, row["id"], ids=ids, up_to_id=up_to_id)
+        return {"ok": True, "marked": marked, "unread": row["unread"] - marked}
+
+    res = await pool.write(_write)
+    if res is None:
+        raise HTTPException(404, "user not found")
+    return res
+
+
+@router.get("/api/notifications/unread_count")
+async def api_notifications_unread_count(tg_id: int, db: aiosqlite.Connection = Depends(read_db)):
+    """Счётчик для бейджа: одна строка notification_unread по ключу."""
+    cur = await db.execute(UNREAD_COUNT_SQL, (tg_id,))
+    row = await cur.fetchone()
+    return {"ok": True, "unread": row["unread"] if row else 0}
 
 
 @router.get("/api/invites")
-async def api_list_invites(tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def api_list_invites(tg_id: int, db: aiosqlite.Connection = Depends(read_db)):
+    cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+    row = await cur.fetchone()
+    if not row:
+        return {"ok": True, "invites": []}
+    cur = await db.execute(PENDING_INVITES_SQL, (row["id"], 0))
+    return {"ok": True, "invites": [invite_item(r) for r in await cur.fetchall()]}
+
+
+@router.get("/api/invites/wait")
+async def api_wait_invites(tg_id: int, since_id: int = 0, timeout: float = 25.0):
+    """Long-poll: pending-инвайты с id > since_id; если их нет - ждём новый до timeout секунд.
+
+    -> {"invites": [...], "last_id": ...}; last_id передаётся следующим запросом как since_id.
+    Соединение с БД на время ожидания не держим.
+    """
+    timeout = min(max(timeout, 0.0), INVITE_WAIT_MAX_S)
+    pool = get_pool()
+    async with pool.reader() as db:
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         row = await cur.fetchone()
-        if not row:
-            return {"ok": True, "invites": []}
-        user_id = row["id"]
-        cur = await db.execute("""SELECT i.id, fu.tg_id AS from_tg, fu.name AS from_name, i.time_iso, i.meal_type, i.message, i.status, i.place_id, i.place_name, i.created_at
-                                  FROM invites i
-                                  JOIN users fu ON fu.id = i.from_user_id
-                                  WHERE i.to_user_id = ? AND i.status = 'pending'
-                                  ORDER BY i.created_at DESC
-                              """, (user_id,))
-        rows = await cur.fetchall()
-        out = []
-        for r in rows:
-            out.append({
-                "id": r["id"],
-                "from_tg": r["from_tg"],
-                "from_name": r["from_name"],
-                "time_iso": r["time_iso"],
-                "meal_type": r["meal_type"],
-                "message": r["message"],
-                "status": r["status"],
-                "place_id": r["place_id"],
-                "place_name": r["place_name"],
-                "created_at": r["created_at"]
-            })
-        return {"ok": True, "invites": out}
+    if not row:
+        raise HTTPException(404, "user not found")
+    user_id = row["id"]
+
+    async def pending():
+        async with pool.reader() as db:
+            cur = await db.execute(PENDING_INVITES_SQL, (user_id, since_id))
+            return await cur.fetchall()
+
+    ev = invite_waiters.subscribe(user_id)
+    try:
+        rows = await pending()
+        if not rows and timeout > 0 and await invite_waiters.wait(ev, timeout):
+            rows = await pending()
+    finally:
+        invite_waiters.unsubscribe(user_id, ev)
+    invites = [invite_item(r) for r in rows]
+    return {"ok": True, "invites": invites, "last_id": max([since_id] + [i["id"] for i in invites])}
 
 
 @router.post("/api/invite")
-async def api_invite(request: Request):
+async def api_invite(request: Request, pool: DBPool = Depends(db_pool)):
     """body: { from_tg_id: int, to_tg_id: int, time_iso: str, meal_type: str, message?: str }
     """
     body = await request.json()
@@ -416,9 +640,7 @@ async def api_invite(request: Request):
     meal_type = body.get("meal_type") or None
     message = body.get("message") or None
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-
+    async def _write(db):
         # ensure both users exist (create lightweight record if missing)
         async def ensure_user(tg):
             cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg,))
@@ -426,7 +648,6 @@ async def api_invite(request: Request):
             if r:
                 return r["id"]
             await db.execute("INSERT INTO users (tg_id, created_at, updated_at) VALUES (?, datetime('now'), datetime('now'))", (tg,))
-            await db.commit()
             cur2 = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg,))
             rr = await cur2.fetchone()
             return rr["id"]
@@ -438,9 +659,13 @@ async def api_invite(request: Request):
             "INSERT INTO invites (from_user_id, to_user_id, time_iso, meal_type, message, place_id, place_name, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', datetime('now'))",
             (from_id, to_id, time_iso, meal_type, message, body.get("place_id"), body.get("place_name"))
         )
+        # без ответа инвайт протухнет через INVITE_PENDING_TTL_HOURS
+        expire_due = await schedule_job(db, "invite_expire", cur.lastrowid, due_in(INVITE_PENDING_TTL_HOURS * 3600))
+        return from_id, to_id, cur.lastrowid, expire_due
 
-        await db.commit()
-        invite_id = cur.lastrowid
+    from_id, to_id, invite_id, expire_due = await pool.write(_write)
+    job_scheduler.wake(expire_due)
+    invite_waiters.wake(to_id)
 
     # optional: try to notify target via telegram bot (best-effort, failures ignored)
     async def notify_target():
@@ -450,8 +675,7 @@ async def api_invite(request: Request):
         # попробуем взять имя отправителя из БД (может быть null)
         sender_name = None
         try:
-            async with aiosqlite.connect(DB_PATH) as db2:
-                db2.row_factory = aiosqlite.Row
+            async with get_pool().reader() as db2:
                 cur = await db2.execute("SELECT name, username FROM users WHERE id = ?", (from_id,))
                 r = await cur.fetchone()
                 if r:
@@ -524,19 +748,13 @@ async def api_invite(request: Request):
         # keyboard = {"inline_keyboard": keyboard_buttons}
 
         try:
-            # resp = await send_telegram_message(to_tg, text, reply_markup=keyboard)
-            resp = await send_telegram_message(to_tg, text)
-            logging.info("telegram notify result for invite %s -> %s : %s", invite_id, to_tg, resp)
+            # await queue_telegram_message(to_tg, text, reply_markup=keyboard)
+            await queue_telegram_message(to_tg, text)
         except Exception:
-            logging.exception("telegram notify failed for invite")
+            logging.exception("telegram notify enqueue failed for invite")
 
-
-    # fire-and-forget notify (do not await to not slow down response)
-    try:
-        import asyncio
-        asyncio.create_task(notify_target())
-    except Exception:
-        pass
+    # только чтение имени и запись в outbox - отправку делает app/outbox.py
+    await notify_target()
 
     return {"ok": True, "invite_id": invite_id}
 
@@ -547,9 +765,7 @@ async def handle_survey_response(invite_id: int, responder_tg: int, ans: str):
     if answer not in ("yes", "no"):
         return {"ok": False, "error": "invalid answer"}
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-
+    async def _write(db):
         # проверим user
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (responder_tg,))
         user = await cur.fetchone()
@@ -564,7 +780,6 @@ async def handle_survey_response(invite_id: int, responder_tg: int, ans: str):
 
         # insert response
         await db.execute("INSERT INTO invite_surveys (invite_id, user_id, answer, created_at) VALUES (?, ?, ?, datetime('now'))", (invite_id, user_id, answer))
-        await db.commit()
 
         # get invite + partner info to craft follow-up
         cur = await db.execute("""
@@ -601,30 +816,26 @@ async def handle_survey_response(invite_id: int, responder_tg: int, ans: str):
                 "reactions": ALLOWED_REACTIONS
             }
 
-            await db.execute(
-                "INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                (user_id, "survey_followup", json.dumps(payload, ensure_ascii=False))
-            )
-            await db.commit()
-
+            item = await insert_notification(db, user_id, "survey_followup", payload)
             # send telegram with reaction buttons to the user who answered
-            try:
-                # kb = {"inline_keyboard": [[{"text": r, "callback_data": f"review:{invite_id}:{r}"}] for r in ALLOWED_REACTIONS]}
-                # await send_telegram_message(responder_tg, payload["prompt"], reply_markup=kb)
-                await send_telegram_message(responder_tg, payload["prompt"])
-            except Exception:
-                logging.exception("telegram send followup failed")
-            return {"ok": True, "action": "ask_review"}
+            # kb = {"inline_keyboard": [[{"text": r, "callback_data": f"review:{invite_id}:{r}"}] for r in ALLOWED_REACTIONS]}
+            await enqueue_message(db, responder_tg, payload["prompt"])
         else:
-            payload = {"message": f'Ничего страшного - найдете другого.'}
-            await db.execute("INSERT INTO notifications (user_id, type, payload, read, created_at) VALUES (?, ?, ?, 0, datetime('now'))",
-                             (user_id, "survey_negative", json.dumps(payload, ensure_ascii=False)))
-            await db.commit()
-            try:
-                await send_telegram_message(responder_tg, payload["message"])
-            except Exception:
-                logging.exception("telegram send negative failed")
-            return {"ok": True, "action": "noted"}
+            payload = {"invite_id": invite_id, "message": f'Ничего страшного - найдете другого.'}
+            item = await insert_notification(db, user_id, "survey_negative", payload)
+            await enqueue_message(db, responder_tg, payload["message"])
+        return {"ok": True, "payload": payload, "partner_tg": partner_tg, "item": item}
+
+    res = await get_pool().write(_write)
+    if not res.get("ok"):
+        return res
+    outbox.wake()
+    notification_hub.publish([res["item"]])
+
+    if answer == "yes":
+        return {"ok": True, "action": "ask_review"}
+    else:
+        return {"ok": True, "action": "noted"}
 
 
 @router.post("/api/invite/respond")
@@ -647,7 +858,7 @@ async def api_invite_respond(request: Request):
 
 
 @router.post("/api/review/toggle")
-async def api_toggle_review(request: Request):
+async def api_toggle_review(request: Request, pool: DBPool = Depends(db_pool)):
     """body: { reviewer_tg_id: int, target_tg_id: int, reaction: str }
     Toggles one reaction: если есть - удаляет, иначе добавляет.
     """
@@ -663,15 +874,12 @@ async def api_toggle_review(request: Request):
     if reaction not in ALLOWED_REACTIONS:
         raise HTTPException(400, "invalid reaction")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-
+    async def _write(db):
         async def ensure_user(tg):
             cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg,))
             r = await cur.fetchone()
             if r: return r["id"]
             await db.execute("INSERT INTO users (tg_id, created_at, updated_at) VALUES (?, datetime('now'), datetime('now'))", (tg,))
-            await db.commit()
             cur2 = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg,))
             rr = await cur2.fetchone()
             return rr["id"]
@@ -679,130 +887,70 @@ async def api_toggle_review(request: Request):
         reviewer_id = await ensure_user(reviewer_tg)
         target_id = await ensure_user(target_tg)
 
-        cur = await db.execute("SELECT id FROM reviews WHERE reviewer_id = ? AND target_user_id = ? AND reaction = ?", (reviewer_id, target_id, reaction))
-        row = await cur.fetchone()
-        if row:
-            await db.execute("DELETE FROM reviews WHERE id = ?", (row["id"],))
-            await db.commit()
+        # reviews и review_counts меняются в одном SAVEPOINT
+        if await remove_review(db, reviewer_id, target_id, reaction):
             return {"ok": True, "action": "removed", "reaction": reaction}
-        else:
-            await db.execute("INSERT INTO reviews (reviewer_id, target_user_id, reaction, created_at) VALUES (?, ?, ?, datetime('now'))", (reviewer_id, target_id, reaction))
-            await db.commit()
-            return {"ok": True, "action": "added", "reaction": reaction}
+        await add_review(db, reviewer_id, target_id, reaction)
+        return {"ok": True, "action": "added", "reaction": reaction}
 
+    return await pool.write(_write)
 
 
-@router.get("/api/reviews")
-async def api_get_reviews(tg_id: int, limit: int = 20, viewer_tg_id: int = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            return {"ok": False, "error": "user not found", "counts": {}, "recent": [], "viewer": []}
-        user_id = row["id"]
-
-        cur = await db.execute("SELECT reaction, COUNT(*) AS cnt FROM reviews WHERE target_user_id = ? GROUP BY reaction", (user_id,))
-        rows = await cur.fetchall()
-        counts = {r["reaction"]: int(r["cnt"]) for r in rows}
 
-        cur = await db.execute("""
-            SELECT r.reaction, r.comment, r.created_at, u.tg_id AS reviewer_tg, u.name AS reviewer_name, u.avatar AS reviewer_avatar
-            FROM reviews r
-            LEFT JOIN users u ON u.id = r.reviewer_id
-            WHERE r.target_user_id = ?
-            ORDER BY r.created_at DESC
-            LIMIT ?
-        """, (user_id, limit))
-        recent = []
-        for r in await cur.fetchall():
-            recent.append({
-                "reaction": r["reaction"],
-                "comment": r["comment"],
-                "created_at": r["created_at"],
-                "reviewer_tg": r["reviewer_tg"],
-                "reviewer_name": r["reviewer_name"],
-                "reviewer_avatar": safe_avatar_url(r["reviewer_avatar"])
-            })
-
-        viewer_reactions = []
-        if viewer_tg_id:
-            cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (viewer_tg_id,))
-            vr = await cur.fetchone()
-            if vr:
-                v_id = vr["id"]
-                cur = await db.execute("SELECT reaction FROM reviews WHERE reviewer_id = ? AND target_user_id = ?", (v_id, user_id))
-                viewer_reactions = [r["reaction"] for r in await cur.fetchall()]
+@router.get("/api/reviews")
+async def api_get_reviews(tg_id: int, limit: int = 20, viewer_tg_id: int = None,
+                          db: aiosqlite.Connection = Depends(read_db)):
+    cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+    row = await cur.fetchone()
+    if not row:
+        return {"ok": False, "error": "user not found", "counts": {}, "recent": [], "viewer": []}
+    user_id = row["id"]
+
+    counts = await get_review_counts(db, user_id)
+
+    cur = await db.execute("""
+        SELECT r.reaction, r.comment, r.created_at, u.tg_id AS reviewer_tg, u.name AS reviewer_name, u.avatar AS reviewer_avatar
+        FROM reviews r
+        LEFT JOIN users u ON u.id = r.reviewer_id
+        WHERE r.target_user_id = ?
+        ORDER BY r.created_at DESC
+        LIMIT ?
+    """, (user_id, limit))
+    recent = []
+    for r in await cur.fetchall():
+        recent.append({
+            "reaction": r["reaction"],
+            "comment": r["comment"],
+            "created_at": r["created_at"],
+            "reviewer_tg": r["reviewer_tg"],
+            "reviewer_name": r["reviewer_name"],
+            "reviewer_avatar": safe_avatar_url(r["reviewer_avatar"])
+        })
+
+    viewer_reactions = []
+    if viewer_tg_id:
+        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (viewer_tg_id,))
+        vr = await cur.fetchone()
+        if vr:
+            v_id = vr["id"]
+            cur = await db.execute("SELECT reaction FROM reviews WHERE reviewer_id = ? AND target_user_id = ?", (v_id, user_id))
+            viewer_reactions = [r["reaction"] for r in await cur.fetchall()]
 
     return {"ok": True, "counts": counts, "recent": recent, "viewer": viewer_reactions}
 
 
 @router.post("/verify_init")
-async def verify_init(request: Request):
+async def verify_init(request: Request, pool: DBPool = Depends(db_pool)):
     logging.info("VERIFY_INIT start")
     payload = await request.json()
     logging.info("VERIFY_INIT payload raw: %s", payload)
 
-    # Получаем initData - может быть строкой (raw query) или объектом
-    init_raw = payload.get("initData")
-    if isinstance(init_raw, str):
-        # parse_qsl корректно декодирует %-encoding и возвращает пары
-        pairs = parse_qsl(init_raw, keep_blank_values=True)
-        init_data = {k: v for k, v in pairs}
-    else:
-        init_data = dict(init_raw or {})
-
-    if not init_data:
-        logging.warning("verify_init: missing initData")
-        raise HTTPException(status_code=400, detail="initData required")
-
-    if not BOT_TOKEN:
-        logging.error("BOT_TOKEN not set")
-        raise HTTPException(status_code=500, detail="BOT_TOKEN not set on server")
-
-    # If client parsed `user` to object, convert it back to compact JSON string
-    try:
-        import json
-        if "user" in init_data and isinstance(init_data["user"], dict):
-            init_data["user"] = json.dumps(init_data["user"], separators=(",", ":"), ensure_ascii=False)
-    except Exception as e:
-        logging.exception("error normalizing user field: %s", e)
-
-    # Ensure all values are strings (Telegram sends strings)
-    for k, v in list(init_data.items()):
-        if v is None:
-            init_data[k] = ""
-        elif not isinstance(v, str):
-            init_data[k] = str(v)
-
-    # Build data_check_string exactly like Telegram expects
-    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(init_data.items()) if k != "hash")
-    logging.info("data_check_string:\n%s", data_check_string)
-
-    # compute HMAC
-    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
-    computed_hmac = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-    provided_hash = init_data.get("hash", "")
-    logging.info("computed_hmac=%s provided_hash=%s", computed_hmac, provided_hash)
-
-    if not hmac.compare_digest(computed_hmac, provided_hash):
-        logging.warning("HMAC mismatch - invalid initData")
-        raise HTTPException(status_code=403, detail="invalid initData")
-
-    # далее проверка auth_date и upsert
-    try:
-        auth_date = int(init_data.get("auth_date", 0))
-    except Exception:
-        auth_date = 0
-    now_ts = int(datetime.now(timezone.utc).timestamp())
-    if auth_date == 0 or (now_ts - auth_date) > 24 * 3600:
-        logging.warning("initData expired: auth_date=%s now_ts=%s", auth_date, now_ts)
-        raise HTTPException(status_code=403, detail="initData expired")
-
+    # initData - строка (raw query) или объект; подпись и auth_date - utils.check_init_data
     try:
-        tg_id = int(init_data.get("id") or init_data.get("user", "") and (json.loads(init_data.get("user")) or {}).get("id"))
-    except Exception:
-        raise HTTPException(status_code=400, detail="invalid id in initData")
+        init_data, tg_id = check_init_data(payload.get("initData"), BOT_TOKEN)
+    except HTTPException as e:
+        logging.warning("verify_init: %s", e.detail)
+        raise
 
     # извлекаем поля профиля (если они есть прямо в init_data или внутри user JSON)
     first_name = init_data.get("first_name")
@@ -825,14 +973,12 @@ async def verify_init(request: Request):
     except Exception:
         pass
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # Обновляем/вставляем пользователя (tg_id)
+    # Обновляем/вставляем пользователя (tg_id)
+    async def _write(db):
         await db.execute(
             "UPDATE users SET name = ?, avatar = ? WHERE tg_id = ?",
             (first_name or username or None, avatar, tg_id)
         )
-        await db.commit()
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         row = await cur.fetchone()
         if row is None:
@@ -845,7 +991,12 @@ async def verify_init(request: Request):
                 username = excluded.username,
                 updated_at = datetime('now');
             """, (tg_id, first_name or username or None, avatar, username))
-            await db.commit()
+        cur = await db.execute("SELECT name, username, avatar, age FROM users WHERE tg_id = ?", (tg_id,))
+        return await cur.fetchone()
+
+    u = await pool.write(_write)
+    if u is not None:
+        session_grid.update_user(tg_id, u["name"], u["username"], u["avatar"], u["age"])
 
     logging.info("VERIFY_INIT ok for tg_id=%s name=%s", tg_id, first_name)
     return {
@@ -863,96 +1014,94 @@ async def verify_init(request: Request):
 # ----------------------
 # API: профиль с тегами и "последними контактами"
 # ----------------------
-@router.get("/api/profile")
-async def api_profile(tg_id: int):
-    """Возвращает профиль пользователя + теги + последние другие пользователи (recent_contacts)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT id, tg_id, name, avatar, username, age, created_at FROM users WHERE tg_id = ?", (tg_id,))
-        user = await cur.fetchone()
-        if user is None:
-            return {"ok": False, "error": "user not found"}
+# недавно активные пользователи: обратный проход по idx_users_last_seen, без GROUP BY по истории
+RECENT_USERS_SQL = """
+    SELECT tg_id, name, avatar, username, age, last_seen
+    FROM users
+    WHERE last_seen IS NOT NULL AND id != ?
+    ORDER BY last_seen DESC
+    LIMIT ?
+"""
 
-        user_id = user["id"]
-
-        # теги
-        cur = await db.execute("SELECT tag FROM user_tags WHERE user_id = ? ORDER BY tag COLLATE NOCASE", (user_id,))
-        tags = [r["tag"] for r in await cur.fetchall()]
-
-        # последние сессии текущего пользователя
-        cur = await db.execute("""
-            SELECT lat, lon, started_at, expires_at, active
-            FROM eat_sessions
-            WHERE user_id = ?
-            ORDER BY started_at DESC
-            LIMIT 10
-        """, (user_id,))
-        sessions = [dict(r) for r in await cur.fetchall()]
-
-        # recent other users: последних N других пользователей, отсортированных по последней активности
-        cur = await db.execute("""
-            SELECT u.tg_id, u.name, u.avatar, u.username, u.age, max(e.started_at) AS last_seen
-            FROM users u
-            JOIN eat_sessions e ON e.user_id = u.id
-            WHERE u.id != ?
-            GROUP BY u.id
-            ORDER BY last_seen DESC
-            LIMIT 10
-        """, (user_id,))
-        contacts = []
-        for r in await cur.fetchall():
-            contacts.append({
-                "tg_id": r["tg_id"],
-                "name": r["name"],
-                "username": r["username"],
-                "avatar": safe_avatar_url(r["avatar"]),
-                "age": r["age"],
-                "last_seen": r["last_seen"]
-            })
 
-        # reviews counts (опционально)
-        cur_reaction = await db.execute("SELECT reaction, COUNT(*) AS cnt FROM reviews WHERE target_user_id = ? GROUP BY reaction", (user_id,))
-        rows = await cur_reaction.fetchall()
-        review_counts = {r["reaction"]: int(r["cnt"]) for r in rows}
-
-        result = {
-            "ok": True,
-            "user": {
-                "tg_id": user["tg_id"],
-                "name": user["name"],
-                "avatar": safe_avatar_url(user["avatar"]),
-                "username": user["username"],
-                "age": user["age"],
-                "created_at": user["created_at"]
-            },
-            "tags": tags,
-            "sessions": sessions,
-            "recent_contacts": contacts,
-            "review_counts": review_counts
-        }
-        return result
+@router.get("/api/profile")
+async def api_profile(tg_id: int, db: aiosqlite.Connection = Depends(read_db)):
+    """Возвращает профиль пользователя + теги + последние другие пользователи (recent_contacts)."""
+    cur = await db.execute("SELECT id, tg_id, name, avatar, username, age, created_at FROM users WHERE tg_id = ?", (tg_id,))
+    user = await cur.fetchone()
+    if user is None:
+        return {"ok": False, "error": "user not found"}
+
+    user_id = user["id"]
+
+    # теги
+    cur = await db.execute("SELECT tag FROM user_tags WHERE user_id = ? ORDER BY tag COLLATE NOCASE", (user_id,))
+    tags = [r["tag"] for r in await cur.fetchall()]
+
+    # последние сессии текущего пользователя (старые уже могли уехать в архив)
+    cur = await db.execute("""
+        SELECT lat, lon, started_at, expires_at, active FROM (
+            SELECT lat, lon, started_at, expires_at, active FROM eat_sessions WHERE user_id = ?
+            UNION ALL
+            SELECT lat, lon, started_at, expires_at, 0 AS active FROM eat_sessions_archive WHERE user_id = ?
+        )
+        ORDER BY started_at DESC
+        LIMIT 10
+    """, (user_id, user_id))
+    sessions = [dict(r) for r in await cur.fetchall()]
+
+    # recent other users: последних N других пользователей, отсортированных по последней активности
+    cur = await db.execute(RECENT_USERS_SQL, (user_id, 10))
+    contacts = []
+    for r in await cur.fetchall():
+        contacts.append({
+            "tg_id": r["tg_id"],
+            "name": r["name"],
+            "username": r["username"],
+            "avatar": safe_avatar_url(r["avatar"]),
+            "age": r["age"],
+            "last_seen": r["last_seen"]
+        })
+
+    # reviews counts (опционально)
+    review_counts = await get_review_counts(db, user_id)
+
+    result = {
+        "ok": True,
+        "user": {
+            "tg_id": user["tg_id"],
+            "name": user["name"],
+            "avatar": safe_avatar_url(user["avatar"]),
+            "username": user["username"],
+            "age": user["age"],
+            "created_at": user["created_at"]
+        },
+        "tags": tags,
+        "sessions": sessions,
+        "recent_contacts": contacts,
+        "review_counts": review_counts
+    }
+    return result
 
 # ----------------------
 # API: get tags
 # ----------------------
 @router.get("/api/profile/tags")
-async def api_profile_get_tags(tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            return {"ok": False, "error": "user not found"}
-        user_id = row["id"]
-        cur = await db.execute("SELECT tag FROM user_tags WHERE user_id = ? ORDER BY tag COLLATE NOCASE", (user_id,))
-        tags = [r["tag"] for r in await cur.fetchall()]
-        return {"ok": True, "tags": tags}
+async def api_profile_get_tags(tg_id: int, db: aiosqlite.Connection = Depends(read_db)):
+    cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+    row = await cur.fetchone()
+    if not row:
+        return {"ok": False, "error": "user not found"}
+    user_id = row["id"]
+    cur = await db.execute("SELECT tag FROM user_tags WHERE user_id = ? ORDER BY tag COLLATE NOCASE", (user_id,))
+    tags = [r["tag"] for r in await cur.fetchall()]
+    return {"ok": True, "tags": tags}
 
 # ----------------------
 # API: replace tags (POST) - body: {tg_id:int, tags: [str,...]}
 # ----------------------
 @router.post("/api/profile/tags")
-async def api_profile_set_tags(request: Request):
+async def api_profile_set_tags(request: Request, pool: DBPool = Depends(db_pool)):
     body = await request.json()
     if not isinstance(body, dict) or "tg_id" not in body or "tags" not in body:
         raise HTTPException(status_code=400, detail="tg_id and tags required")
@@ -962,41 +1111,33 @@ async def api_profile_set_tags(request: Request):
         raise HTTPException(status_code=400, detail="tags must be list")
 
     # normalize: trim, lower, remove empty, unique, max length
-    norm = []
-    seen = set()
-    for t in tags:
-        try:
-            st = (str(t) or "").strip()
-        except Exception:
-            st = ""
-        if not st:
-            continue
-        st = st[:64]
-        st = st.lower()
-        if st in seen:
-            continue
-        seen.add(st)
-        norm.append(st)
+    norm = normalize_tags(tags)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async def _write(db):
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         row = await cur.fetchone()
         if not row:
-            return {"ok": False, "error": "user not found"}
+            return None
         user_id = row["id"]
 
-        # replace tags in transaction
-        await db.execute("BEGIN")
-        try:
-            await db.execute("DELETE FROM user_tags WHERE user_id = ?", (user_id,))
-            for t in norm:
-                await db.execute("INSERT OR IGNORE INTO user_tags (user_id, tag) VALUES (?, ?)", (user_id, t))
-            await db.commit()
-        except Exception:
-            await db.rollback()
-            raise
-
+        # replace tags: пишем только разницу и правим tag_counts; op выполняется в своём
+        # SAVEPOINT, ошибка откатит и теги, и счётчики
+        cur = await db.execute("SELECT tag FROM user_tags WHERE user_id = ?", (user_id,))
+        old = {r["tag"] for r in await cur.fetchall()}
+        new = set(norm)
+        removed, added = old - new, [t for t in norm if t not in old]
+        if removed:
+            await db.executemany("DELETE FROM user_tags WHERE user_id = ? AND tag = ?", [(user_id, t) for t in removed])
+        if added:
+            await db.executemany("INSERT INTO user_tags (user_id, tag) VALUES (?, ?)", [(user_id, t) for t in added])
+        await apply_tag_diff(db, removed, added)
+        return user_id
+
+    user_id = await pool.write(_write)
+    if user_id is None:
+        return {"ok": False, "error": "user not found"}
+    # индекс правится только после коммита
+    tag_index.set_tags(user_id, norm)
     return {"ok": True, "tags": norm}
 
 
@@ -1004,7 +1145,7 @@ async def api_profile_set_tags(request: Request):
 # API: update profile (name/avatar/age) - body: {tg_id, name?, avatar?, age?}
 # ----------------------
 @router.post("/api/profile/update")
-async def api_profile_update(request: Request):
+async def api_profile_update(request: Request, pool: DBPool = Depends(db_pool)):
     body = await request.json()
     if not isinstance(body, dict) or "tg_id" not in body:
         raise HTTPException(status_code=400, detail="tg_id required")
@@ -1017,15 +1158,13 @@ async def api_profile_update(request: Request):
     if avatar:
         avatar = safe_avatar_url(avatar)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async def _write(db):
         cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
         row = await cur.fetchone()
         if row is None:
             # create basic user record (include username)
             await db.execute("INSERT INTO users (tg_id, name, avatar, username, age, created_at, updated_at) VALUES (?, ?, ?, ?, ?, datetime('now'), datetime('now'))",
                              (tg_id, name, avatar, username, age))
-            await db.commit()
         else:
             # update fields present
             fields = []
@@ -1050,102 +1189,246 @@ async def api_profile_update(request: Request):
                 params.append(tg_id)
                 q = "UPDATE users SET " + ", ".join(fields) + ", updated_at = datetime('now') WHERE tg_id = ?"
                 await db.execute(q, tuple(params))
-                await db.commit()
+        cur = await db.execute("SELECT name, username, avatar, age FROM users WHERE tg_id = ?", (tg_id,))
+        return await cur.fetchone()
+
+    u = await pool.write(_write)
+    if u is not None:
+        session_grid.update_user(tg_id, u["name"], u["username"], u["avatar"], u["age"])
 
     return {"ok": True}
 
 
+SIMILAR_MAX_LIMIT = 500
+
+
+async def _similar_from_index(db, user_id: int, user_tags, limit: int, metric: str):
+    """Top-k из tag_index; из БД дочитываются только профили найденных."""
+    top = tag_index.similar(user_id, limit, metric)
+    if not top:
+        return []
+    ids = [uid for uid, _, _ in top]
+    cur = await db.execute(
+        f"SELECT id, tg_id, name, avatar, username, age FROM users WHERE id IN ({','.join('?' for _ in ids)})", ids
+    )
+    profiles = {r["id"]: r for r in await cur.fetchall()}
+    mine = set(user_tags)
+    out = []
+    for uid, common, score in top:
+        r = profiles.get(uid)
+        if r is None:
+            continue
+        out.append({
+            "tg_id": r["tg_id"],
+            "name": r["name"],
+            "username": r["username"],
+            "avatar": safe_avatar_url(r["avatar"]),
+            "age": r["age"],
+            "tags": [t for t in tag_index.tags_of(uid) if t in mine],
+            "common": common,
+            "score": round(score, 4),
+            "last_seen": tag_index.last_seen(uid)
+        })
+    return out
+
+
 @router.get("/api/users/similar")
-async def api_users_similar(tg_id: int, limit: int = 10):
-    """Возвращает пользователей с пересечением по тегам, отсортированных по числу совпадений и активности."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        # найдём user_id
-        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            return {"ok": False, "error": "user not found", "users": []}
-        user_id = row["id"]
+async def api_users_similar(tg_id: int, limit: int = 10, metric: str = "overlap",
+                            db: aiosqlite.Connection = Depends(read_db)):
+    """Возвращает пользователей с пересечением по тегам, отсортированных по числу совпадений и активности.
 
-        # получаем теги текущего пользователя
+    metric=jaccard - по доле общих тегов от объединения (без индекса - всегда overlap).
+    """
+    if metric not in SIMILAR_METRICS:
+        raise HTTPException(400, f"metric must be one of {', '.join(SIMILAR_METRICS)}")
+    limit = max(0, min(limit, SIMILAR_MAX_LIMIT))
+    # найдём user_id
+    cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+    row = await cur.fetchone()
+    if not row:
+        return {"ok": False, "error": "user not found", "users": []}
+    user_id = row["id"]
+    use_index = TAG_INDEX_ENABLED and tag_index.ready
+
+    # получаем теги текущего пользователя
+    if use_index:
+        user_tags = list(tag_index.tags_of(user_id))
+    else:
         cur = await db.execute("SELECT tag FROM user_tags WHERE user_id = ?", (user_id,))
         user_tags = [r["tag"] for r in await cur.fetchall()]
 
-        if not user_tags:
-            # fallback: вернём последние активные контакты (как в profile)
-            cur = await db.execute("""
-                SELECT u.tg_id, u.name, u.avatar, u.username, u.age, max(e.started_at) AS last_seen
-                FROM users u
-                JOIN eat_sessions e ON e.user_id = u.id
-                WHERE u.id != ?
-                GROUP BY u.id
-                ORDER BY last_seen DESC
-                LIMIT ?
-            """, (user_id, limit))
-            rows = await cur.fetchall()
-            res = []
-            for r in rows:
-                res.append({
-                    "tg_id": r["tg_id"],
-                    "name": r["name"],
-                    "username": r["username"],
-                    "avatar": safe_avatar_url(r["avatar"]),
-                    "age": r["age"],
-                    "tags": [],
-                    "common": 0,
-                    "last_seen": r["last_seen"]
-                })
-            return {"ok": True, "users": res}
-
-        # ищем других пользователей, у которых есть пересекающиеся теги
-        placeholders = ",".join("?" for _ in user_tags)
-        q = f"""
-            SELECT u.id AS uid, u.tg_id, u.name, u.avatar, u.username, u.age,
-                   GROUP_CONCAT(DISTINCT ut.tag) AS tags,
-                   COUNT(DISTINCT ut.tag) AS common,
-                   MAX(e.started_at) AS last_seen
-            FROM user_tags ut
-            JOIN users u ON u.id = ut.user_id
-            LEFT JOIN eat_sessions e ON e.user_id = u.id
-            WHERE ut.tag IN ({placeholders}) AND u.id != ?
-            GROUP BY u.id
-            ORDER BY common DESC, last_seen DESC
-            LIMIT ?
-        """
-        params = user_tags + [user_id, limit]
-        cur = await db.execute(q, params)
+    if not user_tags:
+        # fallback: вернём последние активные контакты (как в profile)
+        cur = await db.execute(RECENT_USERS_SQL, (user_id, limit))
         rows = await cur.fetchall()
-        out = []
+        res = []
         for r in rows:
-            tags = (r["tags"] or "").split(",") if r["tags"] else []
-            out.append({
+            res.append({
                 "tg_id": r["tg_id"],
                 "name": r["name"],
                 "username": r["username"],
                 "avatar": safe_avatar_url(r["avatar"]),
                 "age": r["age"],
-                "tags": tags,
-                "common": int(r["common"] or 0),
+                "tags": [],
+                "common": 0,
                 "last_seen": r["last_seen"]
             })
-        return {"ok": True, "users": out}
+        return {"ok": True, "users": res}
+
+    if use_index:
+        return {"ok": True, "users": await _similar_from_index(db, user_id, user_tags, limit, metric)}
+
+    # без индекса: ищем других пользователей, у которых есть пересекающиеся теги
+    placeholders = ",".join("?" for _ in user_tags)
+    q = f"""
+        SELECT u.id AS uid, u.tg_id, u.name, u.avatar, u.username, u.age,
+               GROUP_CONCAT(DISTINCT ut.tag) AS tags,
+               COUNT(DISTINCT ut.tag) AS common,
+               u.last_seen
+        FROM user_tags ut
+        JOIN users u ON u.id = ut.user_id
+        WHERE ut.tag IN ({placeholders}) AND u.id != ?
+        GROUP BY u.id
+        ORDER BY common DESC, last_seen DESC
+        LIMIT ?
+    """
+    params = user_tags + [user_id, limit]
+    cur = await db.execute(q, params)
+    rows = await cur.fetchall()
+    out = []
+    for r in rows:
+        tags = (r["tags"] or "").split(",") if r["tags"] else []
+        out.append({
+            "tg_id": r["tg_id"],
+            "name": r["name"],
+            "username": r["username"],
+            "avatar": safe_avatar_url(r["avatar"]),
+            "age": r["age"],
+            "tags": tags,
+            "common": int(r["common"] or 0),
+            "last_seen": r["last_seen"]
+        })
+    return {"ok": True, "users": out}
 
 @router.get("/api/tags")
-async def api_tags(limit: int = 100):
+async def api_tags(limit: int = 100, db: aiosqlite.Connection = Depends(read_db)):
     """Возвращает список популярных тегов с count, отсортированных по популярности.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("""
-            SELECT tag, COUNT(*) AS cnt
-            FROM user_tags
-            GROUP BY tag
-            ORDER BY cnt DESC, tag ASC
-            LIMIT ?
-        """, (limit,))
+    cur = await db.execute(TOP_TAGS_SQL, (limit,))
+    rows = await cur.fetchall()
+    tags = [{"tag": r["tag"], "count": r["cnt"]} for r in rows]
+    return {"ok": True, "tags": tags}
+
+
+@router.get("/api/tags/suggest")
+async def api_tags_suggest(prefix: str = "", limit: int = 10, db: aiosqlite.Connection = Depends(read_db)):
+    """Автодополнение тегов по префиксу, самые популярные первыми."""
+    prefix = prefix.strip().lower()
+    limit = max(0, min(limit, 50))
+    if not prefix:
+        cur = await db.execute(TOP_TAGS_SQL, (limit,))
         rows = await cur.fetchall()
-        tags = [{"tag": r["tag"], "count": r["cnt"]} for r in rows]
-        return {"ok": True, "tags": tags}
+    else:
+        rows = await suggest_tags(db, prefix, limit)
+    return {"ok": True, "prefix": prefix, "tags": [{"tag": r["tag"], "count": r["cnt"]} for r in rows]}
+
+
+CHAT_HISTORY_MAX_LIMIT = 100
+
+
+def init_data_tg_id(x_telegram_init_data: str = Header("")) -> int:
+    """tg_id из подписанного initData мини-аппа (заголовок X-Telegram-Init-Data)."""
+    return check_init_data(x_telegram_init_data, BOT_TOKEN)[1]
+
+
+@router.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    """Чат с собеседниками по accepted-инвайтам, протокол - app/chat.py.
+
+    -> {"type": "auth", "init_data": "<Telegram.WebApp.initData>"} - первым сообщением, не в URL
+    -> {"type": "send", "to": tg_id, "text": "...", "client_id": "..."}
+    <- {"type": "message", "id", "from_tg", "to_tg", "text", "created_at", "client_id"} | {"type": "error", ...}
+    Не прошли проверку initData или пользователь не найден - закрытие 1008.
+    """
+    await websocket.accept()
+    try:
+        msg = json.loads(await asyncio.wait_for(websocket.receive_text(), CHAT_AUTH_TIMEOUT_S))
+        if not isinstance(msg, dict) or msg.get("type") != "auth":
+            raise ValueError("auth expected")
+        _, tg_id = check_init_data(msg.get("init_data"), BOT_TOKEN)
+    except (asyncio.TimeoutError, ValueError, HTTPException) as e:
+        logging.info("ws_chat: auth failed: %s", getattr(e, "detail", None) or type(e).__name__)
+        await websocket.close(code=1008)
+        return
+    except (WebSocketDisconnect, RuntimeError):
+        return
+    async with get_pool().reader() as db:
+        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+        row = await cur.fetchone()
+        peers = await load_peers(db, row["id"]) if row else None
+    if not row:
+        await websocket.close(code=1008)
+        return
+    await chat_hub.serve(websocket, row["id"], tg_id, peers)
+
+
+@router.get("/api/chat/contacts")
+async def api_chat_contacts(limit: int = 100, tg_id: int = Depends(init_data_tg_id)):
+    """Собеседники (accepted-инвайты) с последним сообщением, свежие переписки первыми."""
+    limit = max(0, min(limit, 500))
+    await chat_hub.flush()
+    async with get_pool().reader() as db:
+        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+        row = await cur.fetchone()
+        if not row:
+            return {"ok": True, "contacts": []}
+        user_id = row["id"]
+        cur = await db.execute(CONTACTS_SQL, (user_id, user_id, user_id, user_id, limit))
+        rows = await cur.fetchall()
+    out = []
+    for r in rows:
+        last = None
+        if r["last_id"] is not None:
+            last = {"id": r["last_id"], "text": r["last_text"], "created_at": r["last_at"],
+                    "mine": r["last_sender_id"] == user_id}
+        out.append({
+            "tg_id": r["tg_id"],
+            "name": r["name"],
+            "username": r["username"],
+            "avatar": safe_avatar_url(r["avatar"]),
+            "last_message": last,
+        })
+    return {"ok": True, "contacts": out}
+
+
+@router.get("/api/chat/history")
+async def api_chat_history(with_tg: int, before_id: int = 0, limit: int = 50,
+                           tg_id: int = Depends(init_data_tg_id)):
+    """История переписки, новые первыми; следующая страница - before_id=next_before_id."""
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_LIMIT))
+    # недописанные сообщения хаба - в БД, чтобы страница их не пропустила
+    await chat_hub.flush()
+    async with get_pool().reader() as db:
+        cur = await db.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
+        row = await cur.fetchone()
+        if not row:
+            raise HTTPException(404, "user not found")
+        user_id = row["id"]
+        peer_id = await matched_peer(db, user_id, with_tg)
+        if peer_id is None:
+            raise HTTPException(403, "not matched")
+        lo, hi = pair(user_id, peer_id)
+        cur = await db.execute(HISTORY_SQL, (lo, hi, before_id if before_id > 0 else 2 ** 63 - 1, limit + 1))
+        rows = await cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    messages = [{
+        "id": r["id"],
+        "from_tg": tg_id if r["sender_id"] == user_id else with_tg,
+        "text": r["body"],
+        "created_at": r["created_at"],
+    } for r in rows]
+    return {"ok": True, "messages": messages, "next_before_id": rows[-1]["id"] if more else None}
 
 
 
@@ -1155,8 +1438,7 @@ async def api_tags(limit: int = 100):
 
 
 async def handle_review_from_survey(invite_id: int, reviewer_tg: int, reaction: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async def _write(db):
         cur = await db.execute("SELECT from_user_id, to_user_id FROM invites WHERE id = ?", (invite_id,))
         inv = await cur.fetchone()
         if not inv:
@@ -1173,108 +1455,96 @@ async def handle_review_from_survey(invite_id: int, reviewer_tg: int, reaction:
             target_id = inv["from_user_id"]
 
         # тут можно добавлять в reviews или вызывать существующую логику
-        await db.execute("INSERT INTO reviews (reviewer_id, target_user_id, reaction, created_at) VALUES (?, ?, ?, datetime('now'))",
-                         (reviewer_id, target_id, reaction))
-        await db.commit()
+        # повторное нажатие той же реакции - не ошибка
+        await add_review(db, reviewer_id, target_id, reaction)
         return {"ok": True}
 
+    return await get_pool().write(_write)
 
 
-@router.post("/telegram/webhook")
-async def telegram_webhook(request: Request):
-    data = await request.json()
 
-    # handle callback_query
-    if "callback_query" in data:
-        cq = data["callback_query"]
-        cq_id = cq.get("id")
-        from_user = cq.get("from", {})
-        tg_user_id = from_user.get("id")
-        data_str = cq.get("data", "") or ""
+async def _mark_callback_message(cq: dict, suffix: str):
+    """Дописывает отметку в исходное сообщение и убирает кнопки (если callback пришёл из сообщения)."""
+    msg = cq.get("message")
+    if not (msg and "chat" in msg and "message_id" in msg):
+        return
+    chat_id = msg["chat"]["id"]
+    mid = msg["message_id"]
+    await edit_message_text(chat_id=chat_id, message_id=mid, text=(msg.get("text") or "") + suffix)
+    await edit_message_reply_markup(chat_id=chat_id, message_id=mid, reply_markup={"inline_keyboard": []})
 
-        try:
-            if data_str.startswith("invite:"):
-                _, sid, action = data_str.split(":", 2)
-                iid = int(sid)
-                if action not in ("accept", "decline"):
-                    await answer_callback_query(cq_id, "Неверная команда", show_alert=True)
-                    return {"ok": True}
-                res = await handle_invite_response(iid, tg_user_id, action)
-                if res.get("ok"):
-                    await answer_callback_query(cq_id, f"Вы {('приняли' if action=='accept' else 'отклонили')} приглашение", show_alert=False)
-                else:
-                    await answer_callback_query(cq_id, res.get("error", "Ошибка"), show_alert=True)
-                return {"ok": True}
-
-            # после успешной обработки invite:
-            if res.get("ok"):
-                await answer_callback_query(cq_id, f"Вы {('приняли' if action=='accept' else 'отклонили')} приглашение", show_alert=False)
-                # попробуем обновить текст и убрать кнопки в исходном сообщении (если callback пришёл из сообщения)
-                try:
-                    msg = cq.get("message")
-                    if msg and "chat" in msg and "message_id" in msg:
-                        chat_id = msg["chat"]["id"]
-                        mid = msg["message_id"]
-                        # пометить в тексте
-                        new_text = (msg.get("text") or "") + ("\n\n✅ Вы приняли" if action=="accept" else "\n\n❌ Вы отказались")
-                        await edit_message_text(chat_id=chat_id, message_id=mid, text=new_text)
-                        await edit_message_reply_markup(chat_id=chat_id, message_id=mid, reply_markup={"inline_keyboard": []})
-                except Exception:
-                    logging.exception("failed to update invite message after callback")
-
-            if data_str.startswith("survey:"):
-                _, sid, ans = data_str.split(":", 2)
-                iid = int(sid)
-                if ans not in ("yes", "no"):
-                    await answer_callback_query(cq_id, "Неверный ответ", show_alert=True)
-                else:
-                    res = await handle_survey_response(iid, tg_user_id, ans)
-                    if res.get("ok"):
-                        await answer_callback_query(cq_id, "Спасибо, ответ принят", show_alert=False)
-                    else:
-                        await answer_callback_query(cq_id, res.get("error","Ошибка"), show_alert=True)
-                return {"ok": True}
-            
-            if res.get("ok"):
-                await answer_callback_query(cq_id, "Спасибо, ответ принят", show_alert=False)
-                try:
-                    msg = cq.get("message")
-                    if msg and "chat" in msg and "message_id" in msg:
-                        chat_id = msg["chat"]["id"]
-                        mid = msg["message_id"]
-                        choice = "Да" if ans=="yes" else "Нет"
-                        new_text = (msg.get("text") or "") + f"\n\nВы ответили: {choice} ✅"
-                        await edit_message_text(chat_id=chat_id, message_id=mid, text=new_text)
-                        await edit_message_reply_markup(chat_id=chat_id, message_id=mid, reply_markup={"inline_keyboard": []})
-                except Exception:
-                    logging.exception("failed to update survey message after callback")
-
-
-            if data_str.startswith("review:"):
-                _, sid, reaction = data_str.split(":", 2)
-                iid = int(sid)
-                res = await handle_review_from_survey(iid, tg_user_id, reaction)
-                if res.get("ok"):
-                    await answer_callback_query(cq_id, "Отзыв сохранён - спасибо!", show_alert=False)
-                else:
-                    await answer_callback_query(cq_id, res.get("error","Ошибка"), show_alert=True)
-                return {"ok": True}
-            
-            if res.get("ok"):
-                await answer_callback_query(cq_id, "Отзыв сохранён - спасибо!", show_alert=False)
-                try:
-                    msg = cq.get("message")
-                    if msg and "chat" in msg and "message_id" in msg:
-                        chat_id = msg["chat"]["id"]
-                        mid = msg["message_id"]
-                        new_text = (msg.get("text") or "") + "\n\n✅ Отзыв сохранён"
-                        await edit_message_text(chat_id=chat_id, message_id=mid, text=new_text)
-                        await edit_message_reply_markup(chat_id=chat_id, message_id=mid, reply_markup={"inline_keyboard": []})
-                except Exception:
-                    logging.exception("failed to update review message after callback")
-        except Exception:
-            logging.exception("telegram callback handling failed")
-            await answer_callback_query(cq_id, "Ошибка при обработке", show_alert=True)
-            return {"ok": True}
 
+@update_handler("callback_query")
+async def process_callback_query(cq: dict):
+    """Обработка callback_query в воркере app/webhook.py (апдейты одного пользователя - по порядку)."""
+    cq_id = cq.get("id")
+    from_user = cq.get("from", {})
+    tg_user_id = from_user.get("id")
+    data_str = cq.get("data", "") or ""
+
+    try:
+        if data_str.startswith("invite:"):
+            _, sid, action = data_str.split(":", 2)
+            iid = int(sid)
+            if action not in ("accept", "decline"):
+                await answer_callback_query(cq_id, "Неверная команда", show_alert=True)
+                return
+            res = await handle_invite_response(iid, tg_user_id, action)
+            if not res.get("ok"):
+                await answer_callback_query(cq_id, res.get("error", "Ошибка"), show_alert=True)
+                return
+            await answer_callback_query(cq_id, f"Вы {('приняли' if action=='accept' else 'отклонили')} приглашение", show_alert=False)
+            # попробуем обновить текст и убрать кнопки в исходном сообщении
+            try:
+                await _mark_callback_message(cq, "\n\n✅ Вы приняли" if action == "accept" else "\n\n❌ Вы отказались")
+            except Exception:
+                logging.exception("failed to update invite message after callback")
+            return
+
+        if data_str.startswith("survey:"):
+            _, sid, ans = data_str.split(":", 2)
+            iid = int(sid)
+            if ans not in ("yes", "no"):
+                await answer_callback_query(cq_id, "Неверный ответ", show_alert=True)
+                return
+            res = await handle_survey_response(iid, tg_user_id, ans)
+            if not res.get("ok"):
+                await answer_callback_query(cq_id, res.get("error","Ошибка"), show_alert=True)
+                return
+            await answer_callback_query(cq_id, "Спасибо, ответ принят", show_alert=False)
+            try:
+                choice = "Да" if ans == "yes" else "Нет"
+                await _mark_callback_message(cq, f"\n\nВы ответили: {choice} ✅")
+            except Exception:
+                logging.exception("failed to update survey message after callback")
+            return
+
+        if data_str.startswith("review:"):
+            _, sid, reaction = data_str.split(":", 2)
+            iid = int(sid)
+            res = await handle_review_from_survey(iid, tg_user_id, reaction)
+            if not res.get("ok"):
+                await answer_callback_query(cq_id, res.get("error","Ошибка"), show_alert=True)
+                return
+            await answer_callback_query(cq_id, "Отзыв сохранён - спасибо!", show_alert=False)
+            try:
+                await _mark_callback_message(cq, "\n\n✅ Отзыв сохранён")
+            except Exception:
+                logging.exception("failed to update review message after callback")
+            return
+    except Exception:
+        logging.exception("telegram callback handling failed")
+        await answer_callback_query(cq_id, "Ошибка при обработке", show_alert=True)
+
+
+@router.post("/telegram/webhook")
+async def telegram_webhook(request: Request):
+    """Сохраняет апдейт (дубли по update_id отсекаются) и сразу отвечает 200;
+    обработка - в пуле воркеров app/webhook.py."""
+    try:
+        data = await request.json()
+    except Exception:
+        return {"ok": True}
+    if isinstance(data, dict):
+        await webhook_dispatcher.accept(data)
     return {"ok": True}
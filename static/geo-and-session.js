@@ -347,9 +347,10 @@ function startUpdateLoop(tg_id) {
     updateIntervalId = setInterval(() => {
         navigator.geolocation.getCurrentPosition(async pos => {
         try {
-            await postJson("/start", { tg_id, lat: pos.coords.latitude, lon: pos.coords.longitude });
-            console.log("pos updated");
-            fetchNearbyAndRender(tg_id, pos.coords.latitude, pos.coords.longitude);
+            // один запрос: обновление сессии на месте + список рядом
+            const data = await postJson("/heartbeat", { tg_id, lat: pos.coords.latitude, lon: pos.coords.longitude, radius_km: 3.0 });
+            console.log("pos updated:", data.session);
+            renderNearby(data.nearby || []);
         } catch (e) {
             console.error("update error", e);
         }
@@ -408,6 +409,28 @@ function pluralizePeople(n) {
     return `${n} человек`;
 }
 
+function renderNearby(items) {
+    const countEl = $qs("#nearbyCount");
+    const cards = $qs("#nearbyCards");
+    if (!countEl || !cards) return;
+
+    // update title
+    const txt = `Рядом - ${pluralizePeople(items.length)} готовы обедать`;
+    countEl.textContent = txt;
+    countEl.classList.add("nearby-count--spaced");
+
+    // render cards
+    cards.innerHTML = "";
+    if (items.length === 0) {
+        cards.innerHTML = '<div class="muted">Никого рядом не найдено</div>';
+        return;
+    }
+    for (const p of items) {
+        const node = renderPersonCard(p);
+        cards.appendChild(node);
+    }
+}
+
 async function fetchNearbyAndRender(tg_id, lat, lon, radius_km = 3.0) {
     const countEl = $qs("#nearbyCount");
     const cards = $qs("#nearbyCards");
@@ -417,23 +440,7 @@ async function fetchNearbyAndRender(tg_id, lat, lon, radius_km = 3.0) {
         const res = await fetch(`/nearby?tg_id=${encodeURIComponent(tg_id)}&lat=${encodeURIComponent(lat)}&lon=${encodeURIComponent(lon)}&radius_km=${encodeURIComponent(radius_km)}`, { cache: "no-store" });
         if (!res.ok) throw new Error("nearby fetch failed " + res.status);
         const data = await res.json();
-        const items = data.nearby || [];
-
-        // update title
-        const txt = `Рядом - ${pluralizePeople(items.length)} готовы обедать`;
-        countEl.textContent = txt;
-        countEl.classList.add("nearby-count--spaced");
-
-        // render cards
-        cards.innerHTML = "";
-        if (items.length === 0) {
-            cards.innerHTML = '<div class="muted">Никого рядом не найдено</div>';
-            return;
-        }
-        for (const p of items) {
-            const node = renderPersonCard(p);
-            cards.appendChild(node);
-        }
+        renderNearby(data.nearby || []);
     } catch (e) {
         console.error("fetchNearbyAndRender error", e);
         cards.innerHTML = '<div class="muted">Ошибка при поиске людей</div>';
@@ -462,5 +469,5 @@ export {
     startEatingWithDelay, showEatStatus, hideEatStatus,
     startEating, stopEating, startUpdateLoop, stopUpdateLoop,
     showTimerAndUi, hideTimerAndUi,
-    pluralizePeople, fetchNearbyAndRender, formatDistance
+    pluralizePeople, fetchNearbyAndRender, renderNearby, formatDistance
 };
\ No newline at end of file
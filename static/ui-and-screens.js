@@ -261,22 +261,15 @@ const seenInviteIds = new Set();
 // Показывать только первый новый invite (true) или все подряд (false)
 const SHOW_ONLY_FIRST_INVITE = true;
 
-// Пауза между опросами (ms)
-const INVITE_POLL_INTERVAL = 15_000;
+// long-poll /api/invites/wait: сколько сервер держит запрос (s) и пауза после ошибки (ms)
+const INVITE_WAIT_TIMEOUT_S = 25;
+const INVITE_WAIT_RETRY_MS = 5_000;
 
-let _invitePollTimer = null;
-let _invitePollRunning = false;
+let _inviteWaitGen = 0;      // каждый start/stop начинает новое поколение, старый цикл выходит
+let _inviteWaitCtrl = null;
+let _inviteSinceId = 0;
 
-async function pollIncomingInvitesOnce() {
-  if (_invitePollRunning) return;
-  _invitePollRunning = true;
-  try {
-    const tg = getTgId();
-    if (!tg) return; // не авторизован - нет смысла
-    // если вкладка невидима - не опрашиваем (экономия)
-    if (typeof document !== "undefined" && document.hidden) return;
-
-    const invites = await fetchIncomingInvites();
+function showIncomingInvites(invites) {
     if (!Array.isArray(invites) || invites.length === 0) return;
 
     // фильтруем новые
@@ -295,24 +288,43 @@ async function pollIncomingInvitesOnce() {
         setTimeout(() => openIncomingInviteModal(inv), 200);
       }
     }
-  } catch (e) {
-    console.warn("pollIncomingInvitesOnce failed", e);
-  } finally {
-    _invitePollRunning = false;
+}
+
+// Сервер держит запрос, пока не придёт новый инвайт (или timeout), и сразу отвечает
+async function inviteWaitLoop(gen) {
+  while (gen === _inviteWaitGen) {
+    const tg = getTgId();
+    // не авторизован или вкладка в фоне - ждём локально, без запросов
+    if (!tg || (typeof document !== "undefined" && document.hidden)) {
+      await sleep(1000);
+      continue;
+    }
+    try {
+      _inviteWaitCtrl = new AbortController();
+      const url = `/api/invites/wait?tg_id=${encodeURIComponent(tg)}&since_id=${_inviteSinceId}&timeout=${INVITE_WAIT_TIMEOUT_S}`;
+      const res = await fetch(url, { cache: "no-store", signal: _inviteWaitCtrl.signal });
+      if (!res.ok) throw new Error("wait failed " + res.status);
+      const data = await res.json();
+      if (data.last_id) _inviteSinceId = Math.max(_inviteSinceId, Number(data.last_id));
+      showIncomingInvites(data.invites);
+    } catch (e) {
+      if (e && e.name === "AbortError") break;
+      console.warn("inviteWaitLoop failed", e);
+      await sleep(INVITE_WAIT_RETRY_MS);
+    }
   }
 }
 
-function startInvitePoll(interval = INVITE_POLL_INTERVAL) {
+function startInvitePoll() {
   stopInvitePoll();
-  // стартуем немедленно, затем по таймеру
-  pollIncomingInvitesOnce();
-  _invitePollTimer = setInterval(pollIncomingInvitesOnce, interval);
+  inviteWaitLoop(_inviteWaitGen);
 }
 
 function stopInvitePoll() {
-  if (_invitePollTimer) {
-    clearInterval(_invitePollTimer);
-    _invitePollTimer = null;
+  _inviteWaitGen++;
+  if (_inviteWaitCtrl) {
+    _inviteWaitCtrl.abort();
+    _inviteWaitCtrl = null;
   }
 }
 
@@ -662,6 +674,7 @@ async function loadScreen(name) {
     name = sanitizeScreenName(name);
     if (name === currentScreen) return;
     currentScreen = name;
+    if (name !== "chat") stopChat();
     const url = `/screens/${name}.html`;
     try {
         const res = await fetch(url, { cache: "no-store" });
@@ -720,7 +733,9 @@ const screenInits = {
         }
     },
     map(){},
-    chat(){},
+    chat() {
+        initChatScreen();
+    },
     profile: async function() {
         const avatarEl = $qs("#profileAvatar");
         const nameEl = $qs("#profileName");
@@ -1171,6 +1186,233 @@ async function tryAutoStart() {
     }, { enableHighAccuracy: true, maximumAge: 0, timeout: 10000 });
 }
 
+// ========== Chat (WebSocket /ws/chat) ==========
+const CHAT_RECONNECT_MS = 2_000;
+const CHAT_PAGE = 50;
+
+let _chatWs = null;
+let _chatPeer = null;           // открытая переписка: контакт из /api/chat/contacts
+let _chatBeforeId = null;       // keyset следующей страницы истории
+let _chatShownIds = new Set();
+let _chatUnread = {};           // tg_id -> непрочитанные в этой сессии
+let _chatSeq = 0;
+
+function chatTime(created_at) {
+    if (!created_at) return "";
+    const d = new Date(created_at.replace(" ", "T") + "Z");
+    return isNaN(d) ? "" : d.toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" });
+}
+
+function openChatSocket() {
+    const tg = getTgId();
+    if (!tg || _chatWs) return;
+    const proto = location.protocol === "https:" ? "wss" : "ws";
+    const ws = new WebSocket(`${proto}://${location.host}/ws/chat`);
+    // личность - подписанный initData первым сообщением, не в URL
+    ws.onopen = () => ws.send(JSON.stringify({ type: "auth", init_data: getInitDataRaw() }));
+    ws.onmessage = (ev) => {
+        try {
+            handleChatEvent(JSON.parse(ev.data));
+        } catch (e) {
+            console.warn("chat event parse failed", e, ev.data);
+        }
+    };
+    ws.onclose = (ev) => {
+        if (_chatWs !== ws) return;
+        _chatWs = null;
+        // 1008 - initData не прошёл проверку или пользователь не найден; иначе (в т.ч. 1013 - не успевали читать) переподключаемся и дочитываем
+        if (ev.code === 1008 || !$qs(".screen.chat")) return;
+        setTimeout(() => {
+            if (_chatWs || !$qs(".screen.chat")) return;
+            openChatSocket();
+            if (_chatPeer) loadChatHistory(true);
+            else loadChatContacts();
+        }, CHAT_RECONNECT_MS);
+    };
+    _chatWs = ws;
+}
+
+function stopChat() {
+    _chatPeer = null;
+    if (_chatWs) {
+        const ws = _chatWs;
+        _chatWs = null;
+        ws.close();
+    }
+}
+
+function handleChatEvent(ev) {
+    if (ev.type === "error") {
+        console.warn("chat error:", ev.error);
+        if (_chatPeer) appendChatNotice(`Не отправлено: ${ev.error}`);
+        return;
+    }
+    if (ev.type !== "message") return;
+    const me = Number(getTgId());
+    const peerTg = Number(ev.from_tg) === me ? Number(ev.to_tg) : Number(ev.from_tg);
+    if (_chatPeer && Number(_chatPeer.tg_id) === peerTg) {
+        appendChatMessage(ev, true);
+    } else if (Number(ev.from_tg) !== me) {
+        _chatUnread[peerTg] = (_chatUnread[peerTg] || 0) + 1;
+    }
+    updateChatRow(peerTg, ev);
+}
+
+async function loadChatContacts() {
+    const list = $qs("#chatList");
+    const tg = getTgId();
+    if (!list) return;
+    if (!tg) {
+        list.innerHTML = '<li class="muted">Войдите через Telegram, чтобы писать собеседникам</li>';
+        return;
+    }
+    try {
+        const res = await fetch("/api/chat/contacts", { cache: "no-store", headers: initDataHeaders() });
+        const data = await res.json();
+        const contacts = Array.isArray(data.contacts) ? data.contacts : [];
+        if (!contacts.length) {
+            list.innerHTML = '<li class="muted">Здесь появятся те, с кем вы договорились встретиться</li>';
+            return;
+        }
+        list.innerHTML = "";
+        for (const c of contacts) list.appendChild(renderChatRow(c));
+    } catch (e) {
+        console.warn("loadChatContacts failed", e);
+        list.innerHTML = '<li class="muted">Не удалось загрузить чаты</li>';
+    }
+}
+
+function renderChatRow(c) {
+    const li = document.createElement("li");
+    li.className = "chat-row";
+    li.dataset.tg = c.tg_id;
+    const name = c.name || (c.username ? "@" + c.username : "Пользователь");
+    const last = c.last_message;
+    const unread = _chatUnread[c.tg_id] || 0;
+    li.innerHTML = `
+        <img class="avatar" src="${escapeHtml(c.avatar || "/static/images/default_avatar.svg")}" alt="avatar"/>
+        <div class="chat-body">
+            <div class="chat-name">${escapeHtml(name)}</div>
+            <div class="chat-last">${last ? escapeHtml((last.mine ? "Вы: " : "") + last.text) : "Напишите первым"}</div>
+        </div>
+        <div class="chat-meta">${last ? chatTime(last.created_at) : ""}${unread ? ` <span class="badge">${unread}</span>` : ""}</div>`;
+    li.addEventListener("click", () => openChatThread(c));
+    return li;
+}
+
+function updateChatRow(peerTg, ev) {
+    const li = document.querySelector(`.chat-row[data-tg="${peerTg}"]`);
+    if (!li) return;
+    const mine = Number(ev.from_tg) === Number(getTgId());
+    const lastEl = li.querySelector(".chat-last");
+    if (lastEl) lastEl.textContent = (mine ? "Вы: " : "") + ev.text;
+    const meta = li.querySelector(".chat-meta");
+    const unread = _chatUnread[peerTg] || 0;
+    if (meta) meta.innerHTML = `${chatTime(ev.created_at)}${unread ? ` <span class="badge">${unread}</span>` : ""}`;
+    // свежая переписка - наверх
+    if (li.parentNode && li.parentNode.firstChild !== li) li.parentNode.insertBefore(li, li.parentNode.firstChild);
+}
+
+function openChatThread(c) {
+    _chatPeer = c;
+    delete _chatUnread[c.tg_id];
+    $qs("#chatContacts").hidden = true;
+    $qs("#chatThread").hidden = false;
+    $qs("#chatPeerName").textContent = c.name || (c.username ? "@" + c.username : "Пользователь");
+    $qs("#chatPeerAvatar").src = c.avatar || "/static/images/default_avatar.svg";
+    loadChatHistory(true);
+    const input = $qs("#chatInput");
+    if (input) input.focus();
+}
+
+function closeChatThread() {
+    _chatPeer = null;
+    $qs("#chatThread").hidden = true;
+    $qs("#chatContacts").hidden = false;
+    loadChatContacts();
+}
+
+async function loadChatHistory(reset) {
+    const box = $qs("#chatMessages");
+    const more = $qs("#chatMore");
+    const tg = getTgId();
+    if (!box || !_chatPeer || !tg) return;
+    const peer = _chatPeer;
+    if (reset) {
+        _chatBeforeId = null;
+        _chatShownIds = new Set();
+        box.querySelectorAll(".chat-msg").forEach(el => el.remove());
+    }
+    const params = new URLSearchParams({ with_tg: peer.tg_id, limit: CHAT_PAGE });
+    if (_chatBeforeId) params.set("before_id", _chatBeforeId);
+    try {
+        const res = await fetch(`/api/chat/history?${params}`, { cache: "no-store", headers: initDataHeaders() });
+        if (!res.ok) throw new Error("history failed " + res.status);
+        const data = await res.json();
+        if (_chatPeer !== peer) return;
+        // ответ - новые первыми; ранние вставляем сверху по одному
+        const atBottom = reset || box.scrollTop + box.clientHeight >= box.scrollHeight - 20;
+        for (const m of data.messages || []) appendChatMessage(m, false);
+        _chatBeforeId = data.next_before_id;
+        if (more) more.hidden = !_chatBeforeId;
+        if (atBottom) box.scrollTop = box.scrollHeight;
+    } catch (e) {
+        console.warn("loadChatHistory failed", e);
+    }
+}
+
+function appendChatMessage(m, live) {
+    const box = $qs("#chatMessages");
+    if (!box || _chatShownIds.has(m.id)) return;
+    _chatShownIds.add(m.id);
+    const el = document.createElement("div");
+    el.className = "chat-msg" + (Number(m.from_tg) === Number(getTgId()) ? " mine" : "");
+    el.dataset.id = m.id;
+    el.innerHTML = `${escapeHtml(m.text)}<span class="time">${chatTime(m.created_at)}</span>`;
+    if (live) {
+        box.appendChild(el);
+        box.scrollTop = box.scrollHeight;
+    } else {
+        // история приходит от новых к старым: каждое следующее - над предыдущими
+        const more = $qs("#chatMore");
+        const first = Array.from(box.querySelectorAll(".chat-msg")).find(x => Number(x.dataset.id) > m.id);
+        box.insertBefore(el, first || null);
+        if (more && box.firstChild !== more) box.insertBefore(more, box.firstChild);
+    }
+}
+
+function appendChatNotice(text) {
+    const box = $qs("#chatMessages");
+    if (!box) return;
+    const el = document.createElement("div");
+    el.className = "muted";
+    el.textContent = text;
+    box.appendChild(el);
+}
+
+function initChatScreen() {
+    const back = $qs("#chatBack");
+    if (back) back.addEventListener("click", closeChatThread);
+    const more = $qs("#chatMore");
+    if (more) more.addEventListener("click", () => loadChatHistory(false));
+    const form = $qs("#chatForm");
+    if (form) form.addEventListener("submit", (ev) => {
+        ev.preventDefault();
+        const input = $qs("#chatInput");
+        const text = (input.value || "").trim();
+        if (!text || !_chatPeer) return;
+        if (!_chatWs || _chatWs.readyState !== WebSocket.OPEN) {
+            appendChatNotice("Нет соединения, пробуем переподключиться...");
+            openChatSocket();
+            return;
+        }
+        _chatWs.send(JSON.stringify({ type: "send", to: Number(_chatPeer.tg_id), text, client_id: String(++_chatSeq) }));
+        input.value = "";
+    });
+    openChatSocket();
+    loadChatContacts();
+}
+
 // ========== Notifications for initiator (mini-app) ==========
 let _notifPollTimer = null;
 const NOTIF_POLL_INTERVAL = 15_000;
@@ -1358,31 +1600,79 @@ async function pollNotificationsOnce() {
         if (!unread.length) return;
 
         // Показываем новые (старые сначала)
-        for (const n of unread.reverse()) {
-            seenNotifIds.add(n.id);
-            openNotificationModal(n);
-
-            // Пометить как прочитанное (best-effort)
-            try {
-                const tg = getTgId();
-                if (tg) await postJson("/api/notifications/mark_read", { tg_id: tg, notification_id: n.id });
-            } catch (e) {
-                console.warn("mark_read failed for", n.id, e);
-            }
-        }
+        for (const n of unread.reverse()) await showNotification(n);
     } catch (e) {
         console.warn("pollNotificationsOnce failed", e);
     }
 }
 
+// показанные уведомления помечаются прочитанными одним запросом на пачку
+const NOTIF_MARK_DELAY = 300;
+let _notifToMark = [];
+let _notifMarkTimer = null;
+
+async function flushNotifMarkRead() {
+    _notifMarkTimer = null;
+    const ids = _notifToMark;
+    _notifToMark = [];
+    const tg = getTgId();
+    if (!tg || !ids.length) return;
+    try {
+        await postJson("/api/notifications/mark_read_bulk", { tg_id: tg, ids });
+    } catch (e) {
+        console.warn("mark_read_bulk failed for", ids, e);
+    }
+}
+
+async function showNotification(n) {
+    if (!n || n.read || seenNotifIds.has(n.id)) return;
+    seenNotifIds.add(n.id);
+    openNotificationModal(n);
+
+    // Пометить как прочитанное (best-effort)
+    _notifToMark.push(n.id);
+    if (!_notifMarkTimer) _notifMarkTimer = setTimeout(flushNotifMarkRead, NOTIF_MARK_DELAY);
+}
 
-function startNotificationsPoll(interval = NOTIF_POLL_INTERVAL) {
-    if (_notifPollTimer) clearInterval(_notifPollTimer);
+// SSE: сервер сам присылает уведомления; опрос остаётся запасным вариантом
+let _notifStream = null;
+
+function startNotificationsStream() {
+    const tg = getTgId();
+    if (!tg || typeof EventSource === "undefined") return false;
+    if (_notifStream) _notifStream.close();
+    const es = new EventSource(`/api/notifications/stream?tg_id=${encodeURIComponent(tg)}`);
+    es.addEventListener("notification", (ev) => {
+        try {
+            showNotification(JSON.parse(ev.data));
+        } catch (e) {
+            console.warn("notification event parse failed", e, ev.data);
+        }
+    });
+    es.onerror = () => {
+        // CONNECTING - браузер переподключится сам (с Last-Event-ID); CLOSED - уходим на опрос
+        if (es.readyState === EventSource.CLOSED && _notifStream === es) {
+            console.warn("notifications stream closed, fallback to polling");
+            _notifStream = null;
+            startNotificationsPoll(NOTIF_POLL_INTERVAL, false);
+        }
+    };
+    _notifStream = es;
+    return true;
+}
+
+function startNotificationsPoll(interval = NOTIF_POLL_INTERVAL, useStream = true) {
+    stopNotificationsPoll();
+    if (useStream && startNotificationsStream()) return;
     pollNotificationsOnce();
     _notifPollTimer = setInterval(pollNotificationsOnce, interval);
 }
 
 function stopNotificationsPoll() {
+    if (_notifStream) {
+        _notifStream.close();
+        _notifStream = null;
+    }
     if (_notifPollTimer) {
         clearInterval(_notifPollTimer);
         _notifPollTimer = null;
@@ -105,6 +105,18 @@ function buildInitDataObject() {
     return null;
 }
 
+// подписанный initData строкой query - для X-Telegram-Init-Data и auth-сообщения /ws/chat
+function getInitDataRaw() {
+    const initStr = window.Telegram?.WebApp?.initData ?? null;
+    if (initStr && typeof initStr === "string" && initStr.includes("=")) return initStr;
+    const parsedFromUrl = extractTgWebAppDataFromUrl();
+    return parsedFromUrl ? new URLSearchParams(parsedFromUrl).toString() : "";
+}
+
+function initDataHeaders() {
+    return { "X-Telegram-Init-Data": getInitDataRaw() };
+}
+
 async function verifyInitData(initData) {
     return postJson("/verify_init", { initData })
         .catch(err => ({ ok: false, error: err.message }));
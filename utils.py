@@ -1,9 +1,24 @@
 # utils.py
 
+import hmac
+import json
 import math
+import heapq
+import hashlib
+from functools import lru_cache
+from urllib.parse import parse_qsl
 from fastapi import HTTPException
 from datetime import datetime, timedelta, timezone
 
+try:
+    import numpy as np  # опционально: без numpy работает чистый Python
+except ImportError:
+    np = None
+
+EARTH_RADIUS_KM = 6371.0
+# на коротких массивах накладные расходы numpy дороже цикла
+NUMPY_MIN_BATCH = 32
+
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
@@ -20,9 +35,124 @@ def parse_int(v, name):
         raise HTTPException(status_code=400, detail=f"invalid {name}")
     
 def haversine_km(lat1, lon1, lat2, lon2):
-    R = 6371.0
+    R = EARTH_RADIUS_KM
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlambda = math.radians(lon2 - lon1)
     a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
     return R * 2 * math.asin(math.sqrt(a))
+
+
+TAG_MAX_LEN = 64
+
+def normalize_tags(tags):
+    """trim, lower, без пустых и дублей, не длиннее TAG_MAX_LEN; порядок сохраняется."""
+    norm = []
+    seen = set()
+    for t in tags:
+        try:
+            st = (str(t) or "").strip()
+        except Exception:
+            st = ""
+        if not st:
+            continue
+        st = st[:TAG_MAX_LEN].lower()
+        if st in seen:
+            continue
+        seen.add(st)
+        norm.append(st)
+    return norm
+
+
+@lru_cache(maxsize=4)
+def _webapp_secret(bot_token: str) -> bytes:
+    # ключ зависит только от токена - не пересчитываем на каждый запрос
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+def init_data_hash(init_data: dict, bot_token: str) -> str:
+    """HMAC-SHA256 подпись initData мини-аппа (hex), как её считает Telegram."""
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(init_data.items()) if k != "hash")
+    return hmac.new(_webapp_secret(bot_token), data_check_string.encode(), hashlib.sha256).hexdigest()
+
+INIT_DATA_MAX_AGE_S = 24 * 3600
+
+def check_init_data(init_raw, bot_token: str, max_age_s: int = INIT_DATA_MAX_AGE_S):
+    """Проверить initData мини-аппа (строка query или dict); вернуть (init_data, tg_id).
+
+    400 - нет initData или id, 500 - нет BOT_TOKEN, 403 - подпись не сошлась или auth_date старше max_age_s.
+    """
+    if isinstance(init_raw, str):
+        # parse_qsl корректно декодирует %-encoding и возвращает пары
+        init_data = dict(parse_qsl(init_raw, keep_blank_values=True))
+    else:
+        init_data = dict(init_raw or {})
+    if not init_data:
+        raise HTTPException(status_code=400, detail="initData required")
+    if not bot_token:
+        raise HTTPException(status_code=500, detail="BOT_TOKEN not set on server")
+
+    # клиент мог распарсить user в объект - возвращаем компактный JSON, значения - строки, как шлёт Telegram
+    if isinstance(init_data.get("user"), dict):
+        init_data["user"] = json.dumps(init_data["user"], separators=(",", ":"), ensure_ascii=False)
+    for k, v in list(init_data.items()):
+        if v is None:
+            init_data[k] = ""
+        elif not isinstance(v, str):
+            init_data[k] = str(v)
+
+    if not hmac.compare_digest(init_data_hash(init_data, bot_token), init_data.get("hash", "")):
+        raise HTTPException(status_code=403, detail="invalid initData")
+    try:
+        auth_date = int(init_data.get("auth_date", 0))
+    except ValueError:
+        auth_date = 0
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    if auth_date == 0 or (now_ts - auth_date) > max_age_s:
+        raise HTTPException(status_code=403, detail="initData expired")
+    try:
+        tg_id = int(init_data.get("id") or init_data.get("user", "") and (json.loads(init_data.get("user")) or {}).get("id"))
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid id in initData")
+    return init_data, tg_id
+
+
+def haversine_many(lat, lon, lats, lons):
+    """Расстояния (км) от точки (lat, lon) до массивов координат за один проход.
+
+    С numpy возвращает ndarray, без него - list.
+    """
+    if np is not None and len(lats) >= NUMPY_MIN_BATCH:
+        lat1 = math.radians(lat)
+        lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+        dphi = lat2 - lat1
+        dlambda = np.radians(np.asarray(lons, dtype=np.float64) - lon)
+        a = np.sin(dphi / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlambda / 2) ** 2
+        return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return [haversine_km(lat, lon, la, lo) for la, lo in zip(lats, lons)]
+
+
+def nearest_k(dists, k=None, max_km=None):
+    """Индексы ближайших (не дальше max_km), отсортированные по расстоянию.
+
+    k=None - все подходящие. Top-k через partition (numpy) или heapq; при равных расстояниях,
+    в том числе на границе k, первым идёт меньший индекс - оба пути возвращают одно и то же.
+    """
+    if np is not None and isinstance(dists, np.ndarray):
+        idx = np.flatnonzero(dists <= max_km) if max_km is not None else np.arange(len(dists))
+        if k is not None and k < len(idx):
+            if k <= 0:
+                return []
+            # берём всех, равных k-му: argpartition выбрал бы из них произвольных, а не с меньшими индексами
+            sub = dists[idx]
+            idx = idx[sub <= np.partition(sub, k - 1)[k - 1]]
+        return idx[np.argsort(dists[idx], kind="stable")][:k].tolist()
+    pairs = ((d, i) for i, d in enumerate(dists) if max_km is None or d <= max_km)
+    if k is not None:
+        return [i for _, i in heapq.nsmallest(max(0, k), pairs)]
+    return [i for _, i in sorted(pairs)]
+
+
+def rank_by_distance(lat, lon, lats, lons, k=None, max_km=None):
+    """[(index, distance_km)] ближайших точек - общий путь ранжирования для /nearby и т.п."""
+    dists = haversine_many(lat, lon, lats, lons)
+    return [(i, float(dists[i])) for i in nearest_k(dists, k, max_km)]